@@ -1,50 +1,37 @@
-import sqlite3
 import os
 import time
 import json
+import argparse
 import configparser
 import numpy as np
 from matplotlib import pyplot as plt
-from matplotlib import font_manager, colors
-from tqdm import trange, tqdm
-from collections import Counter
+from matplotlib import font_manager, colors, ticker
 from wordcloud import WordCloud
+from collections import Counter
+
+import analytics
+import database
 
 # 载入数据库名
 CONFIG = configparser.ConfigParser()
 CONFIG.read('config.ini', encoding='utf-8')
 DB_NAME = CONFIG['common'].get('database_name', fallback='data')
 
-# 连接数据库
-conn = sqlite3.connect('data/' + DB_NAME + '.sqlite3')
-conn.row_factory = sqlite3.Row
-cursor = conn.cursor()
-
 if not os.path.exists('analysize'):
     os.mkdir('analysize')
 
-
-def str_to_timestamp(time_str):
-    '''将时间字符串转换成时间戳'''
-    return int(time.mktime(time.strptime(time_str, "%Y-%m-%d %H:%M:%S")))
+# 以千为单位的坐标轴标签
+THOUSANDS = ticker.FuncFormatter(lambda value, _: '{:g}K'.format(value) if value else '0')
 
 
-def pic01():
+def pic01(data, period, today):
     '''统计视频信息按时段的分布'''
 
     print('pic0 and pic1')
 
-    # 数据库查询
-    view_sum = [0] * 24
-    count = [0] * 24
-    for day in trange(1, 32, position=1):
-        for hour in trange(0, 24, position=0):
-            st = str_to_timestamp('2021-08-{} {}:00:00'.format(day, hour))
-            ed = str_to_timestamp('2021-08-{} {}:59:59'.format(day, hour))
-            count[hour] += cursor.execute(
-                'SELECT COUNT() from VIDEO WHERE pubdate BETWEEN ? and ?', (st, ed)).fetchone()[0]
-            view_sum[hour] += cursor.execute(
-                'SELECT SUM(view) from VIDEO WHERE pubdate BETWEEN ? and ?', (st, ed)).fetchone()[0]
+    # 数据统计
+    count = analytics.hour_histogram(data['pubdate'])
+    view_sum = analytics.hour_histogram(data['pubdate'], data['view'])
 
     # 数据准备
     N = 24
@@ -66,12 +53,11 @@ def pic01():
     ax.bar(theta, count / 1000, width=width, bottom=0.0, color=colors)
     ax.set_xticks(np.linspace(0, 2*np.pi, 24, endpoint=False))
     ax.set_xticklabels(range(0, 24), fontsize=20)
-    ax.set_yticks([i for i in range(0, 6)])
-    ax.set_yticklabels([0] + ['{}K'.format(i)
-                       for i in range(1, 6)], fontsize=15)
+    ax.yaxis.set_major_formatter(THOUSANDS)
+    ax.tick_params(axis='y', labelsize=15)
     font = font_manager.FontProperties(fname='font/msyh.ttc', size=28)
-    ax.set_title('2021年08月 B站数码区视频投稿数量在一天中的分布', fontproperties=font)
-    plt.suptitle("2021.09.05 统计", x=0.75, y=0.9,
+    ax.set_title('{} B站数码区视频投稿数量在一天中的分布'.format(period), fontproperties=font)
+    plt.suptitle(today + ' 统计', x=0.75, y=0.9,
                  fontproperties=font, fontsize=18)
     plt.savefig('analysize/pic0.png')
 
@@ -86,35 +72,20 @@ def pic01():
            width=width, bottom=0.0, color=colors)
     ax.set_xticks(np.linspace(0, 2*np.pi, 24, endpoint=False))
     ax.set_xticklabels(range(0, 24), fontsize=20)
-    ax.set_yticks([i for i in range(0, 11, 2)])
-    ax.set_yticklabels([0] + ['{}K'.format(i)
-                       for i in range(2, 11, 2)], fontsize=15)
+    ax.yaxis.set_major_formatter(THOUSANDS)
+    ax.tick_params(axis='y', labelsize=15)
     font = font_manager.FontProperties(fname='font/msyh.ttc', size=28)
-    plt.title('2021年08月 B站数码区一天中各时段发布视频的平均播放量', fontproperties=font)
-    plt.suptitle("2021.09.05 统计", x=0.75, y=0.9,
+    plt.title('{} B站数码区一天中各时段发布视频的平均播放量'.format(period), fontproperties=font)
+    plt.suptitle(today + ' 统计', x=0.75, y=0.9,
                  fontproperties=font, fontsize=18)
     plt.savefig('analysize/pic1.png')
 
 
-def pic2():
+def pic2(count, period, today):
     '''分析标签'''
 
     print('\npic2')
 
-    # 数据库查询与数据统计
-    st = str_to_timestamp('2021-08-{} {}:00:00'.format(1, 0))
-    ed = str_to_timestamp('2021-08-{} {}:59:59'.format(31, 23))
-    total_num = cursor.execute(
-        'SELECT COUNT() from VIDEO WHERE pubdate BETWEEN ? and ?', (st, ed)).fetchone()[0]
-    data = cursor.execute(
-        'SELECT * from VIDEO WHERE pubdate BETWEEN ? and ?', (st, ed))
-
-    count = Counter()
-    with tqdm(total=total_num) as pbar:
-        for row in data:
-            keywords = row['keywords']
-            count += Counter(keywords.split(','))
-            pbar.update(1)
     with open('count.json', 'w') as f:
         json.dump(count, f)
 
@@ -122,7 +93,7 @@ def pic2():
     del_list = ['数码', '科技', '哔哩哔哩', 'B站', '弹幕',
                 'Bilibili', '打卡挑战', '科技猎手', '必剪创作']
     for name in del_list:
-        del count[name]
+        count.pop(name, None)
 
     N = 30
 
@@ -146,31 +117,25 @@ def pic2():
     plt.xticks(fontsize=18)
     plt.xlabel('词频 / 次', fontproperties=font, fontsize=20)
     plt.ylabel('标签', fontproperties=font, fontsize=20)
-    plt.title('2021年08月 B站数码区视频标签词频统计前 30 名\n',
+    plt.title('{} B站数码区视频标签词频统计前 30 名\n'.format(period),
               fontproperties=font, fontsize=28)
-    plt.suptitle("2021.09.05 统计", x=0.75, y=0.88,
+    plt.suptitle(today + ' 统计', x=0.75, y=0.88,
                  fontproperties=font, fontsize=18)
     plt.tight_layout()
     plt.savefig('analysize/pic2-0.png')
 
 
-def pic3():
+def pic3(data, period, today):
     '''分析播放量与视频时长关系'''
 
     print('\npic3')
 
-    # 查询数据库
-    x = []
-    y = []
+    # 数据统计
     interval = 600
     N = 6
-    for i in trange(N):
-        y.append(cursor.execute('SELECT AVG(view) from VIDEO WHERE duration BETWEEN ? and ?',
-                 (interval * i, interval * (i + 1) - 1)).fetchone()[0])
-        x.append('{}~{} 分钟'.format(10 * i, 10 * (i + 1)))
+    y, _ = analytics.bucket_mean(data['view'], data['duration'], interval * np.arange(1, N + 1))
+    x = ['{}~{} 分钟'.format(10 * i, 10 * (i + 1)) for i in range(N)]
     x.append('{} 分钟以上'.format(10 * N))
-    y.append(cursor.execute(
-        'SELECT AVG(view) from VIDEO WHERE duration > ?', (interval * N,)).fetchone()[0])
 
     # 生成图表
     plt.figure(figsize=(16, 9))
@@ -181,13 +146,54 @@ def pic3():
     plt.yticks(fontsize=18)
     plt.xlabel('视频时长', fontproperties=font, fontsize=20)
     plt.ylabel('平均播放量 / 次', fontproperties=font, fontsize=20)
-    plt.title('2021年08月 B站数码区视频平均播放量随视频总时长的分布\n',
+    plt.title('{} B站数码区视频平均播放量随视频总时长的分布\n'.format(period),
               fontproperties=font, fontsize=28)
-    plt.suptitle("2021.09.05 统计", x=0.75, y=0.92,
+    plt.suptitle(today + ' 统计', x=0.75, y=0.92,
                  fontproperties=font, fontsize=18)
     plt.savefig('analysize/pic3.png')
 
 
-pic01()
-pic2()
-pic3()
+def main():
+    parser = argparse.ArgumentParser(description='生成数据分析图表')
+    parser.add_argument('--start', default='2021-08-01', help='统计的首日 (含), 格式 YYYY-MM-DD')
+    parser.add_argument('--end', default='2021-08-31', help='统计的末日 (含), 格式 YYYY-MM-DD')
+    parser.add_argument('--columns', action='store_true',
+                        help='从 export.py 导出的列式存储读取数据, 而非数据库')
+    args = parser.parse_args()
+
+    st = analytics.to_timestamp(args.start)
+    ed = analytics.to_timestamp(args.end) + 86400
+    # 整月时以月份为标题
+    if args.start.endswith('-01') and args.start[:7] == args.end[:7] \
+            and time.localtime(ed).tm_mday == 1:
+        period = time.strftime('%Y年%m月', time.localtime(st))
+    else:
+        period = '{} 至 {}'.format(args.start, args.end)
+    today = time.strftime('%Y.%m.%d')
+
+    # 一次读入所需的列
+    if args.columns:
+        data = analytics.load_columns(
+            'data/columns/VIDEO', ['pubdate', 'view', 'duration', 'keywords'], st, ed)
+        count = analytics.tag_frequency(data['keywords'])
+    else:
+        # 只读打开, 不建表也不迁移; 标签词频直接由标签倒排表统计,
+        # 数据库尚未由爬虫建立标签表时从 keywords 统计
+        db = database.Database(DB_NAME, readonly=True)
+        tags = db.has_table('META') and db.get_meta('tags_migrated') is not None
+        columns = ['pubdate', 'view', 'duration'] + ([] if tags else ['keywords'])
+        data = analytics.load(db.conn, columns, st, ed)
+        if tags:
+            count = Counter(dict(db.top_tags(st, ed)))
+        else:
+            count = analytics.tag_frequency(data['keywords'])
+        del db
+    print('视频数: {}'.format(len(data['pubdate'])))
+
+    pic01(data, period, today)
+    pic2(count, period, today)
+    pic3(data, period, today)
+
+
+if __name__ == '__main__':
+    main()
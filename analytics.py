@@ -0,0 +1,145 @@
+'''数据分析计算
+
+将 VIDEO 表中需要的列按发布时间范围分块读入 NumPy 数组, 再以向量化运算统计
+各时段分布 / 分桶平均值 / 标签词频, 避免按小时或分桶逐条查询数据库.
+
+Method:
+    to_timestamp:   将日期字符串转换成时间戳
+    load:           读取 VIDEO 表中的列
+    load_columns:   从列式导出中读取 VIDEO 表的列
+    hour_histogram: 按一天中的小时统计
+    bucket_mean:    分桶平均值
+    tag_frequency:  标签词频
+'''
+
+import time
+from collections import Counter
+
+import numpy as np
+
+import columnar
+import database
+
+# VIDEO 表中的文本列, 读入为 object 数组, 其余列均读入为 float64
+TEXT_COLUMNS = {'bvid', 'pic', 'title', 'desc', 'keywords'}
+
+
+def to_timestamp(date, fmt='%Y-%m-%d'):
+    '''将本地时间的日期字符串转换成时间戳'''
+    return int(time.mktime(time.strptime(date, fmt)))
+
+
+def load(conn, columns, start=None, end=None, chunk_size=65536):
+    '''分块读取 VIDEO 表中的列
+
+    conn:       数据库连接
+    columns:    列名列表
+    start:      发布时间下限 (含), 为 None 时不限制
+    end:        发布时间上限 (不含), 为 None 时不限制
+    chunk_size: 每次读取的行数
+    返回 {列名: 数组}, 数值列为 float64 (NULL 为 nan), 文本列 (TEXT_COLUMNS) 为 object
+    '''
+    # 按列名确定类型, 不随各块中的取值变化
+    dtypes = {name: object if name in TEXT_COLUMNS else np.float64 for name in columns}
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('pubdate >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('pubdate < ?')
+        params.append(end)
+    sql = 'SELECT {} FROM VIDEO'.format(', '.join(columns))
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+
+    chunks = {name: [] for name in columns}
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for name, values in zip(columns, zip(*rows)):
+            chunks[name].append(np.array(values, dtype=dtypes[name]))
+    return {name: np.concatenate(data) if data else np.empty(0, dtypes[name])
+            for name, data in chunks.items()}
+
+
+def load_columns(root, columns, start=None, end=None):
+    '''从 export.py 导出的列式存储中读取 VIDEO 表的列, 只访问需要的列
+
+    root:       VIDEO 表的列式存储目录
+    columns:    列名列表
+    start:      发布时间下限 (含), 为 None 时不限制
+    end:        发布时间上限 (不含), 为 None 时不限制
+    返回与 load 相同格式的 {列名: 数组}, 重复导出的视频只保留最后一次
+    '''
+    table = columnar.Table(root)
+    index = table.latest('aid')
+    pubdate = np.asarray(table.column('pubdate'))[index]
+    mask = np.ones(len(index), dtype=bool)
+    if start is not None:
+        mask &= pubdate >= start
+    if end is not None:
+        mask &= pubdate < end
+    index = index[mask]
+
+    result = {}
+    for name in columns:
+        type = table.columns[name]['type']
+        if type == 'string':
+            result[name] = table.column(name).take(index)
+        elif type == 'dict':
+            result[name] = table.decode(name, np.asarray(table.column(name))[index])
+        else:
+            values = np.asarray(table.column(name))[index]
+            result[name] = np.where(values == columnar.null_value(type), np.nan, values)
+    return result
+
+
+def hour_histogram(pubdate, weights=None, utc_offset=None):
+    '''按发布时间在一天中的小时统计
+
+    pubdate:    发布时间戳数组
+    weights:    各视频的权重, 为 None 时统计数量
+    utc_offset: 时区偏移 (秒), 为 None 时使用本地时区
+    返回长度为 24 的数组
+    '''
+    if utc_offset is None:
+        utc_offset = time.localtime().tm_gmtoff
+    valid = ~np.isnan(pubdate)
+    hours = ((pubdate[valid].astype(np.int64) + utc_offset) // 3600) % 24
+    if weights is not None:
+        weights = np.nan_to_num(weights[valid])
+    return np.bincount(hours, weights, minlength=24)
+
+
+def bucket_mean(values, keys, edges):
+    '''按 keys 所在区间分桶, 计算各桶中 values 的平均值
+
+    values: 数值数组, nan 不计入
+    keys:   分桶依据数组, nan 不计入
+    edges:  升序的区间分界, 得到 len(edges) + 1 个桶: (-inf, edges[0]), ..., [edges[-1], inf)
+    返回 (各桶平均值, 各桶数量), 空桶的平均值为 nan
+    '''
+    valid = ~np.isnan(values) & ~np.isnan(keys)
+    index = np.digitize(keys[valid], edges)
+    sums = np.bincount(index, values[valid], minlength=len(edges) + 1)
+    counts = np.bincount(index, minlength=len(edges) + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts, counts
+
+
+def tag_frequency(keywords, exclude=()):
+    '''统计标签词频
+
+    keywords:   各视频以逗号分隔的标签字符串, 与标签倒排表一样按 Database.split_tags 拆分
+    exclude:    不统计的标签
+    返回 Counter
+    '''
+    count = Counter()
+    for text in keywords:
+        count.update(database.Database.split_tags(text))
+    for name in exclude:
+        count.pop(name, None)
+    return count
@@ -0,0 +1,120 @@
+'''原始响应存档
+
+将请求得到的原始响应以 (地址, 获取时间, zlib 压缩内容) 的记录追加写入
+data/archive/ 下的分段文件, 页面结构变化或需要新字段时可由 replay.py 离线重新解析,
+无需重新爬取.
+
+每个分段文件只由一个进程写入, 启动时与写满 segment_size 字节后新开一段.
+写入中断的不完整记录在读取时忽略.
+
+Class:
+    ResponseArchive:    响应存档
+
+Method:
+    segments:           已有的分段文件列表
+    read_segment:       依次读取分段文件中的记录
+'''
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'ARC1'
+# 标识, 获取时间, 地址长度, 压缩内容长度
+HEADER = struct.Struct('<4sdII')
+
+
+def segments(root='data/archive'):
+    '''已有的分段文件路径列表, 按序号排列
+
+    root:   存档目录
+    '''
+    if not os.path.exists(root):
+        return []
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if name.endswith('.arc')]
+
+
+def read_segment(path):
+    '''依次读取分段文件中的记录
+
+    path:   分段文件路径
+    生成 (地址, 获取时间, 响应内容)
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        magic, fetched, url_size, size = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + url_size + size
+        if magic != MAGIC or end > len(data):
+            break
+        url = data[offset + HEADER.size:offset + HEADER.size + url_size].decode('utf-8')
+        try:
+            body = zlib.decompress(data[end - size:end])
+        except zlib.error:
+            break
+        yield url, fetched, body
+        offset = end
+
+
+class ResponseArchive:
+    '''响应存档, 线程安全
+
+    root:           存档目录
+    segment_size:   单个分段文件大小上限 (字节)
+    images:         是否保存图片响应
+    level:          zlib 压缩等级
+    '''
+
+    def __init__(self, root='data/archive', segment_size=64 * 1024 * 1024, images=False, level=6):
+        self.root = root
+        self.segment_size = segment_size
+        self.images = images
+        self.level = level
+        self.lock = threading.Lock()
+        self.file = None
+        os.makedirs(root, exist_ok=True)
+        self.open_segment()
+
+    def open_segment(self):
+        '''新开一个分段文件, 以独占方式创建, 多个进程可共用存档目录'''
+        if self.file is not None:
+            self.file.close()
+        paths = segments(self.root)
+        number = int(os.path.basename(paths[-1]).split('.')[0]) + 1 if paths else 0
+        while True:
+            path = os.path.join(self.root, '{:06d}.arc'.format(number))
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except FileExistsError:
+                number += 1
+        self.file = os.fdopen(fd, 'wb')
+
+    def record(self, url, content, content_type=None):
+        '''追加一条响应记录
+
+        url:            完整请求地址 (含参数)
+        content:        响应内容
+        content_type:   响应的 Content-Type, 用于跳过图片
+        '''
+        if not self.images and content_type and content_type.startswith('image/'):
+            return
+        data = zlib.compress(content, self.level)
+        url = url.encode('utf-8')
+        with self.lock:
+            if self.file is None:
+                return
+            if self.file.tell() and self.file.tell() + len(data) > self.segment_size:
+                self.open_segment()
+            self.file.write(HEADER.pack(MAGIC, time.time(), len(url), len(data)) + url + data)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
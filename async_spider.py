@@ -0,0 +1,561 @@
+'''asyncio 爬取引擎
+
+在单个事件循环中以协程运行 视频列表 / 视频 / 评论 / 图片 各阶段,
+各阶段并发数单独配置. 数据库结构与进度恢复方式与线程引擎一致,
+各阶段任务写入任务表后, 在队列不足一半时分批从任务表领取, 内存中只保留有限的任务.
+数据库读写在单独的线程中依次执行, 不阻塞事件循环.
+
+Class:
+    AsyncSpider:    协程爬虫
+'''
+
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import aiohttp
+
+import tools
+import database
+import dedup
+import extractor
+import image_check
+import image_store
+import proxy_manager
+import scheduler
+from metrics import SpiderMetrics
+
+
+class AsyncSpider:
+    '''协程爬虫
+
+    api_url:        API 域名
+    video_url:      视频域名
+    db_name:        数据库名称
+    regions:        各分区列表进度 scheduler.RegionProgress
+    limit:          尝试获取视频数量上限
+    wl_max:         视频列表缓冲区大小
+    concurrency:    各阶段并发数, 形如 {'video': 100, 'comment': 100, 'pic': 150}
+    proxies:        本地代理缓存 proxy_manager.ProxyManager, 为空则不使用代理
+    allow_fallback: 是否允许代理获取失败时不使用代理
+    list_rate:      每秒最多请求的视频列表页数, 不大于 0 时不限速
+    keep_alive:     是否保持连接
+    idle_timeout:   空闲连接保持时间 (秒)
+    images:         已载入索引的图片存储, 为空则使用 image_store.ImageStore
+    verifier:       图片完整校验进程池 image_check.ImageVerifier, 为空则不进行完整校验
+    comments:       评论分页进度 scheduler.CommentProgress, 为空则每个视频只获取第一页
+    comment_mode:   评论排序方式, 3 为按热度, 2 为按时间
+    metrics:        运行指标 metrics.SpiderMetrics, 为空则只在内部记录
+    archive:        原始响应存档 archive.ResponseArchive, 为空则不存档
+    seen:           已知的视频与用户 dedup.Seen, 为空则只对本次运行中的编号去重
+    claim_batch:    图片与评论队列中任务不足一半时, 从任务表补充至该数量
+    flush_interval: 提交数据库的间隔 (秒), 写入的数据最迟在该时间后可见
+    '''
+
+    def __init__(self, api_url, video_url, db_name, regions, limit, wl_max,
+                 concurrency, proxies=None, allow_fallback=False,
+                 list_rate=1, keep_alive=True, idle_timeout=60, images=None,
+                 verifier=None, comments=None, comment_mode=3, metrics=None,
+                 archive=None, seen=None, claim_batch=1000, flush_interval=1):
+        self.list_url = api_url + 'web-interface/newlist'
+        self.comment_url = api_url + 'v2/reply/main'
+        self.video_url = video_url
+        self.db_name = db_name
+        self.regions = regions
+        self.limit = limit
+        self.wl_max = wl_max
+        self.concurrency = concurrency
+        self.proxies = proxies
+        self.allow_fallback = allow_fallback
+        self.list_interval = 1 / list_rate if list_rate > 0 else 0
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.images = images
+        self.verifier = verifier
+        self.comments = comments or scheduler.CommentProgress(1)
+        self.comment_mode = comment_mode
+        self.metrics = metrics or SpiderMetrics()
+        self.archive = archive
+        self.seen = seen or dedup.Seen()
+        self.claim_batch = claim_batch
+        self.flush_interval = flush_interval
+        self.stopping = False
+
+    def run(self):
+        '''运行至全部任务完成或被 Ctrl + C 中断'''
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            logging.warning('开始退出...')
+
+    def run_db(self, func, *args):
+        '''在数据库线程中执行 func(*args), 返回可等待的结果'''
+        return asyncio.get_running_loop().run_in_executor(self.db_executor, func, *args)
+
+    def close_db(self):
+        '''在数据库线程中提交并关闭数据库'''
+        del self.db
+
+    async def main(self):
+        # 数据库连接只在该线程中创建与使用
+        self.db_executor = ThreadPoolExecutor(1)
+        self.db = await self.run_db(database.Database, self.db_name)
+        # 任务队列本身不限长, 失败任务可直接放回; 由 slots 限制列表缓冲区大小
+        self.task_queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.wl_max)
+        self.comment_queue = asyncio.Queue()
+        # 图片任务按 (优先级, 序号, 数据) 排序, 视频封面优先于用户头像
+        self.pic_queue = asyncio.PriorityQueue()
+        self.pic_seq = 0
+        self.queues = {'video': self.task_queue, 'video_pic': self.pic_queue,
+                       'user_pic': self.pic_queue, 'comment': self.comment_queue}
+        # 各阶段正在处理的任务数
+        self.busy = 0
+        if self.images is None:
+            self.images = image_store.ImageStore()
+            self.images.load(await self.run_db(self.db.get_images))
+        # 正在下载的图片地址 -> Future, 同一地址只下载一次
+        self.image_inflight = {}
+        self.metrics.queue_depth.collect = lambda: {
+            'video': self.task_queue.qsize(), 'comment': self.comment_queue.qsize(),
+            'pic': self.pic_queue.qsize()}
+
+        if self.keep_alive:
+            connector = aiohttp.TCPConnector(
+                limit=0, ttl_dns_cache=300, keepalive_timeout=self.idle_timeout)
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=0, ttl_dns_cache=300, force_close=True)
+        workers = []
+        try:
+            # 与线程引擎一致, 不保存服务器下发的 Cookie
+            async with aiohttp.ClientSession(connector=connector,
+                                             cookie_jar=aiohttp.DummyCookieJar()) as self.session:
+
+                list_worker = asyncio.create_task(self.list_work())
+                refill_worker = asyncio.create_task(self.refill_work(list_worker))
+                workers.append(refill_worker)
+                workers.append(asyncio.create_task(self.status_work()))
+                workers.append(asyncio.create_task(self.flush_work()))
+                for i in range(self.concurrency['video']):
+                    workers.append(asyncio.create_task(self.video_work()))
+                for i in range(self.concurrency['comment']):
+                    workers.append(asyncio.create_task(self.comment_work()))
+                for i in range(self.concurrency['pic']):
+                    workers.append(asyncio.create_task(self.pic_work()))
+
+                # 列表获取结束且各阶段任务与任务表中的待处理任务全部完成时, refill_work 返回
+                await list_worker
+                await refill_worker
+                logging.warning('爬虫任务结束, 准备退出.')
+        finally:
+            self.stopping = True
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.run_db(self.close_db)
+            self.db_executor.shutdown()
+            logging.warning('退出完成.')
+
+    async def put_tasks(self, type, tasks):
+        '''将从任务表领取的任务放入对应队列, 视频任务等待列表缓冲区空位
+
+        type:   任务类型
+        tasks:  (key, payload) 列表
+        '''
+        for key, payload in tasks:
+            if type == 'video':
+                bvid, cid = json.loads(payload)
+                await self.slots.acquire()
+                self.task_queue.put_nowait((key, bvid, cid, None))
+            elif type == 'comment':
+                self.comment_queue.put_nowait(scheduler.CommentTask(key))
+            else:
+                self.put_pic(0 if type == 'video_pic' else 1, (key, payload))
+
+    async def refill(self, types):
+        '''队列中任务不足 claim_batch 的一半时从任务表领取补充, 返回领取的任务数
+
+        types:  任务类型
+        '''
+        count = 0
+        for type in types:
+            size = self.queues[type].qsize()
+            if size * 2 >= self.claim_batch:
+                continue
+            tasks = await self.run_db(self.db.claim_tasks, type, self.claim_batch - size)
+            await self.put_tasks(type, tasks)
+            count += len(tasks)
+        return count
+
+    async def refill_work(self, list_worker, interval=0.2):
+        '''定期补充图片与评论任务; 列表获取结束后也补充视频任务,
+        各阶段没有排队与处理中的任务且任务表中没有待处理任务时返回
+
+        list_worker:    视频列表协程
+        interval:       补充间隔 (秒)
+        '''
+        while True:
+            if not list_worker.done():
+                await self.refill(('video_pic', 'user_pic', 'comment'))
+            elif not await self.refill(scheduler.TASK_TYPES) and self.busy == 0 and \
+                    not any(queue.qsize() for queue in self.queues.values()) and \
+                    not await self.run_db(self.db.has_pending_tasks):
+                return
+            await asyncio.sleep(interval)
+
+    async def flush_work(self):
+        '''定期提交数据库, 与线程引擎的 SpiderDB 一样使写入在 flush_interval 内可见,
+        export.py 按 spider 时间增量导出时不会遗漏提交较晚的行'''
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.run_db(self.db.conn.commit)
+
+    def put_pic(self, priority, data):
+        self.pic_seq += 1
+        self.pic_queue.put_nowait((priority, self.pic_seq, data))
+
+    async def lease_proxy(self):
+        '''从本地代理缓存借用代理, 缓存为空时按配置等待或不使用代理'''
+        proxy = self.proxies.lease(timeout=0)
+        while (not self.allow_fallback) and (not proxy) and (not self.stopping):
+            logging.warning('获取代理失败. 重试.')
+            await asyncio.sleep(1)
+            proxy = self.proxies.lease(timeout=0)
+        if not proxy:
+            logging.warning('获取代理失败. 不使用代理.')
+        return proxy
+
+    async def GET(self, url, params={}, use_proxy=True, retry_time=3):
+        ''' 带有重试与代理的 GET 方法, 返回响应体
+
+        url:        请求 URL
+        params:     请求参数
+        use_proxy:  是否使用代理
+        retry_time: 重试次数上限
+        '''
+        while retry_time > 0:
+            proxy = None
+            if use_proxy and self.proxies:
+                proxy = await self.lease_proxy()
+            st = time.time()
+            try:
+                headers = {
+                    'User-Agent': tools.get_UA(),
+                    'X-Forwarded-For': tools.get_IP()
+                }
+                async with self.session.get(url, params=params, headers=headers,
+                                            proxy='http://{}'.format(proxy) if proxy else None,
+                                            timeout=aiohttp.ClientTimeout(total=3)) as res:
+                    self.metrics.http_responses.inc(status=res.status)
+                    res.raise_for_status()
+                    body = await res.read()
+
+                    # 验证请求完整性
+                    if (res.content_length is not None) and (len(body) != res.content_length):
+                        logging.warning('{} 获取信息不完整. 重试.'.format(url))
+                        raise aiohttp.ClientPayloadError('获取信息不完整')
+                    if self.archive is not None:
+                        self.archive.record(str(res.url), body, res.content_type)
+                if proxy:
+                    self.proxies.report(proxy, True, time.time() - st)
+                return body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if not isinstance(error, aiohttp.ClientResponseError):
+                    self.metrics.http_errors.inc(error=type(error).__name__)
+                # 只有连接错误、超时与限流计为代理失败, 目标内容不存在等状态码说明代理可用
+                if proxy and isinstance(error, aiohttp.ClientResponseError) and \
+                        error.status not in proxy_manager.THROTTLE_STATUS:
+                    self.proxies.report(proxy, True, time.time() - st)
+                elif proxy:
+                    self.metrics.proxy_errors.inc(proxy=proxy)
+                    self.proxies.report(proxy, False)
+                retry_time -= 1
+                if retry_time == 0:
+                    raise
+                logging.debug('GET失败. 重试.(剩余:{} 次)'.format(retry_time))
+                await asyncio.sleep(1)
+
+    async def list_work(self):
+        '''按页获取视频列表, 放入任务队列'''
+        # 根据任务表分批恢复未完成的视频任务, 每批不超过列表缓冲区大小
+        while True:
+            tasks = await self.run_db(self.db.claim_tasks, 'video', self.wl_max)
+            if not tasks:
+                break
+            await self.put_tasks('video', tasks)
+
+        for rid, pn in self.regions.pages().items():
+            logging.warning('恢复进度. 分区 {} 第 {} 页'.format(rid, pn))
+        while True:
+            if self.limit <= 0:
+                logging.warning('任务队列视频数已达上限, 停止获取列表.')
+                break
+            page = self.regions.claim()
+            if page is None:
+                logging.warning('已将所有分区的视频载入列表, 停止获取列表.')
+                break
+            rid, pn = page
+            params = {
+                'rid': rid,
+                'pn': pn,
+                'ps': 50
+            }
+            archives = None
+            while archives is None:
+                try:
+                    with self.metrics.stage('list'):
+                        data = json.loads(await self.GET(self.list_url, params, False))
+                        archives = data['data']['archives']
+                    logging.info('获取分区 {} 视频列表第 {} 页成功.'.format(rid, pn))
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError):
+                    logging.debug('获取分区 {} 视频列表第 {} 页失败. 重试.'.format(rid, pn))
+                    await asyncio.sleep(1)
+
+            if not archives:
+                self.regions.done(rid, 0, True)
+                logging.warning('已将分区 {} 下所有视频载入列表.'.format(rid))
+                continue
+
+            # 跳过已知的视频; 当前页的任务先写入任务表并记录进度, 再放入任务队列
+            count = len(archives)
+            archives = [video for video in archives if video['aid'] not in self.seen.videos]
+            if len(archives) < count:
+                self.metrics.duplicates.inc(count - len(archives), kind='video')
+            archives = archives[:min(len(archives), self.limit, self.regions.remaining(rid))]
+            for video in archives:
+                self.seen.videos.add(video['aid'])
+            self.regions.done(rid, len(archives), False)
+            await self.run_db(self.add_page, rid, pn, archives)
+            for video in archives:
+                await self.slots.acquire()
+                self.task_queue.put_nowait((video['aid'], video['bvid'], video['cid'], pn))
+                self.limit -= 1
+
+            await asyncio.sleep(self.list_interval)
+
+    def add_page(self, rid, pn, archives):
+        '''将一页列表中的视频记入任务表并记录该分区的进度
+
+        rid:        分区 rid
+        pn:         页码
+        archives:   该页中待爬取的视频
+        '''
+        with self.db.transaction():
+            self.db.add_tasks('video', [(video['aid'], [video['bvid'], video['cid']])
+                                        for video in archives], database.CLAIMED)
+            self.db.update_region(rid, pn + 1, len(archives))
+
+    def add_replies(self, replies):
+        '''写入一页评论并适时提交'''
+        self.db.insert_replies(replies)
+        self.db.update_db()
+
+    async def video_work(self):
+        '''请求视频页面，获取视频和作者信息'''
+        while True:
+            target = await self.task_queue.get()
+            self.busy += 1
+            retry = False
+            try:
+                video_data = {}
+                video_data['aid'] = target[0]
+                video_data['bvid'] = target[1]
+                video_data['cid'] = target[2]
+                video_data['url'] = '{}{}'.format(self.video_url, target[1])
+
+                with self.metrics.stage('video'):
+                    content = await self.GET(video_data['url'], {})
+
+                with self.metrics.stage('parse'):
+                    parsed = extractor.parse_video(content, video_data)
+
+                if parsed is None:
+                    logging.warning('视频 {} 已被删除, 跳过!'.format(target[0]))
+                    await self.run_db(self.db.finish_tasks, 'video', [target[0]])
+                    continue
+                video_data, user_data = parsed
+
+                # 写入时向任务表添加封面与评论任务, 由 refill_work 领取
+                await self.run_db(self.db.insert_video, video_data)
+                self.metrics.results.inc(kind='video')
+                # 同一用户只写入一次并添加一次头像任务
+                if self.seen.users.add(user_data['mid']):
+                    await self.run_db(self.db.insert_user, user_data)
+                    self.metrics.results.inc(kind='user')
+                else:
+                    self.metrics.duplicates.inc(kind='user')
+
+                logging.info('获取视频 {} 成功.'.format(target[0]))
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logging.debug('获取视频 {} 失败. 网络错误. 重试.'.format(target[0]))
+                retry = True
+            except AttributeError:
+                logging.warning('获取视频 {} 失败. 格式错误. 重试.'.format(target[0]))
+                retry = True
+            except asyncio.CancelledError:
+                raise
+            except:
+                logging.error('获取视频 {} 失败. 未知错误. 退出.'.format(target[0]))
+                retry = True
+                raise
+            finally:
+                # 失败任务放回队列, 仍占用缓冲区位置
+                if retry:
+                    self.task_queue.put_nowait(target)
+                else:
+                    self.slots.release()
+                self.busy -= 1
+                self.task_queue.task_done()
+
+    async def comment_work(self):
+        '''获取视频的一页评论, 并按分页进度放入后续页的任务'''
+        while True:
+            task = await self.comment_queue.get()
+            self.busy += 1
+            try:
+                params = {
+                    'oid': task.oid,
+                    'next': task.cursor,
+                    'type': 1,
+                    'mode': self.comment_mode
+                }
+                with self.metrics.stage('comment'):
+                    json_data = json.loads(await self.GET(self.comment_url, params=params))
+                replies = []
+                is_end = True
+                cursor = None
+                try:
+                    replies = json_data['data']['replies'] or []
+                    is_end = json_data['data']['cursor']['is_end'] or not replies
+                    cursor = json_data['data']['cursor'].get('next')
+                except:
+                    logging.warning('{} 评论格式出错. 跳过.'.format(task.oid))
+
+                if replies:
+                    await self.run_db(self.add_replies, replies)
+                    self.metrics.results.inc(len(replies), kind='reply')
+                # 下一页的请求参数由本页响应中的游标给出
+                next_task, first = self.comments.done(
+                    task, [data['content']['message'] for data in replies], is_end, cursor)
+                if next_task is not None:
+                    self.comment_queue.put_nowait(next_task)
+                if first is not None:
+                    await self.run_db(self.db.insert_comment, {
+                        'oid': task.oid,
+                        'data': json.dumps(first, ensure_ascii=False)
+                    })
+                    self.metrics.results.inc(kind='comment')
+                    logging.info('获取评论 {} 成功.'.format(task.oid))
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                logging.debug('获取评论失败. 网络错误. 重试.')
+                self.comment_queue.put_nowait(task)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 协程退出会使并发数永久减少, 未知错误时记录并重试
+                logging.error('获取评论 {} 失败. 未知错误 {!r}. 重试.'.format(task.oid, e))
+                self.comment_queue.put_nowait(task)
+            finally:
+                self.busy -= 1
+                self.comment_queue.task_done()
+
+    async def pic_work(self):
+        '''获取视频封面与用户头像'''
+        while True:
+            priority, seq, data = await self.pic_queue.get()
+            self.busy += 1
+            pic_type = '视频' if priority == 0 else '用户'
+            try:
+                digest = await self.fetch_image(data[1], pic_type, data[0])
+                folder = 'video_pic' if priority == 0 else 'user_face'
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.images.link, folder, data[0], data[1], digest)
+                if priority == 0:
+                    await self.run_db(self.db.update_video_pic, data[0])
+                else:
+                    await self.run_db(self.db.update_user_pic, data[0])
+                self.metrics.results.inc(kind='video_pic' if priority == 0 else 'user_pic')
+
+                logging.info('获取图片 {} {} 成功.'.format(pic_type, data[0]))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logging.debug(
+                    '获取图片 {} {} 失败. 网络错误. 重试.'.format(pic_type, data[0]))
+                self.put_pic(priority, data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error('获取图片 {} {} 失败. 未知错误 {!r}. 重试.'.format(pic_type, data[0], e))
+                self.put_pic(priority, data)
+            finally:
+                self.busy -= 1
+                self.pic_queue.task_done()
+
+    async def fetch_image(self, url, pic_type, id):
+        '''获取图片内容哈希, 已下载过的地址不再请求, 同一地址的并发请求只下载一次
+
+        url:        图片地址
+        pic_type:   视频 / 用户, 用于输出日志
+        id:         视频 aid 或用户 mid, 用于输出日志
+        '''
+        while True:
+            digest = self.images.lookup(url)
+            if digest is not None:
+                return digest
+            future = self.image_inflight.get(url)
+            if future is None:
+                break
+            # 其他协程正在下载, 等待其完成后重新查询, 失败时由本协程接手
+            await asyncio.wait([future])
+
+        future = self.image_inflight[url] = asyncio.get_running_loop().create_future()
+        try:
+            with self.metrics.stage('image'):
+                content = await self.GET(url)
+                if image_check.quick_check(content) is False:
+                    meg = '{} {} 图片不完整. 重试.'.format(pic_type, id)
+                    logging.warning(meg)
+                    raise aiohttp.ClientPayloadError(meg)
+            with self.metrics.stage('verify'):
+                if not await self.verify(content):
+                    meg = '{} {} 图片校验失败. 重试.'.format(pic_type, id)
+                    logging.warning(meg)
+                    raise aiohttp.ClientPayloadError(meg)
+            # 写入图片文件不阻塞事件循环
+            digest = await asyncio.get_running_loop().run_in_executor(
+                None, self.images.put, url, content)
+            await self.run_db(self.db.insert_image, url, digest)
+            return digest
+        finally:
+            del self.image_inflight[url]
+            future.set_result(None)
+
+    async def verify(self, content):
+        '''在进程池中完整校验图片, 不阻塞事件循环'''
+        if self.verifier is None or self.verifier.pool is None:
+            return True
+        loop = asyncio.get_running_loop()
+        if not self.verifier.broken:
+            try:
+                return await loop.run_in_executor(
+                    self.verifier.pool, image_check.full_check, content)
+            except BrokenProcessPool:
+                self.verifier.set_broken()
+        # 进程池不可用时在线程中校验
+        return await loop.run_in_executor(None, image_check.full_check, content)
+
+    async def status_work(self):
+        '''每隔十秒输出进度信息'''
+        while True:
+            msg = '-' * 20 + '\n' +\
+                '未入队视频数:   {}\n' + \
+                '排队视频数:     {}\n' + \
+                '排队图片数:     {}\n' + \
+                '排队评论数:     {}\n' + '-' * 20 + '\n'
+            print(msg.format(self.limit, self.task_queue.qsize(),
+                             self.pic_queue.qsize(), self.comment_queue.qsize()))
+            await asyncio.sleep(10)
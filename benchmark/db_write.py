@@ -0,0 +1,84 @@
+'''数据库写入吞吐量测试
+
+生成合成视频与用户数据, 对比逐条写入 (原 SpiderDB 写法, 每 100 条提交一次)
+与按批事务写入 (WAL + executemany) 的每秒写入行数. 在临时目录中运行:
+
+    python -m benchmark.db_write --videos 1000000 --batch 500
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import database
+
+
+def make_video(aid):
+    return {
+        'aid': aid, 'bvid': 'BV{:010d}'.format(aid), 'cid': aid * 10,
+        'pic': 'http://i0.hdslb.com/bfs/archive/{}.jpg'.format(aid),
+        'title': '测试视频 {}'.format(aid), 'desc': '视频简介 {}'.format(aid),
+        'keywords': '测试,数码,标签{}'.format(aid % 20), 'copyright': 1,
+        'duration': aid % 3600, 'videos': 1, 'pubdate': 1627747200 + aid % 2678400,
+        'stat': {'view': aid % 100000, 'danmaku': aid % 100, 'like': aid % 1000, 'coin': aid % 200,
+                 'favorite': aid % 300, 'share': aid % 40, 'reply': aid % 50},
+        'owner': {'mid': aid % 50000}, 'pn': aid // 50 + 1
+    }
+
+
+def make_user(mid):
+    return {
+        'mid': mid, 'name': '用户{}'.format(mid), 'sex': '保密',
+        'face': 'http://i0.hdslb.com/bfs/face/{}.jpg'.format(mid), 'sign': '签名',
+        'level_info': {'current_level': mid % 7}, 'attention': mid % 500, 'fans': mid % 10000
+    }
+
+
+def single(name, videos):
+    '''逐条写入, 每条视频伴随一次进度更新与一次用户写入'''
+    db = database.Database(name, wal=False, synchronous='FULL')
+    for aid in range(1, videos + 1):
+        db.insert_video(make_video(aid))
+        db.update_temp_pn(aid // 50 + 1)
+        db.insert_user(make_user(aid % 50000))
+    del db
+
+
+def batched(name, videos, batch_size):
+    '''按批在事务中写入'''
+    db = database.Database(name)
+    for st in range(1, videos + 1, batch_size):
+        aids = range(st, min(st + batch_size, videos + 1))
+        video_batch = [make_video(aid) for aid in aids]
+        with db.transaction():
+            db.insert_videos(video_batch)
+            db.update_temp_pn(video_batch[-1]['pn'])
+            db.insert_users([make_user(aid % 50000) for aid in aids])
+    del db
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库写入吞吐量测试')
+    parser.add_argument('--videos', type=int, default=1000000, help='合成视频数')
+    parser.add_argument('--batch', type=int, default=500, help='批量写入大小')
+    parser.add_argument('--single-videos', type=int, default=None,
+                        help='逐条写入的视频数, 默认与 --videos 相同')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        # 每个视频对应视频, 进度, 用户三行写入
+        for mode, videos, func in (('single', args.single_videos or args.videos,
+                                    lambda n: single('single', n)),
+                                   ('batched', args.videos,
+                                    lambda n: batched('batched', n, args.batch))):
+            st = time.time()
+            func(videos)
+            elapsed = time.time() - st
+            print('{:<8} videos: {:>8}  elapsed: {:>8.2f}s  rows/s: {:>10.0f}'.format(
+                mode, videos, elapsed, videos * 3 / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''爬取引擎吞吐量对比
+
+在本地模拟服务器上分别以 thread 与 asyncio 引擎完成相同的爬取任务, 输出耗时与吞吐量.
+每个引擎在独立子进程与临时目录中运行, 需在仓库根目录执行:
+
+    python -m benchmark.engine --videos 2000 --latency 0.05 --threads 100 --concurrency 1000
+'''
+
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.mock_server import MockBilibili, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(args):
+    '''子进程: 配置 spider 指向模拟服务器并运行一次完整爬取'''
+    import logging
+    os.chdir(ROOT)
+    import spider
+    logging.getLogger().setLevel(logging.WARNING)
+
+    spider.API_URL = args.base_url + 'x/'
+    spider.VIDEO_URL = args.base_url + 'video/'
+    spider.USE_PROXY = False
+    spider.PROXY_URL = ''
+    spider.DB_NAME = 'bench'
+    spider.ST_PN = 1
+    spider.RIDS = {rid: 1 for rid in range(1, args.regions + 1)}
+    spider.VIDEO_NUM = args.videos
+    spider.THREADS = args.threads
+    spider.WL_MAX = max(args.threads, args.concurrency) * 2
+    spider.WORKERS = args.threads * 3 + args.threads // 2
+    spider.SCHEDULER.capacity['video'] = spider.WL_MAX
+    spider.LIST_RATE = 0
+    spider.LIST_WINDOW = 4
+    spider.ENGINE = args.child
+    spider.IMAGE_BACKEND = args.image_backend
+    spider.ASYNC_CONCURRENCY = {
+        'video': args.concurrency,
+        'comment': args.concurrency,
+        'pic': args.concurrency + args.concurrency // 2
+    }
+
+    os.chdir(args.workdir)
+    st = time.time()
+    spider.main()
+    elapsed = time.time() - st
+
+    conn = sqlite3.connect('data/bench.sqlite3')
+    result = {
+        'engine': args.child,
+        'elapsed': elapsed,
+        'videos': conn.execute('SELECT COUNT() FROM VIDEO').fetchone()[0],
+        'users': conn.execute('SELECT COUNT() FROM USER').fetchone()[0],
+        'comments': conn.execute('SELECT COUNT() FROM COMMENT').fetchone()[0],
+        'replies': conn.execute('SELECT COUNT() FROM REPLY').fetchone()[0],
+        'pics': conn.execute('SELECT COUNT() FROM VIDEO WHERE localpic = 1').fetchone()[0] +
+        conn.execute('SELECT COUNT() FROM USER WHERE localpic = 1').fetchone()[0],
+        # 最后一条记录写入时间, 不含退出时关闭线程与进程池的时间
+        'last_write': max(conn.execute('SELECT MAX(spider) FROM VIDEO').fetchone()[0] or 0,
+                          conn.execute('SELECT MAX(spider) FROM COMMENT').fetchone()[0] or 0) - st
+    }
+    conn.close()
+    print(json.dumps(result))
+
+
+def run(engine, base_url, args):
+    '''启动子进程运行指定引擎并返回结果, 含子进程 (及其校验进程) 的 CPU 时间与峰值内存'''
+    with tempfile.TemporaryDirectory() as workdir:
+        cmd = [sys.executable, '-m', 'benchmark.engine', '--child', engine,
+               '--base-url', base_url, '--workdir', workdir,
+               '--videos', str(args.videos), '--threads', str(args.threads),
+               '--concurrency', str(args.concurrency), '--image-backend', args.image_backend,
+               '--regions', str(args.regions)]
+        proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE)
+        out = proc.stdout.read()
+        proc.stdout.close()
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        if status != 0:
+            raise subprocess.CalledProcessError(status, cmd)
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        result['cpu'] = usage.ru_utime + usage.ru_stime
+        # Linux 下 ru_maxrss 单位为 KB
+        result['rss'] = usage.ru_maxrss * 1024
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='爬取引擎吞吐量对比')
+    parser.add_argument('--videos', type=int, default=2000, help='爬取视频数')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟服务器延迟 (秒)')
+    parser.add_argument('--threads', type=int, default=100, help='thread 引擎线程数')
+    parser.add_argument('--concurrency', type=int, default=1000, help='asyncio 引擎各阶段并发数')
+    parser.add_argument('--engines', default='thread,asyncio')
+    parser.add_argument('--image-backend', default='file', help='图片存储方式 file / pack')
+    parser.add_argument('--regions', type=int, default=1, help='分区数, 视频平均分到各分区')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    mock = MockBilibili(args.videos, latency=args.latency, regions=args.regions)
+    server = serve(mock)
+    print('模拟服务器: {} 视频数: {} 延迟: {}s'.format(mock.base_url, args.videos, args.latency))
+    print('{:<8} {:>10} {:>10} {:>10} {:>12} {:>8}'.format(
+        'engine', 'elapsed/s', 'write/s', 'videos', 'videos/s', 'pics'))
+    for engine in args.engines.split(','):
+        result = run(engine, mock.base_url, args)
+        print('{:<8} {:>10.2f} {:>10.2f} {:>10} {:>12.1f} {:>8}'.format(
+            engine, result['elapsed'], result['last_write'], result['videos'],
+            result['videos'] / max(result['last_write'], 1), result['pics']))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
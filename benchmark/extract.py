@@ -0,0 +1,69 @@
+'''视频页面解析速度测试
+
+对比 正则 + BeautifulSoup 完整解析与 extractor 快速路径的每秒解析页面数.
+可传入保存的视频页面文件, 否则使用模拟服务器生成并填充至接近真实大小的页面:
+
+    python -m benchmark.extract data/pages/*.html --repeat 20
+'''
+
+import argparse
+import time
+
+import extractor
+from benchmark.mock_server import MockBilibili
+
+
+def synthetic_pages(num, padding):
+    '''生成模拟页面, 在 <head> 与 <body> 中填充无关标签与脚本'''
+    mock = MockBilibili(num)
+    head = ''.join('<link rel="stylesheet" href="//s1.hdslb.com/bfs/static/{}.css">'
+                   '<meta property="og:{}" content="填充 {}">'.format(i, i, i) for i in range(padding))
+    body = ''.join('<div class="item-{}"><span>填充内容 {}</span></div>'.format(i, i)
+                   for i in range(padding * 20))
+    pages = []
+    for index in range(num):
+        page = mock.video_page(mock.bvid(mock.aid(index)))
+        page = page.replace('</head>', head + '</head>').replace(
+            '<div id="app"></div>', '<div id="app">' + body + '</div>')
+        pages.append(page.encode('utf-8'))
+    return pages
+
+
+def bench(name, func, pages, repeat):
+    st = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            func(page)
+    elapsed = time.perf_counter() - st
+    num = len(pages) * repeat
+    print('{:<6} pages: {:>6}  elapsed: {:>7.2f}s  pages/s: {:>9.1f}'.format(
+        name, num, elapsed, num / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='视频页面解析速度测试')
+    parser.add_argument('pages', nargs='*', help='保存的视频页面文件')
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--num', type=int, default=50, help='未指定页面时生成的页面数')
+    parser.add_argument('--padding', type=int, default=200, help='生成页面的填充标签数')
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+    else:
+        pages = synthetic_pages(args.num, args.padding)
+    print('平均页面大小: {:.0f} KB'.format(sum(map(len, pages)) / len(pages) / 1024))
+
+    for page in pages:
+        assert extractor.parse_video_page_fast(page)[1:] == \
+            extractor.parse_video_page_soup(page.decode('utf-8'))[1:]
+    bench('soup', lambda page: extractor.parse_video_page_soup(page.decode('utf-8')),
+          pages, args.repeat)
+    bench('fast', extractor.parse_video_page_fast, pages, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
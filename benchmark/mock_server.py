@@ -0,0 +1,288 @@
+'''本地模拟 b站 服务器
+
+提供 视频列表 API / 视频页面 / 评论 API / 图片 四类接口, 数据由编号确定性生成,
+用于在不访问真实站点的情况下测试爬虫速度. 可按比例注入 5xx 错误与截断的响应,
+并模拟超过请求频率后返回 412 的限流.
+
+    python -m benchmark.mock_server --port 8000 --videos 10000 --latency 0.05 --error-rate 0.01
+
+爬虫配置:
+    api_url = http://127.0.0.1:8000/x/
+    video_url = http://127.0.0.1:8000/video/
+'''
+
+import argparse
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def make_png(width=64, height=36, color=(0x33, 0xa3, 0xdc)):
+    '''生成纯色 PNG 图片'''
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body))
+    raw = b''.join(b'\x00' + bytes(color) * width for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw)) + \
+        chunk(b'IEND', b'')
+
+
+class MockBilibili:
+    '''模拟数据集
+
+    videos:     视频总数
+    users:      用户总数
+    latency:    每个请求的额外延迟 (秒)
+    base_aid:   起始 aid
+    regions:    分区数, 视频按序号轮流分到各分区, 分区 rid 取 rid % regions
+    error_rate:     返回 503 的请求比例
+    truncate_rate:  响应只发送一半内容后断开连接的比例
+    throttle:       每秒允许的请求数, 超出的请求返回 412; 为 0 时不限
+    seed:           注入错误使用的随机数种子
+    '''
+
+    def __init__(self, videos=1000, users=None, latency=0.0, base_aid=100000, regions=1,
+                 error_rate=0.0, truncate_rate=0.0, throttle=0, seed=0):
+        self.videos = videos
+        self.regions = max(1, regions)
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        # 当前秒与该秒内的请求数
+        self.window = [0, 0]
+        # 注入的错误类型 -> 次数
+        self.faults = {'error': 0, 'truncate': 0, 'throttle': 0}
+        self.users = users or max(1, videos // 2)
+        self.latency = latency
+        self.base_aid = base_aid
+        self.base_url = ''
+        self.png = make_png()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        '''记录一次请求, 返回需要注入的错误类型 error / truncate / throttle, 不注入时返回 None'''
+        with self.lock:
+            self.requests += 1
+            fault = None
+            if self.throttle:
+                now = int(time.time())
+                if self.window[0] != now:
+                    self.window = [now, 0]
+                self.window[1] += 1
+                if self.window[1] > self.throttle:
+                    fault = 'throttle'
+            if fault is None:
+                value = self.random.random()
+                if value < self.error_rate:
+                    fault = 'error'
+                elif value < self.error_rate + self.truncate_rate:
+                    fault = 'truncate'
+            if fault is not None:
+                self.faults[fault] += 1
+            return fault
+
+    def aid(self, index):
+        return self.base_aid + index
+
+    def bvid(self, aid):
+        return 'BV{:010d}'.format(aid)
+
+    def owner(self, aid):
+        return (aid - self.base_aid) % self.users + 1
+
+    def newlist(self, pn, ps, rid=0):
+        '''分区视频列表, 按发布时间倒序分页'''
+        indexes = range(rid % self.regions, self.videos, self.regions)
+        st = (pn - 1) * ps
+        archives = []
+        for index in indexes[st:st + ps]:
+            aid = self.aid(index)
+            archives.append({'aid': aid, 'bvid': self.bvid(aid), 'cid': aid * 10})
+        return {'code': 0, 'data': {'archives': archives, 'page': {'count': len(indexes), 'num': pn, 'size': ps}}}
+
+    def video_data(self, aid):
+        mid = self.owner(aid)
+        return {
+            'aid': aid,
+            'bvid': self.bvid(aid),
+            'cid': aid * 10,
+            'pic': '{}pic/video/{}.png'.format(self.base_url, aid),
+            'title': '测试视频 {}'.format(aid),
+            'desc': '视频简介 {}'.format(aid),
+            'copyright': 1,
+            'duration': aid % 3600 + 10,
+            'videos': 1,
+            'pubdate': 1627747200 + (aid * 37) % (31 * 86400),
+            'stat': {
+                'aid': aid, 'view': aid % 100000, 'danmaku': aid % 100, 'reply': aid % 50,
+                'favorite': aid % 300, 'coin': aid % 200, 'share': aid % 40, 'like': aid % 1000
+            },
+            'owner': {'mid': mid, 'name': '用户{}'.format(mid)}
+        }
+
+    def up_data(self, mid):
+        return {
+            'mid': mid,
+            'name': '用户{}'.format(mid),
+            'sex': '保密',
+            'face': '{}pic/face/{}.png'.format(self.base_url, mid),
+            'sign': '签名 {}'.format(mid),
+            'level_info': {'current_level': mid % 7},
+            'attention': mid % 500,
+            'fans': mid % 10000
+        }
+
+    def video_page(self, bvid):
+        '''视频页面 html'''
+        aid = int(bvid[2:])
+        if not (0 <= aid - self.base_aid < self.videos):
+            return None
+        state = {'aid': aid, 'bvid': bvid, 'videoData': self.video_data(aid),
+                 'upData': self.up_data(self.owner(aid))}
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+                '<title>{title}_哔哩哔哩_bilibili</title>'
+                '<meta data-vue-meta="true" itemprop="name" name="title" content="{title}">'
+                '<meta data-vue-meta="true" itemprop="keywords" name="keywords" content="{keywords}">'
+                '</head><body><div id="app"></div>'
+                '<script>window.__INITIAL_STATE__={state};(function(){{}}());</script>'
+                '</body></html>').format(
+                    title='测试视频 {}'.format(aid),
+                    keywords='测试视频 {},数码,标签{},哔哩哔哩,bilibili'.format(aid, aid % 20),
+                    state=json.dumps(state, ensure_ascii=False))
+
+    def archive_stat(self, aid):
+        '''视频数据 API, 播放与点赞数随请求次数增长'''
+        if not self.base_aid <= aid < self.base_aid + self.videos:
+            return {'code': -404, 'message': '啥都木有', 'data': None}
+        video = self.video_data(aid)
+        stat = dict(video['stat'])
+        stat['view'] += self.requests
+        stat['like'] += self.requests // 10
+        return {'code': 0, 'message': '0', 'data': stat}
+
+    def replies(self, oid, page, ps=20):
+        '''评论 API, next 参数为页码, 0 与 1 均为第一页'''
+        total = oid % 50
+        st = (max(page, 1) - 1) * ps
+        replies = []
+        for index in range(st, min(st + ps, total)):
+            replies.append({
+                'rpid': oid * 1000 + index,
+                'oid': oid,
+                'mid': index % self.users + 1,
+                'ctime': 1627747200 + index,
+                'like': index % 7,
+                'content': {'message': '评论 {} {}'.format(oid, index)}
+            })
+        is_end = st + ps >= total
+        return {'code': 0, 'data': {
+            'cursor': {'is_begin': st == 0, 'prev': max(page, 1) - 1, 'next': max(page, 1) + 1,
+                       'is_end': is_end, 'all_count': total},
+            'replies': replies or None
+        }}
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.truncate:
+            # 声明完整长度但只发送一半后断开
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        mock = self.server.mock
+        fault = mock.count()
+        if mock.latency:
+            time.sleep(mock.latency)
+        self.truncate = fault == 'truncate'
+        if fault == 'throttle':
+            body = json.dumps({'code': -412, 'message': '请求被拦截', 'data': None}).encode()
+            self.send(412, body, 'application/json')
+            return
+        if fault == 'error':
+            self.send(503, b'service unavailable', 'text/plain')
+            return
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path
+
+        if path == '/x/web-interface/newlist':
+            data = mock.newlist(int(query.get('pn', 1)), int(query.get('ps', 20)),
+                                int(query.get('rid', 0)))
+            self.send(200, json.dumps(data).encode(), 'application/json')
+        elif path.startswith('/video/'):
+            page = mock.video_page(path[len('/video/'):].strip('/'))
+            if page is None:
+                self.send(404, b'not found', 'text/plain')
+            else:
+                self.send(200, page.encode('utf-8'), 'text/html; charset=utf-8')
+        elif path == '/x/v2/reply/main':
+            data = mock.replies(int(query['oid']), int(query.get('next', 0)))
+            self.send(200, json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json')
+        elif path == '/x/web-interface/archive/stat':
+            data = mock.archive_stat(int(query['aid']))
+            self.send(200, json.dumps(data).encode(), 'application/json')
+        elif path.startswith('/pic/'):
+            self.send(200, mock.png, 'image/png')
+        else:
+            self.send(404, b'not found', 'text/plain')
+
+
+def serve(mock, host='127.0.0.1', port=0):
+    '''在后台线程中启动模拟服务器, 返回服务器对象
+
+    mock:   MockBilibili 数据集
+    port:   端口, 为 0 时自动分配
+    '''
+    server = MockServer((host, port), Handler)
+    server.mock = mock
+    mock.base_url = 'http://{}:{}/'.format(host, server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地模拟 b站 服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--videos', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 503 的请求比例')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='截断响应的比例')
+    parser.add_argument('--throttle', type=int, default=0, help='每秒允许的请求数, 超出返回 412')
+    args = parser.parse_args()
+
+    server = serve(MockBilibili(args.videos, latency=args.latency, error_rate=args.error_rate,
+                                truncate_rate=args.truncate_rate, throttle=args.throttle),
+                   args.host, args.port)
+    print('模拟服务器已启动: {}'.format(server.mock.base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,96 @@
+'''端到端吞吐量基准测试
+
+在本地模拟服务器上以不同的 threads 设置运行完整爬取, 输出视频数 / 秒, 请求数 / 秒,
+CPU 时间与峰值内存, 可注入错误, 限流与截断的响应. 每次运行在独立子进程与临时目录中进行,
+结果可保存为 json 作为之后性能改动的对比基线. 需在仓库根目录执行:
+
+    python -m benchmark.suite --videos 2000 --threads 10,50,100 --latency 0.05 --error-rate 0.01
+    python -m benchmark.suite --threads 100 --output baseline.json
+    python -m benchmark.suite --threads 100 --baseline baseline.json
+'''
+
+import argparse
+import copy
+import json
+import platform
+import time
+
+from benchmark import engine
+from benchmark.mock_server import MockBilibili, serve
+
+
+def run_case(mock, engine_name, threads, args):
+    '''以指定引擎与线程数运行一次, 返回结果'''
+    case = copy.copy(args)
+    case.threads = threads
+    requests = mock.requests
+    faults = dict(mock.faults)
+    result = engine.run(engine_name, mock.base_url, case)
+    result['threads'] = threads
+    result['requests'] = mock.requests - requests
+    result['faults'] = {key: mock.faults[key] - faults[key] for key in faults}
+    duration = max(result['last_write'], 1e-3)
+    result['videos_per_sec'] = result['videos'] / duration
+    result['requests_per_sec'] = result['requests'] / duration
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端吞吐量基准测试')
+    parser.add_argument('--videos', type=int, default=2000, help='爬取视频数')
+    parser.add_argument('--threads', default='10,50,100', help='逗号分隔的 threads 设置')
+    parser.add_argument('--engines', default='thread', help='逗号分隔的引擎')
+    parser.add_argument('--concurrency', type=int, default=1000, help='asyncio 引擎各阶段并发数')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟服务器延迟 (秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 503 的请求比例')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='截断响应的比例')
+    parser.add_argument('--throttle', type=int, default=0, help='每秒允许的请求数, 超出返回 412')
+    parser.add_argument('--regions', type=int, default=1, help='分区数')
+    parser.add_argument('--image-backend', default='file', help='图片存储方式 file / pack')
+    parser.add_argument('--seed', type=int, default=0, help='注入错误的随机数种子')
+    parser.add_argument('--output', help='将结果保存为 json 文件')
+    parser.add_argument('--baseline', help='与保存的 json 结果对比')
+    args = parser.parse_args()
+
+    mock = MockBilibili(args.videos, latency=args.latency, regions=args.regions,
+                        error_rate=args.error_rate, truncate_rate=args.truncate_rate,
+                        throttle=args.throttle, seed=args.seed)
+    server = serve(mock)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = {(result['engine'], result['threads']): result
+                        for result in json.load(f)['results']}
+
+    print('模拟服务器: {} 视频数: {} 延迟: {}s 错误: {} 截断: {} 限流: {}/s'.format(
+        mock.base_url, args.videos, args.latency, args.error_rate, args.truncate_rate,
+        args.throttle or '-'))
+    print('{:<8} {:>7} {:>9} {:>7} {:>9} {:>10} {:>8} {:>8} {:>7}  {}'.format(
+        'engine', 'threads', 'elapsed/s', 'videos', 'videos/s', 'requests/s',
+        'cpu/s', 'rss/MB', 'vs base', 'faults'))
+    results = []
+    for engine_name in args.engines.split(','):
+        for threads in [int(value) for value in args.threads.split(',')]:
+            result = run_case(mock, engine_name, threads, args)
+            results.append(result)
+            base = baseline.get((engine_name, threads))
+            change = '{:+.1%}'.format(result['videos_per_sec'] / base['videos_per_sec'] - 1) \
+                if base else '-'
+            print('{:<8} {:>7} {:>9.2f} {:>7} {:>9.1f} {:>10.1f} {:>8.2f} {:>8.1f} {:>7}  {}'.format(
+                engine_name, threads, result['elapsed'], result['videos'],
+                result['videos_per_sec'], result['requests_per_sec'], result['cpu'],
+                result['rss'] / 1024 / 1024, change,
+                ' '.join('{}:{}'.format(key, value) for key, value in result['faults'].items() if value)))
+    server.shutdown()
+
+    if args.output:
+        params = {key: value for key, value in vars(args).items()
+                  if key not in ('output', 'baseline')}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'time': time.time(), 'python': platform.python_version(),
+                       'machine': platform.machine(), 'params': params, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
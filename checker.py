@@ -1,78 +1,254 @@
-import sqlite3
-import configparser
-from tqdm import tqdm
-from PIL import Image
-Image.MAX_IMAGE_PIXELS = 200000000
-
-CONFIG = configparser.ConfigParser()
-CONFIG.read('config.ini', encoding='utf-8')
-DB_NAME = CONFIG['common'].get('database_name', fallback='data')
-
-conn = sqlite3.connect('data/' + DB_NAME + '.sqlite3')
-conn.row_factory = sqlite3.Row
-cursor = conn.cursor()
-
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE bvid IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE cid IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE pic IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE title IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE desc IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE keywords IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE copyright IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE duration IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE videos IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE pubdate IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE view IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE danmaku IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE like IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE coin IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE favorite IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE share IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE reply IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE owner IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE localpic IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM VIDEO WHERE spider IS NULL;').fetchone()[0] == 0)
-
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE name IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE sex IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE face IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE sign IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE level IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE attention IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE fans IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE localpic IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM USER WHERE spider IS NULL;').fetchone()[0] == 0)
-
-assert(cursor.execute('SELECT COUNT() FROM COMMENT WHERE data IS NULL;').fetchone()[0] == 0)
-assert(cursor.execute('SELECT COUNT() FROM COMMENT WHERE spider IS NULL;').fetchone()[0] == 0)
-
-print('NULL check pass.')
-
+'''数据检验工具
 
-assert(cursor.execute('SELECT COUNT() from VIDEO WHERE VIDEO.owner NOT IN (SELECT mid FROM USER)').fetchone()[0] == 0)
+检查各表的空字段 (每个表一次扫描), 视频对应的用户与评论是否存在, 以及已下载的图片是否完整.
+图片按内容哈希去重后在进程池中校验内容哈希与 PIL 完整性.
+检查通过 (或全部问题已重新加入任务表) 后在 META 表中记录本次开始时间, 之后只检查此后写入的数据;
+旧版本直接保存的图片不会再增加, 全部通过后不再检查. --full 重新检查全部数据.
+--repair 将有问题的数据重新加入爬虫任务表, 需在爬虫停止时运行. 在仓库根目录运行:
 
-print('USER existence check pass.')
+    python checker.py
+    python checker.py --full --workers 8
+    python checker.py --repair
+'''
 
+import argparse
+import configparser
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-assert(cursor.execute('SELECT COUNT() from VIDEO WHERE VIDEO.aid NOT IN (SELECT oid FROM COMMENT)').fetchone()[0] == 0)
-
-print('COMMENT existence check pass.')
-
-
-cursor = conn.execute('SELECT * FROM VIDEO WHERE localpic = 1')
-for row in tqdm(cursor):
-    Image.open(
-        'data/video_pic/{}.{}'.format(row['aid'], row['pic'].split('.')[-1])).verify()
-
-print('VIDEO pic check pass.')
-
-
-cursor = conn.execute('SELECT * FROM USER WHERE localpic = 1')
-for row in tqdm(cursor):
-    Image.open(
-        'data/user_face/{}.{}'.format(row['mid'], row['face'].split('.')[-1])).verify()
-
-print('USER pic check pass.')
+from tqdm import tqdm
+from PIL import Image
 
+import database
+import image_check
+import image_store
+Image.MAX_IMAGE_PIXELS = 200000000
 
-print('All check OK.')
+# 表名 -> (主键, 重新获取的任务类型, 检查空字段的列)
+COLUMNS = {
+    'VIDEO': ('aid', 'video', [
+        'bvid', 'cid', 'pic', 'title', 'desc', 'keywords', 'copyright', 'duration', 'videos',
+        'pubdate', 'view', 'danmaku', 'like', 'coin', 'favorite', 'share', 'reply', 'owner',
+        'localpic', 'spider']),
+    'USER': ('mid', None, [
+        'name', 'sex', 'face', 'sign', 'level', 'attention', 'fans', 'localpic', 'spider']),
+    'COMMENT': ('oid', 'comment', ['data', 'spider'])
+}
+
+# 重新获取的任务尚未完成的行不计入
+UNFINISHED = '''NOT EXISTS (SELECT 1 FROM FRONTIER WHERE type = '{}' AND key = {}
+    AND state != {})'''
+
+# 图片任务类型 -> (表名, 主键, 图片地址列, 旧版本图片目录)
+PICTURES = {
+    'video_pic': ('VIDEO', 'aid', 'pic', 'video_pic'),
+    'user_pic': ('USER', 'mid', 'face', 'user_face')
+}
+
+
+def check_nulls(db, table, since):
+    '''一次扫描检查一个表中的空字段
+
+    db:     数据库
+    table:  表名
+    since:  只检查 spider 时间不早于该值的行
+    返回 ({列名: 空值数}, 有空字段的行的主键列表)
+    '''
+    key, type, columns = COLUMNS[table]
+    sql = 'SELECT {}, {} FROM {} WHERE (spider >= ? OR spider IS NULL) AND ({})'.format(
+        key, ', '.join('"{}"'.format(name) for name in columns), table,
+        ' OR '.join('"{}" IS NULL'.format(name) for name in columns))
+    if type is not None:
+        sql += ' AND ' + UNFINISHED.format(type, key, database.DONE)
+    rows = db.cursor.execute(sql, (since,)).fetchall()
+    count = {name: sum(row[i + 1] is None for row in rows) for i, name in enumerate(columns)}
+    return {name: num for name, num in count.items() if num}, [row[0] for row in rows]
+
+
+def check_users(db, since):
+    '''检查视频对应的用户是否存在, 视频任务尚未完成的不计入, 返回缺少用户的视频 (aid, bvid, cid) 列表'''
+    return db.cursor.execute('''SELECT aid, bvid, cid FROM VIDEO WHERE spider >= ?
+        AND NOT EXISTS (SELECT 1 FROM USER WHERE mid = VIDEO.owner) AND ''' +
+        UNFINISHED.format('video', 'aid', database.DONE), (since,)).fetchall()
+
+
+def check_comments(db, since):
+    '''检查视频的评论是否存在, 评论任务尚未完成的视频不计入, 返回缺少评论的视频 aid 列表'''
+    return [row[0] for row in db.cursor.execute('''SELECT aid FROM VIDEO WHERE spider >= ?
+        AND NOT EXISTS (SELECT 1 FROM COMMENT WHERE oid = VIDEO.aid) AND ''' +
+        UNFINISHED.format('comment', 'aid', database.DONE), (since,))]
+
+
+def image_items(db, store, since, legacy):
+    '''待校验的图片
+
+    通过图片存储下载的图片按内容哈希去重, 以 IMAGE 表的写入时间判断是否为新图片;
+    旧版本直接保存在 data/{folder}/ 下的图片 (没有 IMAGE 记录) 只在 legacy 为 True 时全部检查,
+    所在行的 spider 时间会随重新爬取与刷新改变, 不用于判断.
+    生成 (标识, 内容哈希, 图片内容), 标识为内容哈希或 (任务类型, 主键), 内容不存在时为 None
+    '''
+    for (digest,) in db.cursor.execute(
+            'SELECT DISTINCT hash FROM IMAGE WHERE spider >= ?', (since,)).fetchall():
+        content = store.read(digest)
+        yield digest, digest, None if content is None else bytes(content)
+    if not legacy:
+        return
+    for type, (table, key, column, folder) in PICTURES.items():
+        for id, url in db.cursor.execute('''SELECT {0}, {1} FROM {2} WHERE localpic = 1
+                AND NOT EXISTS (SELECT 1 FROM IMAGE WHERE url = {2}.{1})'''.format(
+                    key, column, table)).fetchall():
+            try:
+                with open('data/{}/{}.{}'.format(folder, id, url.split('.')[-1]), 'rb') as f:
+                    yield (type, id), None, f.read()
+            except OSError:
+                yield (type, id), None, None
+
+
+def check_images(db, store, since, legacy, workers, batch_size=256):
+    '''在进程池中校验图片
+
+    db:         数据库
+    store:      图片存储
+    since:      只检查此后下载的图片
+    legacy:     是否检查旧版本直接保存的图片
+    workers:    进程数
+    batch_size: 每批提交的图片数, 限制内存占用
+    返回损坏图片的标识列表
+    '''
+    broken = []
+
+    def run(batch):
+        items = [(digest, content) for _, digest, content in batch if content is not None]
+        results = iter(pool.map(image_check.digest_check, items, chunksize=16))
+        for name, _, content in batch:
+            if content is None or not next(results):
+                broken.append(name)
+
+    with ProcessPoolExecutor(max(1, workers)) as pool:
+        batch = []
+        for item in tqdm(image_items(db, store, since, legacy)):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                run(batch)
+                batch = []
+        run(batch)
+    return broken
+
+
+def repair(db, store, nulls, users, comments, images):
+    '''将有问题的数据重新加入任务表, 爬虫再次运行时重新获取
+
+    db:         数据库
+    store:      图片存储
+    nulls:      {表名: 有空字段的行的主键列表}
+    users:      缺少用户的视频 (aid, bvid, cid) 列表
+    comments:   缺少评论的视频 aid 列表
+    images:     损坏图片的标识列表
+    返回 (视频任务数, 评论任务数, 图片任务数, 无法重新获取的视频 aid 列表)
+    '''
+    rows = list(users)
+    comments = list(comments)
+    with db.transaction():
+        # 视频信息不完整时重新获取视频页面
+        rows.extend(db.cursor.execute('SELECT aid, bvid, cid FROM VIDEO WHERE aid = ?',
+                                      (aid,)).fetchone() for aid in nulls['VIDEO'])
+        # 用户信息不完整时删除该用户, 并重新获取其视频, 视频页面中包含用户信息
+        for mid in nulls['USER']:
+            db.cursor.execute('DELETE FROM USER WHERE mid = ?', (mid,))
+            rows.extend(db.cursor.execute(
+                'SELECT aid, bvid, cid FROM VIDEO WHERE owner = ?', (mid,)).fetchall())
+        # 缺少 bvid 时无法重新获取视频页面
+        videos = {aid: (bvid, cid) for aid, bvid, cid in rows if bvid is not None}
+        skipped = sorted({aid for aid, bvid, _ in rows if bvid is None})
+        comments.extend(nulls['COMMENT'])
+        db.add_tasks('video', [(aid, list(value)) for aid, value in videos.items()], reset=True)
+        db.add_tasks('comment', [(aid, None) for aid in comments], reset=True)
+
+        # 损坏的图片删除内容与索引, 使用该图片的行置为未下载并重新加入图片任务;
+        # 损坏的内容哈希放入临时表, 每个表只扫描一次 (图片地址列没有索引)
+        rows = {type: [] for type in PICTURES}
+        db.cursor.execute('CREATE TEMP TABLE BROKEN_IMAGE(hash TEXT PRIMARY KEY);')
+        for name in images:
+            if isinstance(name, str):
+                store.remove(name)
+                db.cursor.execute('INSERT OR IGNORE INTO temp.BROKEN_IMAGE VALUES (?);', (name,))
+            else:
+                rows[name[0]].append(name[1])
+        for type, (table, key, column, _) in PICTURES.items():
+            tasks = db.cursor.execute('''SELECT {0}, {1} FROM {2} JOIN IMAGE ON IMAGE.url = {2}.{1}
+                WHERE IMAGE.hash IN (SELECT hash FROM temp.BROKEN_IMAGE)'''.format(
+                    key, column, table)).fetchall()
+            tasks.extend(db.cursor.execute('SELECT {}, {} FROM {} WHERE {} = ?'.format(
+                key, column, table, key), (id,)).fetchone() for id in rows[type])
+            db.cursor.executemany('UPDATE {} SET localpic = 0 WHERE {} = ?'.format(table, key),
+                                  ((id,) for id, _ in tasks))
+            db.add_tasks(type, tasks, reset=True)
+        db.cursor.execute('DELETE FROM IMAGE WHERE hash IN (SELECT hash FROM temp.BROKEN_IMAGE);')
+        db.cursor.execute('DROP TABLE temp.BROKEN_IMAGE;')
+    return len(videos), len(comments), len(images), skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='检查数据完整性')
+    parser.add_argument('--full', action='store_true', help='忽略上次检查的时间, 检查全部数据')
+    parser.add_argument('--repair', action='store_true', help='将有问题的数据重新加入爬虫任务表')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='图片校验进程数')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini', encoding='utf-8')
+    db_name = config['common'].get('database_name', fallback='data')
+    image_backend = config.get('image', 'backend', fallback='file')
+    image_segment = config.getint('image', 'segment_size', fallback=256)
+
+    db = database.Database(db_name)
+    store = image_store.open_store(image_backend, 'data', image_segment * 1024 * 1024)
+    now = int(time.time())
+    since = 0 if args.full else int(db.get_meta('checked') or 0)
+    legacy = args.full or db.get_meta('legacy_checked') is None
+    if since:
+        print('只检查 {} 之后的数据.'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since))))
+
+    nulls = {}
+    for table in COLUMNS:
+        count, nulls[table] = check_nulls(db, table, since)
+        print('{} NULL check {}. {}'.format(table, 'fail' if count else 'pass', count or ''))
+
+    users = check_users(db, since)
+    print('USER existence check {}. {}'.format('fail' if users else 'pass', len(users) or ''))
+
+    comments = check_comments(db, since)
+    print('COMMENT existence check {}. {}'.format('fail' if comments else 'pass', len(comments) or ''))
+
+    images = check_images(db, store, since, legacy, args.workers)
+    print('Image check {}. {}'.format('fail' if images else 'pass', len(images) or ''))
+
+    ok = not (any(nulls.values()) or users or comments or images)
+    skipped = []
+    if not ok and args.repair:
+        *count, skipped = repair(db, store, nulls, users, comments, images)
+        print('已重新加入 {} 个视频任务, {} 个评论任务, {} 个损坏图片的图片任务.'.format(*count))
+        if skipped:
+            print('{} 个视频缺少 bvid, 无法重新获取: {}'.format(len(skipped), skipped[:20]))
+    # 有未能重新加入任务表的问题时不推进检查时间, 下次仍会报告
+    if ok or (args.repair and not skipped):
+        with db.transaction():
+            db.set_meta('checked', now)
+            if legacy:
+                db.set_meta('legacy_checked', now)
+    store.close()
+    del db
+
+    if not ok and not args.repair:
+        print('Check failed. 使用 --repair 重新获取有问题的数据.')
+        sys.exit(1)
+    if skipped:
+        print('Repair incomplete.')
+        sys.exit(1)
+    print('All check OK.' if ok else 'Repair done.')
+
+
+if __name__ == '__main__':
+    main()
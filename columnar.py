@@ -0,0 +1,233 @@
+'''列式存储
+
+每个表一个目录, 每列单独存放, 只追加写入, 读取时以内存映射方式只访问需要的列.
+
+    meta.json                   行数, 已导出的最大 spider 时间, 各列类型与字典
+    {列名}.bin                  定长数值列 (int8 / int32 / int64 / float64) 或字典编码列的编号 (int32)
+    {列名}.offsets {列名}.bytes  变长字符串列: 各行结束位置 (int64) 与 utf-8 内容
+
+整数列中的 NULL 以该类型最小值 (NULL_INT) 表示, 字典编码列中的 NULL 编号为 -1, 字符串列中的 NULL 为空串.
+meta.json 最后以替换方式写入, 写入中断时多出的列数据在下次写入时截断.
+
+Class:
+    Writer:         追加写入
+    Table:          内存映射读取
+    StringColumn:   字符串列
+'''
+
+import json
+import os
+
+import numpy as np
+
+# 列类型 -> 存储类型
+DTYPES = {
+    'int8': np.int8,
+    'int32': np.int32,
+    'int64': np.int64,
+    'float64': np.float64,
+    'dict': np.int32
+}
+
+
+def null_value(type):
+    '''该类型中表示 NULL 的值'''
+    if type == 'float64':
+        return np.nan
+    if type == 'dict':
+        return -1
+    return np.iinfo(DTYPES[type]).min
+
+
+def read_meta(root):
+    path = os.path.join(root, 'meta.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class Writer:
+    '''追加写入一个表
+
+    root:   表目录
+    schema: [(列名, 类型)], 类型为 int8 / int32 / int64 / float64 / dict / string
+    '''
+
+    def __init__(self, root, schema):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.meta = read_meta(root) or {
+            'rows': 0,
+            'last': 0,
+            'columns': [{'name': name, 'type': type} for name, type in schema]
+        }
+        if [(column['name'], column['type']) for column in self.meta['columns']] != list(schema):
+            raise ValueError('表 {} 的列与已导出的不一致'.format(root))
+        self.truncate()
+
+    def path(self, name, suffix):
+        return os.path.join(self.root, name + suffix)
+
+    def truncate(self):
+        '''截断写入中断时多出的数据'''
+        rows = self.meta['rows']
+        for column in self.meta['columns']:
+            name = column['name']
+            if column['type'] == 'string':
+                offsets = self.path(name, '.offsets')
+                end = 0
+                if rows:
+                    end = int(np.memmap(offsets, np.int64, 'r', shape=(rows,))[-1])
+                self.resize(offsets, rows * 8)
+                self.resize(self.path(name, '.bytes'), end)
+            else:
+                self.resize(self.path(name, '.bin'), rows * np.dtype(DTYPES[column['type']]).itemsize)
+
+    @staticmethod
+    def resize(path, size):
+        with open(path, 'ab') as f:
+            if f.tell() < size:
+                raise ValueError('列文件 {} 不完整'.format(path))
+            f.truncate(size)
+
+    def append(self, rows):
+        '''追加若干行
+
+        rows:   行列表, 各行的值按 schema 顺序排列
+        '''
+        if not rows:
+            return
+        for column, values in zip(self.meta['columns'], zip(*rows)):
+            name = column['name']
+            type = column['type']
+            if type == 'string':
+                data = [(value or '').encode('utf-8') for value in values]
+                path = self.path(name, '.offsets')
+                start = 0
+                if os.path.getsize(path):
+                    start = int(np.fromfile(path, np.int64, offset=os.path.getsize(path) - 8)[0])
+                offsets = start + np.cumsum([len(value) for value in data], dtype=np.int64)
+                with open(path, 'ab') as f:
+                    f.write(offsets.tobytes())
+                with open(self.path(name, '.bytes'), 'ab') as f:
+                    f.write(b''.join(data))
+                continue
+            if type == 'dict':
+                index = {value: code for code, value in enumerate(column.setdefault('dictionary', []))}
+                codes = []
+                for value in values:
+                    if value is None:
+                        codes.append(-1)
+                        continue
+                    if value not in index:
+                        index[value] = len(column['dictionary'])
+                        column['dictionary'].append(value)
+                    codes.append(index[value])
+                array = np.array(codes, dtype=np.int32)
+            else:
+                null = null_value(type)
+                array = np.array([null if value is None else value for value in values],
+                                 dtype=DTYPES[type])
+            with open(self.path(name, '.bin'), 'ab') as f:
+                f.write(array.tobytes())
+        self.meta['rows'] += len(rows)
+
+    def commit(self, last):
+        '''写入 meta.json, 此前追加的行生效
+
+        last:   已导出的最大 spider 时间
+        '''
+        self.meta['last'] = last
+        temp = os.path.join(self.root, 'meta.json.tmp')
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(temp, os.path.join(self.root, 'meta.json'))
+
+
+class StringColumn:
+    '''内存映射的字符串列
+
+    offsets:    各行结束位置
+    data:       utf-8 内容
+    '''
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        start = int(self.offsets[i - 1]) if i > 0 else 0
+        return bytes(self.data[start:int(self.offsets[i])]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, indices):
+        '''取出若干行, 返回 object 数组'''
+        return np.array([self[int(i)] for i in indices], dtype=object)
+
+
+class Table:
+    '''以内存映射方式读取一个表, 只读取访问的列
+
+    root:   表目录
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.meta = read_meta(root)
+        if self.meta is None:
+            raise FileNotFoundError('{} 中没有导出的数据'.format(root))
+        self.rows = self.meta['rows']
+        self.columns = {column['name']: column for column in self.meta['columns']}
+
+    def __len__(self):
+        return self.rows
+
+    def path(self, name, suffix):
+        return os.path.join(self.root, name + suffix)
+
+    def memmap(self, path, dtype, rows):
+        if not rows:
+            return np.empty(0, dtype)
+        return np.memmap(path, dtype, 'r', shape=(rows,))
+
+    def column(self, name):
+        '''读取一列
+
+        name:   列名
+        数值列与字典编码列返回编号的内存映射数组, 字符串列返回 StringColumn
+        '''
+        type = self.columns[name]['type']
+        if type == 'string':
+            end = 0
+            offsets = self.memmap(self.path(name, '.offsets'), np.int64, self.rows)
+            if self.rows:
+                end = int(offsets[-1])
+            return StringColumn(offsets, self.memmap(self.path(name, '.bytes'), np.uint8, end))
+        return self.memmap(self.path(name, '.bin'), DTYPES[type], self.rows)
+
+    def decode(self, name, codes=None):
+        '''将字典编码列的编号转换为值, NULL 为 None
+
+        name:   列名
+        codes:  编号数组, 为 None 时转换整列
+        '''
+        if codes is None:
+            codes = self.column(name)
+        values = np.array(self.columns[name].get('dictionary', []) + [None], dtype=object)
+        return values[codes]
+
+    def latest(self, key):
+        '''同一键重复导出时只保留最后一次, 返回保留的行号 (升序)
+
+        key:    键所在的列名
+        '''
+        keys = np.asarray(self.column(key))
+        _, index = np.unique(keys[::-1], return_index=True)
+        return np.sort(len(keys) - 1 - index)
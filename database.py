@@ -1,25 +1,69 @@
 import sqlite3
 import os
 import time
+import json
+import logging
+from contextlib import contextmanager
+
+# 任务状态
+PENDING = 0
+CLAIMED = 1
+DONE = 2
+
+# 列表页任务的键为 分区 rid * PAGE_SPAN + 页码
+PAGE_SPAN = 1000000
+
+
+def page_key(rid, pn):
+    '''列表页在任务表中的键
+
+    rid:    分区 rid
+    pn:     页码
+    '''
+    return rid * PAGE_SPAN + pn
 
 
 class Database:
     '''数据库接口类
 
-    name:   数据库名称, 将访问 data/name.sqlite3 数据库
+    name:           数据库名称, 将访问 data/name.sqlite3 数据库
+    wal:            是否使用 WAL 日志模式
+    synchronous:    SQLite synchronous 设置, WAL 模式下 NORMAL 只在检查点时同步磁盘
+    owner:          领取任务的节点名称, 多个进程共享数据库时用于区分租约
+    lease:          任务租约时长 (秒), 过期未完成的任务可被其他节点重新领取; 为 0 时不过期
+    readonly:       以只读方式打开已有数据库, 不建表, 不迁移, 不改变日志模式, 用于分析程序
     '''
 
-    def __init__(self, name):
+    def __init__(self, name, wal=True, synchronous='NORMAL', owner=None, lease=0, readonly=False):
+        self.owner = owner
+        self.lease = lease
+        self.count = 0
+        if readonly:
+            self.conn = sqlite3.connect('file:data/{}.sqlite3?mode=ro'.format(name), uri=True)
+            self.cursor = self.conn.cursor()
+            row = self.cursor.execute(
+                'SELECT sql FROM sqlite_master WHERE name = \'REPLY_FTS\'').fetchone()
+            self.fts = row is not None and 'trigram' in row[0]
+            return
         if not os.path.exists('data'):
             os.mkdir('data')
         if not os.path.exists('data/video_pic'):
             os.mkdir('data/video_pic')
         if not os.path.exists('data/user_face'):
             os.mkdir('data/user_face')
-        self.conn = sqlite3.connect('data/' + name + '.sqlite3')
+        # 多个进程共享数据库时写锁等待时间较长
+        self.conn = sqlite3.connect('data/' + name + '.sqlite3', timeout=60 if lease else 5)
         self.cursor = self.conn.cursor()
+        if wal:
+            self.cursor.execute('PRAGMA journal_mode = WAL;')
+        self.cursor.execute('PRAGMA synchronous = {};'.format(synchronous))
         self.create_table()
-        self.count = 0
+        if self.get_meta('frontier') is None:
+            self.init_frontier()
+        if self.get_meta('reply_migrated') is None:
+            self.migrate_comments()
+        if self.get_meta('tags_migrated') is None:
+            self.migrate_tags()
 
     def __del__(self):
         '''提交并关闭数据库'''
@@ -61,6 +105,32 @@ class Database:
         spider      INTEGER
         );''')
 
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS VIDEO_PUBDATE ON VIDEO(pubdate);''')
+
+        # 标签字典, count 为带有该标签的视频数, 随视频插入更新
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS TAG(
+        id          INTEGER PRIMARY KEY,
+        name        TEXT UNIQUE,
+        count       INTEGER
+        );''')
+
+        # 标签倒排表, pubdate 取自 VIDEO, 按标签或发布时间查询时只需访问索引
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS VIDEO_TAG(
+        tag         INTEGER,
+        pubdate     INTEGER,
+        aid         INTEGER,
+        PRIMARY KEY (tag, pubdate, aid)
+        ) WITHOUT ROWID;''')
+
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS VIDEO_TAG_AID ON VIDEO_TAG(aid);''')
+
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS VIDEO_TAG_PUBDATE ON VIDEO_TAG(pubdate, tag);''')
+
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS USER(
         mid         INTEGER PRIMARY KEY,
@@ -82,18 +152,122 @@ class Database:
         spider      INTEGER
         );''')
 
+        # 单条评论, oid 为视频 aid
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS REPLY(
+        rpid        INTEGER PRIMARY KEY,
+        oid         INTEGER,
+        mid         INTEGER,
+        like        INTEGER,
+        ctime       INTEGER,
+        message     TEXT,
+        spider      INTEGER
+        );''')
+
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS REPLY_OID ON REPLY(oid);''')
+
+        # 评论全文索引, 不可用时评论搜索逐条匹配
+        self.fts = self.create_fts()
+
+        # 各分区列表进度, pn 为下一页页码, quota 为视频数量上限 (NULL 为不限),
+        # count 为已放入任务表的视频数
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS REGION(
+        rid         INTEGER PRIMARY KEY,
+        pn          INTEGER,
+        quota       INTEGER,
+        count       INTEGER
+        );''')
+
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS TEMP(
         id          INTEGER PRIMARY KEY,
         pn          INTEGER
         );''')
 
-    def insert_video(self, video):
-        '''插入视频数据
+        # 爬取任务表, type 为 page / video / video_pic / user_pic / comment
+        # owner 与 expire 为已领取任务的节点与租约到期时间
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS FRONTIER(
+        type        TEXT,
+        key         INTEGER,
+        state       INTEGER,
+        payload     TEXT,
+        updated     INTEGER,
+        owner       TEXT,
+        expire      INTEGER,
+        PRIMARY KEY (type, key)
+        ) WITHOUT ROWID;''')
 
-        video:  视频数据
+        columns = [row[1] for row in self.cursor.execute('PRAGMA table_info(FRONTIER)')]
+        if 'owner' not in columns:
+            self.cursor.execute('ALTER TABLE FRONTIER ADD COLUMN owner TEXT;')
+            self.cursor.execute('ALTER TABLE FRONTIER ADD COLUMN expire INTEGER;')
+
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS FRONTIER_STATE ON FRONTIER(type, state);''')
+
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS META(
+        key         TEXT PRIMARY KEY,
+        value       TEXT
+        );''')
+
+        # 视频数据变化记录, 每次刷新追加一行
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS VIDEO_STAT(
+        aid         INTEGER,
+        time        INTEGER,
+        view        INTEGER,
+        danmaku     INTEGER,
+        like        INTEGER,
+        coin        INTEGER,
+        favorite    INTEGER,
+        share       INTEGER,
+        reply       INTEGER,
+        PRIMARY KEY (aid, time)
+        ) WITHOUT ROWID;''')
+
+        # 视频最近一次刷新的写入时间与响应 code, 获取失败 (视频已删除等) 的也记录, 按刷新间隔重试
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS VIDEO_REFRESH(
+        aid         INTEGER PRIMARY KEY,
+        time        INTEGER,
+        code        INTEGER
+        );''')
+
+        # 列式导出按刷新时间查找被更新的视频
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS VIDEO_REFRESH_TIME ON VIDEO_REFRESH(time);''')
+
+        # 图片地址 -> 内容哈希
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS IMAGE(
+        url         TEXT PRIMARY KEY,
+        hash        TEXT,
+        spider      INTEGER
+        );''')
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        '''显式事务, 正常退出时提交, 出现异常时回滚
+
+        immediate:  是否在事务开始时即获取写锁, 用于多个进程间先读后写的领取操作
         '''
-        data = (
+        self.conn.commit()
+        self.cursor.execute('BEGIN IMMEDIATE;' if immediate else 'BEGIN;')
+        try:
+            yield
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.count = 0
+
+    @staticmethod
+    def video_row(video):
+        return (
             video['aid'],
             video['bvid'],
             video['cid'],
@@ -116,16 +290,99 @@ class Database:
             0,
             int(time.time())
         )
-        self.cursor.execute(
-            'INSERT OR REPLACE INTO VIDEO VALUES (' + ('?,' * 20) + '?);', data)
+
+    def insert_video(self, video):
+        '''插入视频数据
+
+        video:  视频数据
+        '''
+        self.insert_videos([video])
         self.update_db()
 
-    def insert_user(self, user):
-        '''插入用户数据
+    def insert_videos(self, videos):
+        '''批量插入视频数据, 完成视频任务并添加封面与评论任务
 
-        user:   用户数据
+        videos: 视频数据列表
         '''
-        data = (
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO VIDEO VALUES (' + ('?,' * 20) + '?);', map(self.video_row, videos))
+        self.index_tags([(video['aid'], video['keywords'], video['pubdate']) for video in videos])
+        self.finish_tasks('video', [video['aid'] for video in videos])
+        self.add_tasks('video_pic', [(video['aid'], video['pic']) for video in videos], reset=True)
+        self.add_tasks('comment', [(video['aid'], None) for video in videos])
+
+    @staticmethod
+    def split_tags(keywords):
+        '''拆分以逗号分隔的标签字符串, 去除空白与重复'''
+        return list(dict.fromkeys(filter(None, (name.strip() for name in (keywords or '').split(',')))))
+
+    def index_tags(self, videos):
+        '''更新视频的标签倒排表与标签计数, 视频原有的标签先移除
+
+        videos: [(aid, 标签字符串, 发布时间)]
+        '''
+        # 同一视频只保留最后一次
+        videos = list({video[0]: video for video in videos}.values())
+        aids = [(aid,) for aid, _, _ in videos]
+        self.cursor.executemany('''UPDATE TAG SET count = count - 1
+            WHERE id IN (SELECT tag FROM VIDEO_TAG WHERE aid = ?)''', aids)
+        self.cursor.executemany('DELETE FROM VIDEO_TAG WHERE aid = ?', aids)
+        postings = [(pubdate, aid, name) for aid, keywords, pubdate in videos
+                    for name in self.split_tags(keywords)]
+        self.cursor.executemany('INSERT OR IGNORE INTO TAG (name, count) VALUES (?, 0)',
+                                ((name,) for _, _, name in postings))
+        self.cursor.executemany('''INSERT INTO VIDEO_TAG (tag, pubdate, aid)
+            SELECT id, IFNULL(?, 0), ? FROM TAG WHERE name = ?''', postings)
+        self.cursor.executemany('UPDATE TAG SET count = count + 1 WHERE name = ?',
+                                ((name,) for _, _, name in postings))
+
+    def migrate_tags(self, chunk_size=10000):
+        '''由已有视频的 keywords 一次性建立标签表'''
+        now = int(time.time())
+        with self.transaction():
+            rows = self.conn.execute('SELECT aid, keywords, pubdate FROM VIDEO')
+            while True:
+                videos = rows.fetchmany(chunk_size)
+                if not videos:
+                    break
+                self.index_tags(videos)
+            self.set_meta('tags_migrated', now)
+
+    def top_tags(self, start=None, end=None, limit=None):
+        '''按带有标签的视频数从多到少获取标签
+
+        start:  发布时间下限 (含), 与 end 均为 None 时直接读取标签计数
+        end:    发布时间上限 (不含)
+        limit:  数量上限, 为 None 时不限制
+        返回 [(标签, 视频数)]
+        '''
+        if start is None and end is None:
+            return self.cursor.execute('''SELECT name, count FROM TAG WHERE count > 0
+                ORDER BY count DESC LIMIT ?''', (-1 if limit is None else limit,)).fetchall()
+        return self.cursor.execute('''SELECT name, num FROM
+            (SELECT tag, COUNT() AS num FROM VIDEO_TAG WHERE pubdate >= ? AND pubdate < ? GROUP BY tag)
+            JOIN TAG ON TAG.id = tag ORDER BY num DESC LIMIT ?''',
+            (-2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end,
+             -1 if limit is None else limit)).fetchall()
+
+    def get_tag_videos(self, name, start=None, end=None, limit=None):
+        '''获取带有标签的视频, 按发布时间从新到旧
+
+        name:   标签
+        start:  发布时间下限 (含), 为 None 时不限制
+        end:    发布时间上限 (不含), 为 None 时不限制
+        limit:  数量上限, 为 None 时不限制
+        返回 aid 列表
+        '''
+        return [row[0] for row in self.cursor.execute('''SELECT aid FROM VIDEO_TAG
+            WHERE tag = (SELECT id FROM TAG WHERE name = ?) AND pubdate >= ? AND pubdate < ?
+            ORDER BY pubdate DESC LIMIT ?''',
+            (name, -2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end,
+             -1 if limit is None else limit))]
+
+    @staticmethod
+    def user_row(user):
+        return (
             user['mid'],
             user['name'],
             user['sex'],
@@ -137,24 +394,185 @@ class Database:
             0,
             int(time.time())
         )
-        self.cursor.execute(
-            'INSERT OR REPLACE INTO USER VALUES (' + ('?,' * 9) + '?);', data)
+
+    def insert_user(self, user):
+        '''插入用户数据
+
+        user:   用户数据
+        '''
+        self.insert_users([user])
         self.update_db()
 
-    def insert_comment(self, comment):
-        '''插入评论数据
+    def insert_users(self, users):
+        '''批量插入用户数据, 添加头像任务
 
-        comment: 评论数据
+        users:  用户数据列表
         '''
-        data = (
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO USER VALUES (' + ('?,' * 9) + '?);', map(self.user_row, users))
+        self.add_tasks('user_pic', [(user['mid'], user['face']) for user in users], reset=True)
+
+    @staticmethod
+    def comment_row(comment):
+        return (
             comment['oid'],
             comment['data'],
             int(time.time())
         )
-        self.cursor.execute(
-            'INSERT OR REPLACE INTO COMMENT VALUES (?, ?, ?);', data)
+
+    @staticmethod
+    def reply_row(reply):
+        return (
+            reply['rpid'],
+            reply['oid'],
+            reply['mid'],
+            reply['like'],
+            reply['ctime'],
+            reply['content']['message'],
+            int(time.time())
+        )
+
+    def create_fts(self):
+        '''建立评论全文索引, 内容取自 REPLY 表, 由触发器随插入更新
+
+        使用 trigram 分词以支持中文任意三字以上子串查询, 需要 SQLite 3.34 以上;
+        SQLite 不支持 FTS5 或 trigram 时不建立全文索引 (默认分词无法匹配中文子串)
+        返回全文索引是否可用
+        '''
+        try:
+            self.cursor.execute('''
+            CREATE VIRTUAL TABLE temp.FTS_CHECK USING fts5(message, tokenize = 'trigram');''')
+            self.cursor.execute('DROP TABLE temp.FTS_CHECK;')
+        except sqlite3.OperationalError as error:
+            logging.warning('SQLite 不支持 FTS5 trigram 分词 ({}), 不建立评论全文索引, '
+                            '评论搜索将逐条匹配.'.format(error))
+            self.drop_fts()
+            return False
+
+        row = self.cursor.execute(
+            'SELECT sql FROM sqlite_master WHERE name = \'REPLY_FTS\'').fetchone()
+        if row is None or 'trigram' not in row[0]:
+            # 旧版本在不支持 trigram 时使用默认分词建立的索引无法匹配中文子串, 重建
+            self.drop_fts()
+            self.cursor.execute('''
+            CREATE VIRTUAL TABLE REPLY_FTS USING fts5(
+            message, content = 'REPLY', content_rowid = 'rpid', tokenize = 'trigram');''')
+            self.cursor.execute('INSERT INTO REPLY_FTS(REPLY_FTS) VALUES (\'rebuild\');')
+
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS REPLY_INSERT AFTER INSERT ON REPLY BEGIN
+            INSERT INTO REPLY_FTS(rowid, message) VALUES (new.rpid, new.message);
+        END;''')
+
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS REPLY_DELETE AFTER DELETE ON REPLY BEGIN
+            INSERT INTO REPLY_FTS(REPLY_FTS, rowid, message) VALUES ('delete', old.rpid, old.message);
+        END;''')
+
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS REPLY_UPDATE AFTER UPDATE ON REPLY BEGIN
+            INSERT INTO REPLY_FTS(REPLY_FTS, rowid, message) VALUES ('delete', old.rpid, old.message);
+            INSERT INTO REPLY_FTS(rowid, message) VALUES (new.rpid, new.message);
+        END;''')
+        return True
+
+    def drop_fts(self):
+        '''删除评论全文索引及其触发器'''
+        for name in ('REPLY_INSERT', 'REPLY_DELETE', 'REPLY_UPDATE'):
+            self.cursor.execute('DROP TRIGGER IF EXISTS {};'.format(name))
+        try:
+            self.cursor.execute('DROP TABLE IF EXISTS REPLY_FTS;')
+        except sqlite3.OperationalError:
+            # 没有 FTS5 模块时无法删除, 触发器已删除, 不影响写入
+            pass
+
+    def insert_replies(self, replies):
+        '''批量插入单条评论
+
+        replies:    评论 API 返回的 replies 列表
+        '''
+        # INSERT OR REPLACE 不触发删除触发器, 使用 UPSERT 保持全文索引同步
+        self.cursor.executemany('''INSERT INTO REPLY VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(rpid) DO UPDATE SET like = excluded.like,
+            message = excluded.message, spider = excluded.spider''', map(self.reply_row, replies))
+
+    def migrate_comments(self):
+        '''将旧版本 COMMENT 表中的 json 评论列表一次性转换为 REPLY 表中的单条评论
+
+        旧数据没有 rpid 等信息, 以 -(oid * 1000 + 序号) 作为 rpid, mid / like / ctime 为空
+        '''
+        now = int(time.time())
+        with self.transaction():
+            rows = self.cursor.execute('''SELECT oid, data, spider FROM COMMENT
+                WHERE oid NOT IN (SELECT DISTINCT oid FROM REPLY)''').fetchall()
+            for oid, data, spider in rows:
+                try:
+                    messages = json.loads(data)
+                except (TypeError, ValueError):
+                    continue
+                self.cursor.executemany(
+                    'INSERT OR IGNORE INTO REPLY VALUES (?, ?, NULL, NULL, NULL, ?, ?);',
+                    ((-(oid * 1000 + index), oid, message, spider)
+                     for index, message in enumerate(messages)))
+            self.set_meta('reply_migrated', now)
+
+    def search_replies(self, keyword, oid=None, limit=100):
+        '''按关键词搜索评论
+
+        keyword:    关键词, 三字以上且全文索引可用时使用全文索引, 否则逐条匹配
+        oid:        只搜索该视频的评论
+        limit:      返回数量上限
+        返回 (rpid, oid, mid, like, ctime, message) 列表
+        '''
+        if self.fts and len(keyword) >= 3:
+            sql = '''SELECT REPLY.rpid, oid, mid, like, ctime, REPLY.message FROM REPLY_FTS
+                JOIN REPLY ON REPLY.rpid = REPLY_FTS.rowid WHERE REPLY_FTS MATCH ?'''
+            params = ['"{}"'.format(keyword.replace('"', '""'))]
+        else:
+            sql = '''SELECT rpid, oid, mid, like, ctime, message FROM REPLY
+                WHERE instr(message, ?) > 0'''
+            params = [keyword]
+        if oid is not None:
+            sql += ' AND oid = ?'
+            params.append(oid)
+        sql += ' LIMIT ?'
+        params.append(limit)
+        return self.cursor.execute(sql, params).fetchall()
+
+    def count_replies(self, keyword=None):
+        '''统计每个视频的评论数
+
+        keyword:    只统计包含该关键词的评论
+        返回 (oid, 评论数) 列表, 按评论数降序
+        '''
+        if keyword is None:
+            return self.cursor.execute('''SELECT oid, COUNT() AS num FROM REPLY
+                GROUP BY oid ORDER BY num DESC''').fetchall()
+        if self.fts and len(keyword) >= 3:
+            return self.cursor.execute('''SELECT oid, COUNT() AS num FROM REPLY_FTS
+                JOIN REPLY ON REPLY.rpid = REPLY_FTS.rowid WHERE REPLY_FTS MATCH ?
+                GROUP BY oid ORDER BY num DESC''',
+                                       ('"{}"'.format(keyword.replace('"', '""')),)).fetchall()
+        return self.cursor.execute('''SELECT oid, COUNT() AS num FROM REPLY
+            WHERE instr(message, ?) > 0 GROUP BY oid ORDER BY num DESC''', (keyword,)).fetchall()
+
+    def insert_comment(self, comment):
+        '''插入评论数据
+
+        comment: 评论数据
+        '''
+        self.insert_comments([comment])
         self.update_db()
 
+    def insert_comments(self, comments):
+        '''批量插入评论数据, 完成评论任务
+
+        comments:   评论数据列表
+        '''
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO COMMENT VALUES (?, ?, ?);', map(self.comment_row, comments))
+        self.finish_tasks('comment', [comment['oid'] for comment in comments])
+
     def update_temp_pn(self, pn):
         '''更新爬取进度
 
@@ -172,17 +590,191 @@ class Database:
         else:
             return None
 
-    def get_video_pic_list(self):
-        '''获取未在本地缓存封面图片的视频列表'''
-        return self.cursor.execute('SELECT aid, pic FROM VIDEO WHERE localpic = 0').fetchall()
+    def init_regions(self, quotas, start_pn=1):
+        '''登记本次爬取的分区并更新配额, 新分区从 start_pn 开始
+
+        旧版本数据库只有 TEMP 表中单个分区的进度, 记为第一个分区的进度.
+
+        quotas:     {分区 rid: 视频数量上限}, 不限时为 None
+        start_pn:   新分区的起始页码
+        '''
+        with self.transaction():
+            if self.cursor.execute('SELECT 1 FROM REGION LIMIT 1').fetchone() is None:
+                pn = self.get_temp_pn()
+                if pn is not None:
+                    rid = next(iter(quotas))
+                    self.cursor.execute('INSERT INTO REGION VALUES (?, ?, NULL, ?);',
+                                        (rid, pn, self.count_videos()))
+                    self.cursor.execute('''UPDATE FRONTIER SET key = key + ?
+                        WHERE type = 'page' AND key < ?''', (page_key(rid, 0), PAGE_SPAN))
+            self.cursor.executemany('INSERT OR IGNORE INTO REGION VALUES (?, ?, NULL, 0);',
+                                    ((rid, start_pn) for rid in quotas))
+            self.cursor.executemany('UPDATE REGION SET quota = ? WHERE rid = ?',
+                                    ((quota, rid) for rid, quota in quotas.items()))
+
+    def get_regions(self, rids):
+        '''获取分区列表进度
+
+        rids:   分区 rid 列表
+        返回 {分区 rid: (下一页页码, 剩余配额)}, 配额不限时为 None
+        '''
+        regions = {}
+        for rid in rids:
+            data = self.cursor.execute(
+                'SELECT pn, quota, count FROM REGION WHERE rid = ?', (rid,)).fetchone()
+            if data:
+                regions[rid] = (data[0], None if data[1] is None else max(0, data[1] - data[2]))
+        return regions
+
+    def update_region(self, rid, pn, count):
+        '''记录分区列表进度
+
+        rid:    分区 rid
+        pn:     下一页页码, 不会使进度后退
+        count:  新放入任务表的视频数
+        '''
+        self.cursor.execute('UPDATE REGION SET pn = max(pn, ?), count = count + ? WHERE rid = ?',
+                            (pn, count, rid))
+
+    def has_table(self, name):
+        '''数据库中是否存在该表'''
+        return self.cursor.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?',
+                                   (name,)).fetchone() is not None
+
+    def get_meta(self, key):
+        '''读取元数据
+
+        key:    键
+        '''
+        data = self.cursor.execute('SELECT value FROM META WHERE key = ?', (key,)).fetchone()
+        return data[0] if data else None
+
+    def set_meta(self, key, value):
+        '''写入元数据
+
+        key:    键
+        value:  值
+        '''
+        self.cursor.execute('INSERT OR REPLACE INTO META VALUES (?, ?);', (key, value))
 
-    def get_user_face_list(self):
-        '''获取未在本地缓存头像图片的用户列表'''
-        return self.cursor.execute('SELECT mid, face FROM USER WHERE localpic = 0').fetchall()
+    def init_frontier(self):
+        '''根据已有数据一次性生成任务表, 用于从旧版本数据库恢复'''
+        now = int(time.time())
+        with self.transaction():
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO FRONTIER(type, key, state, payload, updated) SELECT \'video_pic\', aid, 0, pic, ? FROM VIDEO WHERE localpic = 0', (now,))
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO FRONTIER(type, key, state, payload, updated) SELECT \'user_pic\', mid, 0, face, ? FROM USER WHERE localpic = 0', (now,))
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO FRONTIER(type, key, state, payload, updated) SELECT \'comment\', aid, 0, NULL, ? FROM VIDEO WHERE aid NOT IN (SELECT oid FROM COMMENT)', (now,))
+            self.add_tasks('video', [(data[0], [data[1], data[2]])
+                                     for data in self.get_broken_user_list()])
+            self.set_meta('frontier', now)
 
-    def get_comment_list(self):
-        '''获取未爬取评论的视频列表'''
-        return self.cursor.execute('SELECT aid from VIDEO WHERE aid NOT IN (SELECT oid FROM COMMENT)').fetchall()
+    def add_tasks(self, type, tasks, state=PENDING, reset=False):
+        '''添加任务, 已存在的任务默认保持原状态
+
+        type:   任务类型
+        tasks:  (key, payload) 列表, payload 非字符串时以 json 存储
+        state:  新任务的状态, 为已领取时归属本节点
+        reset:  是否将已完成的同名任务重新置为待处理
+        '''
+        now = int(time.time())
+        owner, expire = self.claim_info(now) if state == CLAIMED else (None, None)
+        rows = [(type, key, state, payload if payload is None or isinstance(payload, str)
+                 else json.dumps(payload), now, owner, expire) for key, payload in tasks]
+        if reset:
+            self.cursor.executemany('''INSERT INTO FRONTIER VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(type, key) DO UPDATE SET state = excluded.state,
+                payload = excluded.payload, updated = excluded.updated
+                WHERE state = 2''', rows)
+        else:
+            self.cursor.executemany(
+                'INSERT OR IGNORE INTO FRONTIER VALUES (?, ?, ?, ?, ?, ?, ?);', rows)
+
+    def claim_info(self, now):
+        '''本节点领取任务时记录的 (节点名称, 租约到期时间)'''
+        return self.owner, now + self.lease if self.lease else None
+
+    def claim_tasks(self, type, limit):
+        '''领取至多 limit 个待处理或租约已过期的任务并标记为已领取
+
+        type:   任务类型
+        limit:  领取数量上限
+        返回 (key, payload) 列表
+        '''
+        now = int(time.time())
+        with self.transaction(immediate=True):
+            tasks = self.cursor.execute('''SELECT key, payload FROM FRONTIER WHERE type = ?
+                AND (state = 0 OR (state = 1 AND expire < ?)) LIMIT ?''',
+                                        (type, now, limit)).fetchall()
+            self.cursor.executemany(
+                'UPDATE FRONTIER SET state = 1, updated = ?, owner = ?, expire = ? WHERE type = ? AND key = ?',
+                ((now, *self.claim_info(now), type, task[0]) for task in tasks))
+        return tasks
+
+    def claim_page(self, rid):
+        '''领取分区的一页视频列表, 优先领取租约已过期的页, 否则推进共享的列表进度
+
+        rid:    分区 rid
+        返回页码, 分区配额已用尽时返回 None
+        '''
+        now = int(time.time())
+        with self.transaction(immediate=True):
+            data = self.cursor.execute('''SELECT key FROM FRONTIER WHERE type = 'page'
+                AND key BETWEEN ? AND ? AND (state = 0 OR (state = 1 AND expire < ?)) LIMIT 1''',
+                                       (page_key(rid, 0), page_key(rid + 1, -1), now)).fetchone()
+            if data:
+                pn = data[0] - page_key(rid, 0)
+            else:
+                pn, quota, count = self.cursor.execute(
+                    'SELECT pn, quota, count FROM REGION WHERE rid = ?', (rid,)).fetchone()
+                # REGION.count 在列表页写入后才更新, 已领取未完成的页按每页 50 个视频预占配额
+                claimed = self.cursor.execute('''SELECT COUNT() FROM FRONTIER WHERE type = 'page'
+                    AND key BETWEEN ? AND ? AND state = 1''',
+                                              (page_key(rid, 0), page_key(rid + 1, -1))).fetchone()[0]
+                if quota is not None and count + 50 * claimed >= quota:
+                    return None
+                self.cursor.execute('UPDATE REGION SET pn = pn + 1 WHERE rid = ?', (rid,))
+            self.cursor.execute('INSERT OR REPLACE INTO FRONTIER VALUES (?, ?, ?, ?, ?, ?, ?);',
+                                ('page', page_key(rid, pn), CLAIMED, None, now, *self.claim_info(now)))
+        return pn
+
+    def renew_leases(self):
+        '''延长本节点已领取任务的租约'''
+        now = int(time.time())
+        self.cursor.execute('UPDATE FRONTIER SET expire = ? WHERE owner = ? AND state = 1',
+                            (now + self.lease, self.owner))
+        self.conn.commit()
+
+    def finish_tasks(self, type, keys):
+        '''标记任务完成
+
+        type:   任务类型
+        keys:   任务键列表
+        '''
+        now = int(time.time())
+        self.cursor.executemany(
+            'UPDATE FRONTIER SET state = 2, updated = ? WHERE type = ? AND key = ?',
+            ((now, type, key) for key in keys))
+
+    def reset_claims(self):
+        '''将已领取但未完成的任务恢复为待处理, 用于上次运行中断后恢复
+
+        使用租约时其他节点的任务由租约过期回收, 只恢复本节点的任务
+        '''
+        if self.lease:
+            self.cursor.execute(
+                'UPDATE FRONTIER SET state = 0 WHERE state = 1 AND owner = ?', (self.owner,))
+        else:
+            self.cursor.execute('UPDATE FRONTIER SET state = 0 WHERE state = 1')
+        self.conn.commit()
+
+    def has_pending_tasks(self):
+        '''是否还有待处理或租约已过期的任务, 不含由列表爬虫领取的列表页'''
+        return self.cursor.execute('''SELECT 1 FROM FRONTIER WHERE type != 'page'
+            AND (state = 0 OR (state = 1 AND expire < ?)) LIMIT 1''',
+                                   (int(time.time()),)).fetchone() is not None
 
     def get_broken_user_list(self):
         '''获取未爬取用户的视频列表'''
@@ -193,8 +785,7 @@ class Database:
 
         aid:    视频 av 号
         '''
-        self.cursor.execute(
-            'UPDATE VIDEO SET localpic = 1 WHERE aid = ?', (aid,))
+        self.update_video_pics([aid])
         self.update_db()
 
     def update_user_pic(self, mid):
@@ -202,10 +793,117 @@ class Database:
 
         mid:    用户 uid
         '''
-        self.cursor.execute(
-            'UPDATE USER SET localpic = 1 WHERE mid = ?', (mid,))
+        self.update_user_pics([mid])
         self.update_db()
 
+    def update_video_pics(self, aids):
+        '''批量更新视频封面爬取标识, 完成封面任务
+
+        aids:   视频 av 号列表
+        '''
+        self.cursor.executemany(
+            'UPDATE VIDEO SET localpic = 1 WHERE aid = ?', ((aid,) for aid in aids))
+        self.finish_tasks('video_pic', aids)
+
+    def update_user_pics(self, mids):
+        '''批量更新用户头像爬取标识, 完成头像任务
+
+        mids:   用户 uid 列表
+        '''
+        self.cursor.executemany(
+            'UPDATE USER SET localpic = 1 WHERE mid = ?', ((mid,) for mid in mids))
+        self.finish_tasks('user_pic', mids)
+
+    @staticmethod
+    def stat_row(stat):
+        return (
+            stat['aid'],
+            stat['time'],
+            stat['view'],
+            stat['danmaku'],
+            stat['like'],
+            stat['coin'],
+            stat['favorite'],
+            stat['share'],
+            stat['reply']
+        )
+
+    def insert_stats(self, stats):
+        '''批量追加视频数据记录, 并将 VIDEO 表中的数据更新为最新值
+
+        stats:  视频数据列表, 含 aid, time 与各项数据
+        '''
+        rows = list(map(self.stat_row, stats))
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO VIDEO_STAT VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);', rows)
+        self.cursor.executemany('''UPDATE VIDEO SET view = ?, danmaku = ?, like = ?, coin = ?,
+            favorite = ?, share = ?, reply = ? WHERE aid = ?''', (row[2:] + row[:1] for row in rows))
+        self.record_refresh([(stat['aid'], 0) for stat in stats])
+
+    def record_refresh(self, results):
+        '''记录刷新结果, 失败的视频与成功的一样按刷新间隔再次尝试
+
+        results:    (aid, 响应 code) 列表, 成功为 0
+        '''
+        now = int(time.time())
+        self.cursor.executemany('INSERT OR REPLACE INTO VIDEO_REFRESH VALUES (?, ?, ?);',
+                                ((aid, now, code) for aid, code in results))
+
+    def get_stale_videos(self, limit, ratio=0.1, min_interval=3600, max_interval=2592000):
+        '''按过期程度获取需要刷新数据的视频
+
+        刷新间隔为视频发布时长的 ratio 倍, 限制在 [min_interval, max_interval] 秒内,
+        新发布的视频刷新频繁, 旧视频很少刷新. 距上次获取或尝试刷新超过刷新间隔的视频按 超出倍数 降序返回.
+
+        limit:          返回数量上限
+        ratio:          刷新间隔与发布时长之比
+        min_interval:   最短刷新间隔 (秒)
+        max_interval:   最长刷新间隔 (秒)
+        返回 aid 列表
+        '''
+        now = int(time.time())
+        return [row[0] for row in self.cursor.execute('''
+            SELECT aid, (? - last) * 1.0 / max(?, min(?, (? - pubdate) * ?)) AS stale FROM (
+                SELECT VIDEO.aid, VIDEO.pubdate,
+                    max(VIDEO.spider, COALESCE(MAX(VIDEO_STAT.time), 0),
+                        COALESCE(VIDEO_REFRESH.time, 0)) AS last
+                FROM VIDEO LEFT JOIN VIDEO_STAT ON VIDEO_STAT.aid = VIDEO.aid
+                LEFT JOIN VIDEO_REFRESH ON VIDEO_REFRESH.aid = VIDEO.aid
+                GROUP BY VIDEO.aid)
+            WHERE stale >= 1 ORDER BY stale DESC LIMIT ?''',
+            (now, min_interval, max_interval, now, ratio, limit))]
+
+    def insert_image(self, url, digest):
+        '''插入图片索引
+
+        url:    图片地址
+        digest: 内容哈希
+        '''
+        self.insert_images([(url, digest)])
+        self.update_db()
+
+    def insert_images(self, images):
+        '''批量插入图片索引
+
+        images: (图片地址, 内容哈希) 列表
+        '''
+        now = int(time.time())
+        self.cursor.executemany('INSERT OR REPLACE INTO IMAGE VALUES (?, ?, ?);',
+                                ((url, digest, now) for url, digest in images))
+
+    def get_images(self):
+        '''获取全部图片索引'''
+        return self.cursor.execute('SELECT url, hash FROM IMAGE').fetchall()
+
+    def get_video_ids(self):
+        '''获取已有视频与视频任务的 aid'''
+        return (row[0] for row in self.cursor.execute(
+            'SELECT aid FROM VIDEO UNION SELECT key FROM FRONTIER WHERE type = \'video\'').fetchall())
+
+    def get_user_ids(self):
+        '''获取已有用户的 mid'''
+        return (row[0] for row in self.cursor.execute('SELECT mid FROM USER').fetchall())
+
     def count_videos(self):
         '''获取数据库中视频总数'''
         try:
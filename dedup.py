@@ -0,0 +1,86 @@
+'''已知编号去重
+
+启动时从数据库载入已有的视频 aid 与用户 mid, 视频列表中已知的视频不再放入任务队列,
+已知的用户不再重复写入数据库与添加头像任务.
+
+Class:
+    IntSet:     紧凑整数集合
+    NullSet:    不记录任何整数的集合
+    Seen:       已知的视频与用户
+'''
+
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+
+class IntSet:
+    '''紧凑整数集合, 线程安全
+
+    已合并的整数以有序 array 存储, 每个只占 8 字节; 新加入的整数先放在 set 中,
+    数量超过已合并部分的 1/4 (至少 merge_size) 时合并, 合并的总代价与排序相当.
+
+    values:     初始整数
+    merge_size: 触发合并的最少新增数量
+    '''
+
+    def __init__(self, values=(), merge_size=65536):
+        self.sorted = array('q', sorted(set(values)))
+        self.pending = set()
+        self.merge_size = merge_size
+        self.lock = threading.Lock()
+
+    def __contains__(self, value):
+        with self.lock:
+            return self.find(value)
+
+    def __len__(self):
+        return len(self.sorted) + len(self.pending)
+
+    def find(self, value):
+        if value in self.pending:
+            return True
+        index = bisect_left(self.sorted, value)
+        return index < len(self.sorted) and self.sorted[index] == value
+
+    def add(self, value):
+        '''加入整数, 返回是否为新加入'''
+        with self.lock:
+            if self.find(value):
+                return False
+            self.pending.add(value)
+            if len(self.pending) >= max(self.merge_size, len(self.sorted) // 4):
+                self.sorted = array('q', sorted(chain(self.sorted, self.pending)))
+                self.pending.clear()
+            return True
+
+
+class NullSet:
+    '''不记录任何整数的集合, 关闭去重时使用'''
+
+    def __contains__(self, value):
+        return False
+
+    def __len__(self):
+        return 0
+
+    def add(self, value):
+        '''总是返回为新加入'''
+        return True
+
+
+class Seen:
+    '''已知的视频与用户
+
+    db:         数据库, 从中载入已有视频 (含任务表中的视频任务) 与用户; 为 None 时为空
+    enabled:    是否去重, 为 False 时不载入也不记录, 所有编号都视为新出现
+    '''
+
+    def __init__(self, db=None, enabled=True):
+        if not enabled:
+            self.videos = NullSet()
+            self.users = NullSet()
+            return
+        self.videos = IntSet(db.get_video_ids() if db else ())
+        self.users = IntSet(db.get_user_ids() if db else ())
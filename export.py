@@ -0,0 +1,133 @@
+'''列式导出
+
+将数据库中的 VIDEO / USER / REPLY 表增量导出到 data/columns/ 下的列式存储 (见 columnar.py),
+每次只追加 spider 时间晚于上次导出的行, 以及此后被 refresh.py 更新数据的视频,
+分析程序可通过内存映射只读取需要的列.
+同一视频等被重新爬取或刷新后会再次导出, 读取时以 Table.latest 只保留最后一次. 在仓库根目录运行:
+
+    python export.py
+    python export.py --tables VIDEO USER
+'''
+
+import argparse
+import configparser
+import logging
+import os
+import sqlite3
+import time
+
+import columnar
+
+logging.basicConfig(level=logging.INFO)
+
+# 表名 -> [(列名, 类型)]
+SCHEMAS = {
+    'VIDEO': [
+        ('aid', 'int64'),
+        ('bvid', 'string'),
+        ('cid', 'int64'),
+        ('pic', 'string'),
+        ('title', 'string'),
+        ('desc', 'string'),
+        ('keywords', 'string'),
+        ('copyright', 'int8'),
+        ('duration', 'int32'),
+        ('videos', 'int32'),
+        ('pubdate', 'int64'),
+        ('view', 'int64'),
+        ('danmaku', 'int64'),
+        ('like', 'int64'),
+        ('coin', 'int64'),
+        ('favorite', 'int64'),
+        ('share', 'int64'),
+        ('reply', 'int64'),
+        ('owner', 'int64'),
+        ('spider', 'int64')
+    ],
+    'USER': [
+        ('mid', 'int64'),
+        ('name', 'string'),
+        ('sex', 'dict'),
+        ('face', 'string'),
+        ('sign', 'string'),
+        ('level', 'int8'),
+        ('attention', 'int32'),
+        ('fans', 'int64'),
+        ('spider', 'int64')
+    ],
+    'REPLY': [
+        ('rpid', 'int64'),
+        ('oid', 'int64'),
+        ('mid', 'int64'),
+        ('like', 'int64'),
+        ('ctime', 'int64'),
+        ('message', 'string'),
+        ('spider', 'int64')
+    ]
+}
+
+# 表名 -> (记录更新时间的表, 选出在 (上次导出, cutoff) 时间内被更新的行的条件),
+# 用于不改变 spider 时间的更新
+TOUCHED = {
+    'VIDEO': ('VIDEO_REFRESH', '''aid IN (SELECT aid FROM VIDEO_REFRESH
+        WHERE code = 0 AND time > ? AND time < ?)''')
+}
+
+
+def export_table(conn, table, root, delay=60, chunk_size=65536):
+    '''增量导出一个表
+
+    conn:       数据库连接
+    table:      表名
+    root:       列式存储目录
+    delay:      只导出 spider 时间或更新时间早于当前时间 delay 秒的行, 避免遗漏尚未提交的写入,
+                应大于爬虫的提交间隔 ([database] flush_interval)
+    chunk_size: 每次读取的行数
+    返回导出的行数
+    '''
+    schema = SCHEMAS[table]
+    writer = columnar.Writer(os.path.join(root, table), schema)
+    last = writer.meta['last']
+    cutoff = int(time.time()) - delay
+    sql = 'SELECT {} FROM {} WHERE (spider > ? AND spider < ?)'.format(
+        ', '.join('"{}"'.format(name) for name, _ in schema), table)
+    params = [last, cutoff]
+    if table in TOUCHED and conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+                                         (TOUCHED[table][0],)).fetchone():
+        sql += ' OR ' + TOUCHED[table][1]
+        params += [last, cutoff]
+    cursor = conn.execute(sql, params)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        writer.append(rows)
+        count += len(rows)
+    # spider 时间或更新时间早于 cutoff 的行均已导出
+    writer.commit(max(last, cutoff - 1))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='将数据库增量导出为列式存储')
+    parser.add_argument('--tables', nargs='+', default=list(SCHEMAS), choices=list(SCHEMAS),
+                        help='导出的表')
+    parser.add_argument('--root', default='data/columns', help='列式存储目录')
+    parser.add_argument('--delay', type=int, default=60, help='只导出 spider 时间早于当前时间该秒数的行')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini', encoding='utf-8')
+    db_name = config.get('common', 'database_name', fallback='data')
+
+    conn = sqlite3.connect('data/' + db_name + '.sqlite3')
+    for table in args.tables:
+        st = time.time()
+        count = export_table(conn, table, args.root, args.delay)
+        logging.warning('已导出 {}: {} 行, 用时 {:.1f} 秒.'.format(table, count, time.time() - st))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
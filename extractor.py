@@ -0,0 +1,108 @@
+'''视频页面信息提取
+
+在页面字节串上线性查找 title / keywords 两个 <meta> 标签与 __INITIAL_STATE__ JSON,
+不构建 DOM. 页面结构变化导致快速路径失败时回退至 正则 + BeautifulSoup 的解析方式.
+
+Method:
+    parse_video_page:   提取视频页面的 __INITIAL_STATE__, 标题与关键词
+    parse_video:        解析视频页面, 得到写入数据库的视频与用户数据
+'''
+
+import html
+import json
+import logging
+import re
+
+from bs4 import BeautifulSoup
+
+STATE_MARK = b'window.__INITIAL_STATE__='
+META_RE = re.compile(rb'<meta\s[^>]*>', re.IGNORECASE)
+ATTR_RE = re.compile(rb'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+DECODER = json.JSONDecoder()
+
+
+def parse_meta(content, names):
+    '''在 <head> 中查找指定 name 的 <meta> 标签, 返回 {name: content}
+
+    content:    页面字节串
+    names:      需要的 name 集合
+    '''
+    result = {}
+    end = content.find(b'</head>')
+    for match in META_RE.finditer(content, 0, end if end >= 0 else len(content)):
+        attrs = {}
+        for attr in ATTR_RE.finditer(match.group(0)):
+            value = attr.group(2) if attr.group(2) is not None else attr.group(3)
+            attrs[attr.group(1).lower()] = value
+        name = attrs.get(b'name', b'').decode('utf-8', 'replace')
+        if name in names and b'content' in attrs:
+            result[name] = html.unescape(attrs[b'content'].decode('utf-8'))
+            if len(result) == len(names):
+                break
+    return result
+
+
+def parse_state(content):
+    '''解析 __INITIAL_STATE__ 对象, 只解码对应的 <script> 片段
+
+    content:    页面字节串
+    '''
+    st = content.find(STATE_MARK)
+    if st < 0:
+        return None
+    st += len(STATE_MARK)
+    ed = content.find(b'</script>', st)
+    if ed < 0:
+        ed = len(content)
+    data, _ = DECODER.raw_decode(content[st:ed].decode('utf-8').lstrip())
+    return data
+
+
+def parse_video_page_fast(content):
+    meta = parse_meta(content, ('title', 'keywords'))
+    state = parse_state(content)
+    if state is None or 'title' not in meta or 'keywords' not in meta:
+        raise ValueError('页面结构不符')
+    return state, meta['title'], meta['keywords']
+
+
+def parse_video_page_soup(text):
+    json_string = re.search(
+        '<script>window.__INITIAL_STATE__=({.*});', text).group(1)
+    json_data = json.loads(json_string)
+    soup = BeautifulSoup(text, 'html.parser')
+    title = soup.find('meta', attrs={'name': 'title'})['content']
+    keywords = soup.find('meta', attrs={'name': 'keywords'})['content']
+    return json_data, title, keywords
+
+
+def parse_video_page(content):
+    '''提取视频页面的 __INITIAL_STATE__, 标题与关键词
+
+    content:    页面字节串
+    返回 (__INITIAL_STATE__ 对象, 标题, 关键词), 页面格式错误时抛出 AttributeError
+    '''
+    try:
+        return parse_video_page_fast(content)
+    except ValueError:
+        logging.debug('快速解析失败, 回退至完整解析.')
+    try:
+        return parse_video_page_soup(content.decode('utf-8', 'replace'))
+    except (TypeError, ValueError):
+        raise AttributeError('页面格式错误')
+
+
+def parse_video(content, video):
+    '''解析视频页面, 得到写入数据库的视频与用户数据
+
+    content:    页面字节串
+    video:      已知的视频数据 (aid, bvid, cid, url), 以页面中的数据补充
+    返回 (视频数据, 用户数据), 视频已被删除时返回 None; 页面格式错误时抛出 AttributeError
+    '''
+    json_data, title, keywords = parse_video_page(content)
+    if not json_data['videoData']['stat']:
+        return None
+    video['title'] = title
+    video['keywords'] = keywords
+    video.update(json_data['videoData'])
+    return video, json_data['upData']
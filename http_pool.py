@@ -0,0 +1,153 @@
+'''HTTP 连接池
+
+按 (域名, 代理) 复用 requests.Session, 保持 keep-alive 连接,
+避免每个请求都重新进行 TCP 与 TLS 握手. Session 由各线程共享, 不保存 Cookie,
+每个请求与单独调用 requests.get 一样不带状态.
+
+Class:
+    SessionPool:    Session 池
+'''
+
+import http.cookiejar
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    '''Session 池, 线程安全
+
+    pool_size:      每个 Session 对同一主机保持的最大连接数
+    keep_alive:     是否保持连接, 为 False 时每个请求后关闭连接
+    idle_timeout:   Session 空闲超过该时间 (秒) 后关闭并释放连接
+    '''
+
+    def __init__(self, pool_size=10, keep_alive=True, idle_timeout=60):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        # (域名, 代理) -> [Session, 最近使用时间, 使用中的请求数]
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.last_evict = time.time()
+        # 已关闭 Session 的统计
+        self.closed_requests = 0
+        self.closed_connections = 0
+
+    def new_session(self):
+        session = requests.Session()
+        # 拒绝所有 Cookie, 避免服务器下发的 buvid 等在线程间共享
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size,
+                              pool_block=False, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @contextmanager
+    def lease(self, url, proxy=None):
+        '''借出对应 (域名, 代理) 的 Session
+
+        url:    请求 URL
+        proxy:  代理服务器地址
+        '''
+        parts = urlsplit(url)
+        key = ('{}://{}'.format(parts.scheme, parts.netloc), proxy)
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is None:
+                entry = self.sessions[key] = [self.new_session(), 0, 0]
+            entry[1] = time.time()
+            entry[2] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[1] = time.time()
+                entry[2] -= 1
+            if time.time() - self.last_evict > self.idle_timeout / 2:
+                self.evict()
+
+    def get(self, url, proxy=None, **kwargs):
+        '''通过连接池发送 GET 请求, 参数同 requests.get
+
+        url:    请求 URL
+        proxy:  代理服务器地址, 为空则直连
+        '''
+        if proxy:
+            kwargs['proxies'] = {
+                'http': 'http://{}'.format(proxy), 'https': 'https://{}'.format(proxy)}
+        with self.lease(url, proxy) as session:
+            return session.get(url, **kwargs)
+
+    def evict(self):
+        '''关闭空闲超时的 Session'''
+        now = time.time()
+        closed = []
+        with self.lock:
+            self.last_evict = now
+            for key, entry in list(self.sessions.items()):
+                if entry[2] == 0 and now - entry[1] > self.idle_timeout:
+                    del self.sessions[key]
+                    closed.append(entry[0])
+        for session in closed:
+            requests_num, connections_num = self.session_stats(session)
+            with self.lock:
+                self.closed_requests += requests_num
+                self.closed_connections += connections_num
+            session.close()
+        if closed:
+            logging.debug('关闭 {} 个空闲 Session.'.format(len(closed)))
+
+    @staticmethod
+    def session_stats(session):
+        '''统计 Session 中各 urllib3 连接池的请求数与新建连接数'''
+        requests_num = 0
+        connections_num = 0
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_num += pool.num_requests
+                    connections_num += pool.num_connections
+        return requests_num, connections_num
+
+    def stats(self):
+        '''连接池统计
+
+        返回 dict: sessions 当前 Session 数, requests 请求数,
+        connections 新建连接数, reused 复用连接的请求数
+        '''
+        with self.lock:
+            sessions = [entry[0] for entry in self.sessions.values()]
+            requests_num = self.closed_requests
+            connections_num = self.closed_connections
+        for session in sessions:
+            r, c = self.session_stats(session)
+            requests_num += r
+            connections_num += c
+        return {
+            'sessions': len(sessions),
+            'requests': requests_num,
+            'connections': connections_num,
+            'reused': requests_num - connections_num
+        }
+
+    def close(self):
+        '''关闭全部 Session'''
+        with self.lock:
+            sessions = [entry[0] for entry in self.sessions.values()]
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
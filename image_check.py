@@ -0,0 +1,151 @@
+'''图片完整性校验
+
+下载线程只做代价很小的内联检查 (文件头标识, 声明长度, 结束标记),
+PIL 完整校验放到独立的进程池中进行, 不占用下载线程与 GIL.
+内联检查不认识的格式 (如 BMP, TIFF, ICO) 只由 PIL 完整校验.
+
+Class:
+    ImageVerifier:  完整校验进程池
+
+Method:
+    quick_check:    内联快速检查
+    full_check:     PIL 完整校验
+    digest_check:   内容哈希与 PIL 完整校验
+'''
+
+import hashlib
+import io
+import logging
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'IEND\xaeB`\x82'
+
+
+def quick_check(content):
+    '''检查图片文件头与结束标记, 识别截断的 JPEG / PNG / GIF / WEBP
+
+    content:    图片内容
+    返回是否完整, 不认识的格式返回 None, 由 full_check 判断
+    '''
+    if content.startswith(b'\xff\xd8\xff'):
+        # JPEG 以 FFD9 结束, 部分文件末尾带有少量填充
+        return content.find(b'\xff\xd9', max(0, len(content) - 32)) >= 0
+    if content.startswith(PNG_MAGIC):
+        return content.find(PNG_END, max(0, len(content) - 32)) >= 0
+    if content.startswith((b'GIF87a', b'GIF89a')):
+        return content.rstrip(b'\x00').endswith(b'\x3b')
+    if content.startswith(b'RIFF') and content[8:12] == b'WEBP':
+        # RIFF 头中声明的长度不含开头 8 字节
+        return struct.unpack('<I', content[4:8])[0] + 8 <= len(content)
+    return None
+
+
+def full_check(content):
+    '''使用 PIL 完整校验图片, 在进程池中运行
+
+    content:    图片内容
+    '''
+    try:
+        Image.open(io.BytesIO(content)).verify()
+        return True
+    except Exception:
+        return False
+
+
+def digest_check(item):
+    '''校验已存储图片的内容哈希与完整性, 在进程池中运行
+
+    item:   (内容哈希, 图片内容), 内容哈希为 None 时只进行完整校验
+    '''
+    digest, content = item
+    if digest is not None and hashlib.sha256(content).hexdigest() != digest:
+        return False
+    return full_check(content)
+
+
+class ImageVerifier:
+    '''完整校验进程池, 线程安全
+
+    进程池中的进程异常退出 (如被 OOM killer 结束) 后, 改为在调用线程中校验,
+    多线程状态下不重新 fork 进程.
+
+    workers:    进程数, 为 0 时不进行完整校验
+    '''
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.pool = None
+        self.broken = False
+        self.pending = 0
+        self.lock = threading.Lock()
+        if workers > 0:
+            self.pool = ProcessPoolExecutor(workers)
+            # 预先启动全部进程, 应在启动其他线程前创建, 避免多线程状态下 fork
+            for future in [self.pool.submit(full_check, b'') for i in range(workers)]:
+                future.result()
+
+    def submit(self, content, callback):
+        '''提交校验, 完成后在进程池的管理线程中调用 callback(是否完整)
+
+        content:    图片内容
+        callback:   回调函数
+        '''
+        if self.pool is None:
+            callback(True)
+            return
+        with self.lock:
+            self.pending += 1
+
+        def done(future):
+            try:
+                ok = future.result()
+            except BrokenProcessPool:
+                # 校验中的图片记为失败并重新下载, 之后的图片在调用线程中校验
+                self.set_broken()
+                ok = False
+            except Exception:
+                ok = False
+            try:
+                callback(ok)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+
+        if not self.broken:
+            try:
+                self.pool.submit(full_check, content).add_done_callback(done)
+                return
+            except BrokenProcessPool:
+                self.set_broken()
+            except BaseException:
+                with self.lock:
+                    self.pending -= 1
+                raise
+        try:
+            callback(full_check(content))
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def set_broken(self):
+        '''记录进程池已不可用'''
+        with self.lock:
+            if self.broken:
+                return
+            self.broken = True
+        logging.error('图片校验进程异常退出, 改为在爬取线程中校验.')
+
+    def size(self):
+        '''校验中的图片数'''
+        return self.pending
+
+    def close(self):
+        '''等待已提交的校验完成并关闭进程池'''
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
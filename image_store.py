@@ -0,0 +1,363 @@
+'''图片内容寻址存储
+
+图片按内容哈希只存储一份于 data/blob/{哈希前两位}/{哈希}, 原有的
+data/video_pic/{aid}.{ext} 与 data/user_face/{uid}.{ext} 以硬链接形式保留.
+维护 图片地址 -> 哈希 的索引, 已下载过的地址不再重复请求,
+同一地址的并发下载只会实际请求一次. 新下载的图片在完整校验通过后才记入索引.
+
+可选的 PackStore 将图片追加写入 data/pack/ 下的分段文件, 每段附带
+记录 (哈希, 偏移, 长度) 的索引文件, 通过 mmap 随机读取, 不再产生大量小文件.
+
+Class:
+    ImageStore:     图片存储
+    PackStore:      分段文件图片存储
+
+Method:
+    open_store:     按存储方式创建图片存储
+
+在仓库根目录运行 python image_store.py compact 可整理分段文件, 去除不再被引用的图片.
+'''
+
+import argparse
+import configparser
+import hashlib
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+
+
+class ImageStore:
+    '''图片存储, 线程安全
+
+    root:   数据目录
+    '''
+
+    def __init__(self, root='data'):
+        self.root = root
+        # 图片地址 -> 哈希
+        self.index = {}
+        # 正在下载的图片地址 -> threading.Event
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        '''载入数据库中的索引
+
+        rows:   (图片地址, 哈希) 列表
+        '''
+        with self.lock:
+            self.index.update(rows)
+
+    def lookup(self, url):
+        '''查询已下载图片的哈希, 未下载时返回 None'''
+        return self.index.get(url)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'blob', digest[:2], digest)
+
+    def put(self, url, content):
+        '''存储图片内容并记录索引, 相同内容只写入一次
+
+        url:        图片地址
+        content:    图片内容
+        返回内容哈希
+        '''
+        digest = hashlib.sha256(content).hexdigest()
+        self.write(digest, content)
+        with self.lock:
+            self.index[url] = digest
+        return digest
+
+    def write(self, digest, content):
+        '''写入图片内容, 已存在时跳过'''
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(temp, 'wb') as f:
+                f.write(content)
+            os.replace(temp, path)
+
+    def read(self, digest):
+        '''读取图片内容, 不存在时返回 None
+
+        digest: 内容哈希
+        '''
+        try:
+            with open(self.blob_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def remove(self, digest):
+        '''删除已损坏的图片内容, 之后相同哈希的内容可重新写入'''
+        try:
+            os.remove(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        pass
+
+    def fetch(self, url, download):
+        '''获取图片, 已下载过的地址直接返回, 同一地址的并发请求只下载一次
+
+        新下载的图片只写入内容, 不记入索引, 需在完整校验后调用 settle;
+        在此之前同一地址的其他请求一直等待, 不会得到未经校验的内容.
+
+        url:        图片地址
+        download:   下载函数, 参数为图片地址, 返回图片内容, 失败时抛出异常
+        返回 (内容哈希, 是否为新下载)
+        '''
+        while True:
+            with self.lock:
+                digest = self.index.get(url)
+                if digest is not None:
+                    return digest, False
+                event = self.inflight.get(url)
+                if event is None:
+                    event = self.inflight[url] = threading.Event()
+                    break
+            # 其他线程正在下载或校验, 等待其完成后重新查询, 失败时由本线程接手
+            event.wait()
+        try:
+            content = download(url)
+            digest = hashlib.sha256(content).hexdigest()
+            self.write(digest, content)
+        except:
+            self.release(url)
+            raise
+        return digest, True
+
+    def settle(self, url, digest, ok):
+        '''新下载的图片校验完成, 通过时记入索引, 否则删除内容; 之后唤醒等待该地址的请求
+
+        url:    图片地址
+        digest: 内容哈希
+        ok:     是否通过校验
+        '''
+        if ok:
+            with self.lock:
+                self.index[url] = digest
+        else:
+            # 相同哈希的内容相同, 不会有其他地址引用通过校验的同一内容
+            self.remove(digest)
+        self.release(url)
+
+    def release(self, url):
+        '''结束地址的下载, 唤醒等待的请求'''
+        with self.lock:
+            event = self.inflight.pop(url)
+        event.set()
+
+    def link(self, folder, name, url, digest):
+        '''以 data/{folder}/{name}.{ext} 的名字链接到图片内容
+
+        folder: video_pic 或 user_face
+        name:   视频 aid 或用户 mid
+        url:    图片地址, 用于确定扩展名
+        digest: 内容哈希
+        '''
+        path = os.path.join(self.root, folder, '{}.{}'.format(name, url.split('.')[-1]))
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(self.blob_path(digest), path)
+        except OSError:
+            # 文件系统不支持硬链接时复制
+            shutil.copyfile(self.blob_path(digest), path)
+
+
+class PackStore(ImageStore):
+    '''分段文件图片存储, 线程安全
+
+    每段为 data/pack/{序号}.pack, 写满 segment_size 字节后新开一段.
+    段内每条记录为 记录头 (标识, 哈希, 长度) + 图片内容, 对应的 {序号}.idx
+    中每条记录为 (哈希, 内容偏移, 长度). 图片只以哈希寻址, 不再生成按 aid/uid 命名的文件.
+
+    root:           数据目录
+    segment_size:   单个分段文件大小上限 (字节)
+    '''
+    MAGIC = b'BPK1'
+    HEADER = struct.Struct('<4s32sQ')
+    ENTRY = struct.Struct('<32sQQ')
+
+    def __init__(self, root='data', segment_size=256 * 1024 * 1024):
+        ImageStore.__init__(self, root)
+        self.folder = os.path.join(root, 'pack')
+        os.makedirs(self.folder, exist_ok=True)
+        self.segment_size = segment_size
+        # 哈希 -> (段序号, 内容偏移, 长度)
+        self.locations = {}
+        # 段序号 -> mmap
+        self.maps = {}
+        self.write_lock = threading.Lock()
+        segments = self.segments()
+        for segment in segments:
+            self.load_segment(segment)
+        self.open_segment(segments[-1] if segments else 0)
+
+    def segments(self):
+        '''已有的段序号列表'''
+        return sorted(int(name.split('.')[0]) for name in os.listdir(self.folder)
+                      if name.endswith('.pack'))
+
+    def segment_path(self, segment, ext='pack'):
+        return os.path.join(self.folder, '{:06d}.{}'.format(segment, ext))
+
+    def load_segment(self, segment):
+        '''读取段索引, 截断写入中断的不完整记录'''
+        path = self.segment_path(segment, 'idx')
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        end = len(data) - len(data) % self.ENTRY.size
+        for raw, offset, size in self.ENTRY.iter_unpack(data[:end]):
+            # 长度为 0 的记录表示内容已删除
+            if size:
+                self.locations[raw.hex()] = (segment, offset, size)
+            else:
+                self.locations.pop(raw.hex(), None)
+        if end != len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+
+    def open_segment(self, segment):
+        '''以追加方式打开写入段'''
+        self.segment = segment
+        self.pack_file = open(self.segment_path(segment), 'ab')
+        self.idx_file = open(self.segment_path(segment, 'idx'), 'ab')
+
+    def write(self, digest, content):
+        '''追加写入图片内容, 已存在时跳过'''
+        with self.write_lock:
+            if digest in self.locations:
+                return
+            if self.pack_file.tell() and \
+                    self.pack_file.tell() + self.HEADER.size + len(content) > self.segment_size:
+                self.pack_file.close()
+                self.idx_file.close()
+                self.open_segment(self.segment + 1)
+            raw = bytes.fromhex(digest)
+            offset = self.pack_file.tell() + self.HEADER.size
+            self.pack_file.write(self.HEADER.pack(self.MAGIC, raw, len(content)))
+            self.pack_file.write(content)
+            self.pack_file.flush()
+            # 内容写入后再写索引, 中断时最多留下未被索引的内容
+            self.idx_file.write(self.ENTRY.pack(raw, offset, len(content)))
+            self.idx_file.flush()
+            self.locations[digest] = (self.segment, offset, len(content))
+
+    def read(self, digest):
+        '''读取图片内容, 不存在时返回 None
+
+        digest: 内容哈希
+        '''
+        location = self.locations.get(digest)
+        if location is None:
+            return None
+        segment, offset, size = location
+        with self.write_lock:
+            mapped = self.maps.get(segment)
+            # 写入段会继续增长, 超出已映射长度时重新映射
+            if mapped is None or len(mapped) < offset + size:
+                if mapped is not None:
+                    mapped.close()
+                with open(self.segment_path(segment), 'rb') as f:
+                    mapped = self.maps[segment] = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped[offset:offset + size]
+
+    def remove(self, digest):
+        '''删除已损坏的图片内容, 在索引中追加删除记录, 段中的数据由 compact 整理'''
+        with self.write_lock:
+            if self.locations.pop(digest, None) is not None:
+                self.idx_file.write(self.ENTRY.pack(bytes.fromhex(digest), 0, 0))
+                self.idx_file.flush()
+
+    def link(self, folder, name, url, digest):
+        '''分段存储不生成按名字访问的文件, 通过 IMAGE 表由图片地址查询哈希'''
+
+    def close(self):
+        with self.write_lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
+            self.pack_file.close()
+            self.idx_file.close()
+
+    def compact(self, live, threshold=0.3):
+        '''整理分段文件, 将仍被引用的图片搬入新段并删除旧段, 需在爬虫停止时运行
+
+        live:       仍被引用的哈希集合
+        threshold:  段中无用数据占比超过该值时整理
+        返回释放的字节数
+        '''
+        sizes = {}
+        used = {}
+        for digest, (segment, offset, size) in self.locations.items():
+            if digest in live:
+                used[segment] = used.get(segment, 0) + self.HEADER.size + size
+        for segment in self.segments():
+            sizes[segment] = os.path.getsize(self.segment_path(segment))
+        targets = [segment for segment in sizes if segment != self.segment and
+                   sizes[segment] and 1 - used.get(segment, 0) / sizes[segment] > threshold]
+
+        freed = 0
+        for segment in targets:
+            moved = [(digest, location) for digest, location in self.locations.items()
+                     if location[0] == segment]
+            for digest, location in moved:
+                content = bytes(self.read(digest)) if digest in live else None
+                del self.locations[digest]
+                if content is not None:
+                    self.write(digest, content)
+            with self.write_lock:
+                mapped = self.maps.pop(segment, None)
+                if mapped is not None:
+                    mapped.close()
+            os.remove(self.segment_path(segment))
+            os.remove(self.segment_path(segment, 'idx'))
+            freed += sizes[segment] - used.get(segment, 0)
+        return freed
+
+
+def open_store(backend='file', root='data', segment_size=256 * 1024 * 1024):
+    '''按存储方式创建图片存储
+
+    backend:        file 为按哈希存储的单个文件, pack 为分段文件
+    root:           数据目录
+    segment_size:   pack 方式单个分段文件大小上限 (字节)
+    '''
+    if backend == 'pack':
+        return PackStore(root, segment_size)
+    return ImageStore(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分段文件图片存储工具')
+    parser.add_argument('command', choices=['compact'])
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='段中无用数据占比超过该值时整理')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini', encoding='utf-8')
+    db_name = config['common'].get('database_name', fallback='data')
+    segment_size = config.getint('image', 'segment_size', fallback=256) * 1024 * 1024
+
+    conn = sqlite3.connect('data/' + db_name + '.sqlite3')
+    live = {row[0] for row in conn.execute('SELECT hash FROM IMAGE')}
+    conn.close()
+    store = PackStore('data', segment_size)
+    freed = store.compact(live, args.threshold)
+    store.close()
+    print('整理完成, 释放 {:.1f} MB.'.format(freed / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
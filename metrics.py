@@ -0,0 +1,332 @@
+'''运行指标
+
+记录各阶段耗时直方图, 请求状态码与代理错误计数, 以及队列长度等指标.
+可通过本地 HTTP 服务以 Prometheus 文本格式 (/metrics) 或 json (/metrics.json) 读取,
+也可定期将 json 快照写入文件.
+
+Class:
+    Counter:        计数器
+    Gauge:          瞬时值
+    Histogram:      直方图
+    Registry:       指标集合
+    SpiderMetrics:  爬虫使用的指标集合
+'''
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 默认直方图分桶上界 (秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in items) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    '''计数器, 线程安全
+
+    name:   指标名称
+    help:   说明
+    '''
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        # 标签 -> 数值
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        '''增加计数
+
+        value:  增加的数值
+        labels: 标签
+        '''
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        return ['{}{} {}'.format(self.name, format_labels(key), format_value(value))
+                for key, value in self.samples()]
+
+    def snapshot(self):
+        return [{'labels': dict(key), 'value': value} for key, value in self.samples()]
+
+
+class Gauge(Counter):
+    '''瞬时值, 可直接设置, 也可在读取时由 collect 函数计算
+
+    name:       指标名称
+    help:       说明
+    label:      collect 返回值中键对应的标签名
+    collect:    读取时调用, 返回 {标签值: 数值}
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help='', label=None, collect=None):
+        Counter.__init__(self, name, help)
+        self.label = label
+        self.collect = collect
+
+    def set(self, value, **labels):
+        '''设置数值
+
+        value:  数值
+        labels: 标签
+        '''
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+    def samples(self):
+        if self.collect is not None:
+            try:
+                for name, value in self.collect().items():
+                    self.set(value, **{self.label: name})
+            except Exception:
+                pass
+        return Counter.samples(self)
+
+
+class Histogram:
+    '''直方图, 线程安全
+
+    name:       指标名称
+    help:       说明
+    buckets:    分桶上界, 升序
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # 标签 -> [各桶计数, 总和, 总数]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        '''记录一次观测值
+
+        value:  观测值
+        labels: 标签
+        '''
+        key = label_key(labels)
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    def samples(self):
+        with self.lock:
+            return [(key, list(data[0]), data[1], data[2]) for key, data in self.values.items()]
+
+    def quantile(self, counts, total, q):
+        '''按分桶估计分位数, 返回所在桶的上界'''
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def render(self):
+        lines = []
+        for key, counts, total, count in self.samples():
+            seen = 0
+            for bound, num in zip(self.buckets, counts):
+                seen += num
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(key, [('le', format_value(bound))]), seen))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(key), format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(key), count))
+        return lines
+
+    def snapshot(self):
+        result = []
+        for key, counts, total, count in self.samples():
+            result.append({
+                'labels': dict(key),
+                'count': count,
+                'sum': total,
+                'mean': total / count if count else 0,
+                'p50': format_value(self.quantile(counts, count, 0.5)),
+                'p95': format_value(self.quantile(counts, count, 0.95)),
+                'buckets': {format_value(bound): num for bound, num in zip(self.buckets, counts)}
+            })
+        return result
+
+
+class Registry:
+    '''指标集合'''
+
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+        self.stopping = threading.Event()
+
+    def counter(self, name, help=''):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help='', label=None, collect=None):
+        return self.register(Gauge(name, help, label, collect))
+
+    def histogram(self, name, help='', buckets=BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''Prometheus 文本格式'''
+        lines = []
+        for metric in self.metrics:
+            if metric.help:
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''json 格式的快照'''
+        return {
+            'time': time.time(),
+            'metrics': {metric.name: {'type': metric.type, 'samples': metric.snapshot()}
+                        for metric in self.metrics}
+        }
+
+    def serve(self, host='127.0.0.1', port=9108):
+        '''在后台线程中启动 HTTP 服务
+
+        host:   监听地址
+        port:   监听端口
+        '''
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith('/metrics.json'):
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = 'application/json'
+                elif self.path.startswith('/metrics'):
+                    body = registry.render().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def dump(self, path):
+        '''将快照写入文件'''
+        temp = path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp, path)
+
+    def start_dump(self, path, interval=10):
+        '''在后台线程中每隔 interval 秒将快照写入文件
+
+        path:       文件路径
+        interval:   间隔 (秒)
+        '''
+        def work():
+            while not self.stopping.wait(interval):
+                self.dump(path)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def close(self):
+        '''停止 HTTP 服务与定期快照'''
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class SpiderMetrics(Registry):
+    '''爬虫使用的指标集合
+
+    阶段 stage 为 list (视频列表) / video (视频页面请求) / parse (页面解析) / comment (评论) /
+    image (图片下载) / verify (图片完整校验) / db_flush (批量写入数据库)
+    '''
+
+    def __init__(self):
+        Registry.__init__(self)
+        self.stage_seconds = self.histogram(
+            'spider_stage_seconds', '各阶段成功处理一次的耗时 (秒)')
+        self.stage_errors = self.counter(
+            'spider_stage_errors_total', '各阶段失败次数')
+        self.http_responses = self.counter(
+            'spider_http_responses_total', '按状态码统计的 HTTP 响应数')
+        self.http_errors = self.counter(
+            'spider_http_errors_total', '未收到响应的请求按异常类型统计的次数')
+        self.proxy_errors = self.counter(
+            'spider_proxy_errors_total', '按代理统计的请求失败次数')
+        self.results = self.counter(
+            'spider_results_total', '写入数据库的结果数')
+        self.duplicates = self.counter(
+            'spider_duplicates_total', '按类型统计的跳过的已知视频与用户数')
+        self.queue_depth = self.gauge(
+            'spider_queue_depth', '各队列中的任务数', 'queue')
+        self.inflight = self.gauge(
+            'spider_inflight_tasks', '各阶段的在途任务数', 'stage')
+
+    @contextmanager
+    def stage(self, name):
+        '''记录一个阶段的耗时, 块内抛出异常时记为失败并继续抛出
+
+        name:   阶段名称
+        '''
+        st = time.time()
+        try:
+            yield
+        except Exception:
+            self.stage_errors.inc(stage=name)
+            raise
+        self.stage_seconds.observe(time.time() - st, stage=name)
@@ -0,0 +1,177 @@
+'''本地代理缓存
+
+后台线程从代理池预取代理放入本地缓冲区, 按成功率与延迟的 EWMA 为代理打分,
+爬虫线程直接从缓冲区借用得分最高的代理, 不再为每个请求访问一次代理池.
+
+Class:
+    ProxyManager:   代理管理器
+'''
+
+import logging
+import random
+import threading
+import time
+
+import tools
+
+# 视为代理被限流的 HTTP 状态码, 其余状态码 (如 404) 是目标内容的问题, 不计为代理失败
+THROTTLE_STATUS = (412, 429)
+
+
+class ProxyStat:
+    '''单个代理的健康统计
+
+    proxy:  代理服务器地址
+    '''
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.success_rate = 1.0
+        self.latency = 1.0
+        self.samples = 0
+        self.inflight = 0
+
+    def score(self):
+        '''得分越高越优先, 正在使用该代理的请求越多得分越低'''
+        return self.success_rate / (self.latency + 0.1) / (1 + self.inflight)
+
+
+class ProxyManager:
+    '''代理管理器, 线程安全
+
+    proxy_url:      代理池地址
+    buffer_size:    本地缓冲代理数
+    alpha:          EWMA 平滑系数
+    min_rate:       成功率低于该值的代理被淘汰
+    min_samples:    淘汰前至少需要的请求次数
+    allow_delete:   是否通知代理池删除被淘汰的代理
+    refill_interval: 缓冲区已满时检查补充的间隔 (秒)
+    ban_time:       被淘汰的代理在该时间 (秒) 内不再使用
+    '''
+
+    def __init__(self, proxy_url, buffer_size=50, alpha=0.3, min_rate=0.3, min_samples=5,
+                 allow_delete=False, refill_interval=5, ban_time=600):
+        self.proxy_url = proxy_url
+        self.buffer_size = buffer_size
+        self.alpha = alpha
+        self.min_rate = min_rate
+        self.min_samples = min_samples
+        self.allow_delete = allow_delete
+        self.refill_interval = refill_interval
+        self.ban_time = ban_time
+        self.proxies = {}
+        # 代理地址 -> 淘汰时间
+        self.banned = {}
+        self.delete_list = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.refill_work, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        '''停止后台线程并唤醒所有等待中的线程'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def lease(self, timeout=None):
+        '''借用当前得分最高的代理, 缓冲区为空时等待补充
+
+        timeout:    最长等待时间 (秒), 为 None 时一直等待
+        返回代理地址, 超时或已关闭时返回 None
+        '''
+        with self.cond:
+            if not self.proxies and not self.closed:
+                self.cond.wait_for(lambda: self.proxies or self.closed, timeout)
+            if not self.proxies:
+                return None
+            # 在随机两个候选与当前最优中取优, 避免所有线程挤在同一个代理上
+            stats = list(self.proxies.values())
+            candidates = random.sample(stats, min(2, len(stats)))
+            candidates.append(max(stats, key=ProxyStat.score))
+            best = max(candidates, key=ProxyStat.score)
+            best.inflight += 1
+            return best.proxy
+
+    def report(self, proxy, success, latency=None):
+        '''归还代理并记录请求结果
+
+        proxy:      代理地址
+        success:    请求是否成功
+        latency:    请求耗时 (秒), 成功时有效
+        '''
+        if not proxy:
+            return
+        with self.cond:
+            stat = self.proxies.get(proxy)
+            if stat is None:
+                return
+            stat.inflight = max(0, stat.inflight - 1)
+            stat.samples += 1
+            stat.success_rate += self.alpha * \
+                ((1.0 if success else 0.0) - stat.success_rate)
+            if success and latency is not None:
+                stat.latency += self.alpha * (latency - stat.latency)
+            if stat.samples >= self.min_samples and stat.success_rate < self.min_rate:
+                logging.debug('淘汰代理 {} (成功率 {:.2f}).'.format(
+                    proxy, stat.success_rate))
+                del self.proxies[proxy]
+                self.banned[proxy] = time.time()
+                if self.allow_delete:
+                    self.delete_list.append(proxy)
+                self.cond.notify_all()
+
+    def size(self):
+        with self.cond:
+            return len(self.proxies)
+
+    def refill_work(self):
+        '''后台补充代理并批量通知代理池删除被淘汰的代理'''
+        while True:
+            with self.cond:
+                if self.closed:
+                    break
+                need = self.buffer_size - len(self.proxies)
+                delete_list, self.delete_list = self.delete_list, []
+                now = time.time()
+                for proxy in [p for p, t in self.banned.items() if now - t > self.ban_time]:
+                    del self.banned[proxy]
+
+            for proxy in delete_list:
+                logging.warning('删除代理 {} !'.format(proxy))
+                tools.delete_proxy(self.proxy_url, proxy)
+
+            added = 0
+            if need > 0:
+                for proxy in self.fetch(need):
+                    with self.cond:
+                        if proxy in self.proxies or proxy in self.banned:
+                            continue
+                        if len(self.proxies) >= self.buffer_size:
+                            break
+                        self.proxies[proxy] = ProxyStat(proxy)
+                        added += 1
+                        self.cond.notify_all()
+                if added:
+                    logging.debug('补充 {} 个代理.'.format(added))
+
+            with self.cond:
+                if self.closed:
+                    break
+                # 缓冲区仍有空缺且本轮有进展时立即继续, 否则等待淘汰通知或定时检查
+                if not (added and len(self.proxies) < self.buffer_size):
+                    self.cond.wait(self.refill_interval if added or not need else 1)
+
+    def fetch(self, need):
+        '''从代理池获取至多 need 个代理'''
+        proxies = tools.get_proxy_list(self.proxy_url)
+        if proxies:
+            with self.cond:
+                proxies = [proxy for proxy in proxies
+                           if proxy not in self.proxies and proxy not in self.banned]
+            random.shuffle(proxies)
+            return proxies[:need]
+        proxy = tools.get_proxy(self.proxy_url)
+        return [proxy] if proxy else []
@@ -0,0 +1,106 @@
+'''视频数据刷新
+
+重新获取数据库中已有视频的 播放 / 弹幕 / 点赞 / 投币 / 收藏 / 分享 / 评论 数,
+追加到 VIDEO_STAT 表中, 并将 VIDEO 表更新为最新值.
+按视频发布时长决定刷新间隔, 每次运行最多请求 budget 个视频.
+视频已删除或不可见等获取失败的情况记录在 VIDEO_REFRESH 表中, 同样按刷新间隔再次尝试. 在仓库根目录运行:
+
+    python refresh.py
+'''
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import spider
+import archive
+import database
+
+CONFIG = spider.CONFIG
+BUDGET = CONFIG.getint('refresh', 'budget', fallback=10000)
+RATIO = CONFIG.getfloat('refresh', 'ratio', fallback=0.1)
+MIN_INTERVAL = CONFIG.getint('refresh', 'min_interval', fallback=3600)
+MAX_INTERVAL = CONFIG.getint('refresh', 'max_interval', fallback=2592000)
+
+logging.info('[refresh][budget]: {}'.format(BUDGET))
+logging.info('[refresh][ratio]: {}'.format(RATIO))
+logging.info('[refresh][min_interval]: {}'.format(MIN_INTERVAL))
+logging.info('[refresh][max_interval]: {}'.format(MAX_INTERVAL))
+
+STAT_URL = spider.API_URL + 'web-interface/archive/stat'
+
+
+def fetch_stat(aid):
+    '''获取视频数据
+
+    aid:    视频 av 号
+    返回 (aid, 视频数据, 响应 code); 视频不存在等失败时视频数据为 None,
+    网络错误时 code 也为 None, 不记录本次尝试
+    '''
+    try:
+        data = spider.GET(STAT_URL, {'aid': aid}).json()
+    except (requests.exceptions.RequestException, ValueError):
+        logging.warning('视频 {} 数据获取失败. 跳过.'.format(aid))
+        return aid, None, None
+    try:
+        if data['code'] != 0:
+            logging.warning('视频 {} 数据获取失败: {}. 跳过.'.format(aid, data.get('message')))
+            return aid, None, data['code']
+        stat = data['data']
+        stat['aid'] = aid
+        stat['time'] = int(time.time())
+        return aid, stat, 0
+    except (KeyError, TypeError):
+        logging.warning('视频 {} 数据格式错误. 跳过.'.format(aid))
+        return aid, None, -1
+
+
+def main():
+    db = database.Database(spider.DB_NAME, synchronous=spider.DB_SYNCHRONOUS)
+    aids = db.get_stale_videos(BUDGET, RATIO, MIN_INTERVAL, MAX_INTERVAL)
+    logging.warning('需要刷新的视频数: {}'.format(len(aids)))
+    if spider.USE_PROXY:
+        spider.PROXIES.start()
+    if spider.ARCHIVE_ENABLED:
+        spider.ARCHIVE = archive.ResponseArchive(
+            'data/archive', spider.ARCHIVE_SEGMENT * 1024 * 1024, spider.ARCHIVE_IMAGES)
+
+    done = 0
+    batch = []
+    failed = []
+    with ThreadPoolExecutor(spider.THREADS) as pool:
+        try:
+            for aid, stat, code in pool.map(fetch_stat, aids):
+                if stat is not None:
+                    batch.append(stat)
+                elif code is not None:
+                    failed.append((aid, code))
+                if len(batch) + len(failed) >= spider.DB_BATCH:
+                    with db.transaction():
+                        db.insert_stats(batch)
+                        db.record_refresh(failed)
+                    done += len(batch)
+                    batch.clear()
+                    failed.clear()
+                    logging.warning('已刷新 {} / {}'.format(done, len(aids)))
+        except KeyboardInterrupt:
+            # 未开始的请求在 GET 中直接失败, 线程池随即退出
+            logging.warning('开始退出...')
+            spider.STOP.set()
+    if batch or failed:
+        with db.transaction():
+            db.insert_stats(batch)
+            db.record_refresh(failed)
+        done += len(batch)
+    del db
+    spider.SESSIONS.close()
+    spider.PROXIES.close()
+    if spider.ARCHIVE is not None:
+        spider.ARCHIVE.close()
+    logging.warning('刷新完成, 共 {} 个视频.'.format(done))
+
+
+if __name__ == '__main__':
+    main()
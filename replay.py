@@ -0,0 +1,161 @@
+'''离线重新解析
+
+从 data/archive/ 中的原始响应存档重新解析 视频页面 / 评论 / 视频数据 响应并写入数据库,
+不发送任何网络请求. 各分段文件在进程池中并行解析, 解析结果由主进程按分段顺序批量写入.
+与爬取时一样, 视频的评论到达末页 (或 max_replies 页数上限) 后才写入 COMMENT 表并完成评论任务.
+页面结构变化后修改 extractor.py, 或需要新字段时修改数据库结构后运行. 在仓库根目录运行:
+
+    python replay.py
+    python replay.py --workers 8 --since 1630000000
+'''
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+import archive
+import database
+import extractor
+
+logging.basicConfig(level=logging.INFO)
+
+
+def parse_record(url, fetched, body, result):
+    '''解析一条响应记录, 按类型追加到 result 中, 视频列表等不需要的响应忽略
+
+    url:        请求地址
+    fetched:    获取时间
+    body:       响应内容
+    result:     解析结果
+    '''
+    parsed = urlparse(url)
+    query = {key: value[0] for key, value in parse_qs(parsed.query).items()}
+    path = parsed.path
+    if '/video/' in path:
+        data = extractor.parse_video(body, {'bvid': path.rstrip('/').split('/')[-1], 'url': url})
+        if data is not None:
+            result['video'].append(data[0])
+            result['user'].append(data[1])
+    elif path.endswith('/v2/reply/main'):
+        data = json.loads(body)['data']
+        replies = data['replies'] or []
+        if replies:
+            result['reply'].append(replies)
+        # 按获取顺序记录 (oid, 是否为第一页, 评论内容, 是否为末页), 由主进程跟踪分页进度;
+        # 第一页的 next 为 0, 旧版本为 1
+        result['page'].append((
+            int(query['oid']), int(query.get('next', 0)) <= 1,
+            [reply['content']['message'] for reply in replies],
+            bool(data['cursor']['is_end']) or not replies))
+    elif path.endswith('/web-interface/archive/stat'):
+        data = json.loads(body)
+        if data['code'] == 0:
+            stat = data['data']
+            stat['aid'] = int(query['aid'])
+            stat['time'] = int(fetched)
+            result['stat'].append(stat)
+
+
+def parse_segment(path, since=0):
+    '''解析一个分段文件, 在进程池中运行
+
+    path:   分段文件路径
+    since:  只解析该时间之后获取的响应
+    返回 (解析结果, 记录数, 解析失败数)
+    '''
+    result = {'video': [], 'user': [], 'reply': [], 'page': [], 'comment': [], 'stat': []}
+    records = 0
+    errors = 0
+    for url, fetched, body in archive.read_segment(path):
+        if fetched < since:
+            continue
+        records += 1
+        try:
+            parse_record(url, fetched, body, result)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            errors += 1
+    return result, records, errors
+
+
+def track_comments(progress, pages, max_pages):
+    '''按获取顺序跟踪各视频的评论分页, 与爬取时一样只在末页或达到页数上限时完成
+
+    progress:   视频 aid -> [第一页评论, 已解析页数], 跨分段保留
+    pages:      一个分段中的 (oid, 是否为第一页, 评论内容, 是否为末页) 列表
+    max_pages:  每个视频最多获取的页数
+    返回评论全部解析完成的视频的 COMMENT 表数据
+    '''
+    comments = []
+    for oid, first, messages, is_end in pages:
+        if first:
+            progress[oid] = [messages, 0]
+        state = progress.get(oid)
+        # 第一页不在解析范围内 (如早于 --since) 时无法生成 COMMENT 表数据
+        if state is None:
+            continue
+        state[1] += 1
+        if is_end or state[1] >= max_pages:
+            del progress[oid]
+            comments.append({'oid': oid, 'data': json.dumps(state[0], ensure_ascii=False)})
+    return comments
+
+
+def write(db, result):
+    '''在一个事务中写入一个分段的解析结果'''
+    with db.transaction():
+        if result['video']:
+            db.insert_videos(result['video'])
+        if result['user']:
+            db.insert_users(result['user'])
+        for replies in result['reply']:
+            db.insert_replies(replies)
+        if result['comment']:
+            db.insert_comments(result['comment'])
+        if result['stat']:
+            db.insert_stats(result['stat'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从原始响应存档离线重新解析')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='解析进程数')
+    parser.add_argument('--since', type=float, default=0, help='只解析该时间戳之后获取的响应')
+    parser.add_argument('--root', default='data/archive', help='存档目录')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('config.ini', encoding='utf-8')
+    db_name = config.get('common', 'database_name', fallback='data')
+    synchronous = config.get('database', 'synchronous', fallback='NORMAL')
+    max_replies = config.getint('comment', 'max_replies', fallback=1000)
+    max_pages = float('inf') if max_replies < 0 else -(-max_replies // 20)
+
+    paths = archive.segments(args.root)
+    logging.warning('存档分段数: {}'.format(len(paths)))
+    db = database.Database(db_name, synchronous=synchronous)
+    st = time.time()
+    total = {'records': 0, 'errors': 0, 'video': 0, 'user': 0, 'reply': 0, 'comment': 0, 'stat': 0}
+    progress = {}
+    with ProcessPoolExecutor(max(1, args.workers)) as pool:
+        # 按分段顺序写入, 同一地址较晚获取的响应覆盖较早的结果
+        for path, (result, records, errors) in zip(
+                paths, pool.map(parse_segment, paths, [args.since] * len(paths))):
+            result['comment'] = track_comments(progress, result.pop('page'), max_pages)
+            write(db, result)
+            total['records'] += records
+            total['errors'] += errors
+            for kind, data in result.items():
+                total[kind] += sum(map(len, data)) if kind == 'reply' else len(data)
+            logging.warning('已解析 {}: {} 条记录, {} 条失败.'.format(path, records, errors))
+    del db
+    if progress:
+        logging.warning('{} 个视频的评论在存档中未到末页, 评论任务保持未完成.'.format(len(progress)))
+    logging.warning('解析完成, 用时 {:.1f} 秒: {}'.format(time.time() - st, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+'''任务调度器
+
+用一个调度器代替各阶段独立的任务队列. 任意工作线程都可以领取任意类型的任务,
+空闲的线程自动转向任务最多的阶段.
+
+领取顺序: 先取优先级最高的任务类型, 同优先级的多个类型按权重平滑轮询.
+每种类型可设置容量上限, 超出时 put 阻塞直至有空位 (失败重试的任务不受限制).
+
+Class:
+    VideoTask:      视频页面任务
+    PicTask:        图片任务
+    CommentTask:    评论任务
+    CommentProgress: 评论分页进度
+    WeightedRoundRobin: 平滑加权轮询
+    RegionProgress: 多分区视频列表进度
+    Scheduler:      调度器
+    Inflight:       在途任务计数
+
+Method:
+    make_task:      由任务表中的记录构造任务
+    parse_mapping:  解析 "类型:数值, ..." 形式的配置
+'''
+
+import json
+import threading
+import time
+from collections import deque
+
+
+class VideoTask:
+    '''视频页面任务
+
+    aid, bvid, cid: 视频编号
+    pn:             所在视频列表页码
+    '''
+    type = 'video'
+    __slots__ = ('aid', 'bvid', 'cid', 'pn')
+
+    def __init__(self, aid, bvid, cid, pn):
+        self.aid = aid
+        self.bvid = bvid
+        self.cid = cid
+        self.pn = pn
+
+    def __repr__(self):
+        return 'VideoTask({})'.format(self.aid)
+
+
+class PicTask:
+    '''图片任务
+
+    type:   video_pic 为视频封面, user_pic 为用户头像
+    id:     视频 aid 或用户 mid
+    url:    图片地址
+    '''
+    __slots__ = ('type', 'id', 'url')
+
+    def __init__(self, type, id, url):
+        self.type = type
+        self.id = id
+        self.url = url
+
+    def __repr__(self):
+        return 'PicTask({}, {})'.format(self.type, self.id)
+
+
+class CommentTask:
+    '''评论任务, 每个任务获取一页评论
+
+    oid:    视频 aid
+    page:   第几页, 从 1 开始
+    cursor: 请求参数 next, 第一页为 0, 之后为上一页响应中的 cursor.next
+    '''
+    type = 'comment'
+    __slots__ = ('oid', 'page', 'cursor')
+
+    def __init__(self, oid, page=1, cursor=0):
+        self.oid = oid
+        self.page = page
+        self.cursor = cursor
+
+    def __repr__(self):
+        return 'CommentTask({}, {})'.format(self.oid, self.page)
+
+
+class CommentProgress:
+    '''评论分页进度, 线程安全
+
+    评论 API 的 next 参数是由上一页响应给出的游标 (cursor.next), 不一定是页码,
+    因此同一视频的评论逐页获取, 每完成一页以其游标生成下一页任务, 直至末页或达到 max_pages 页;
+    不同视频的评论页仍可同时获取. 只保留第一页 (热门) 评论内容用于写入 COMMENT 表.
+
+    max_pages:  每个视频最多获取的页数
+    '''
+
+    def __init__(self, max_pages=float('inf')):
+        self.max_pages = max_pages
+        # 视频 aid -> 第一页评论
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def done(self, task, messages, is_end, cursor):
+        '''记录一页获取完成
+
+        task:       评论任务
+        messages:   该页评论内容列表
+        is_end:     是否为末页
+        cursor:     响应中的 cursor.next
+        返回 (下一页任务, 视频全部完成时为 None; 视频全部完成时为第一页评论否则为 None)
+        '''
+        with self.lock:
+            if task.page == 1:
+                self.states[task.oid] = messages
+            # 游标缺失或没有前进时视为末页, 避免重复获取同一页
+            if is_end or task.page >= self.max_pages or cursor is None or cursor == task.cursor:
+                return None, self.states.pop(task.oid, None) or []
+            return CommentTask(task.oid, task.page + 1, cursor), None
+
+
+class WeightedRoundRobin:
+    '''平滑加权轮询, 任意时段内各键被选中的次数与权重成正比且交替出现
+
+    weights:    {键: 权重}
+    '''
+
+    def __init__(self, weights):
+        self.weights = {key: max(1, weight) for key, weight in weights.items()}
+        self.current = {key: 0 for key in self.weights}
+
+    def select(self, ready):
+        '''在 ready 中按权重选出一个键, ready 为空时返回 None
+
+        ready:  可选的键列表
+        '''
+        if not ready:
+            return None
+        if len(ready) == 1:
+            return ready[0]
+        total = 0
+        for key in ready:
+            self.current[key] += self.weights[key]
+            total += self.weights[key]
+        best = max(ready, key=lambda key: self.current[key])
+        self.current[best] -= total
+        return best
+
+
+class RegionProgress:
+    '''多分区视频列表进度, 按权重交替领取各分区的列表页
+
+    每个分区记录下一页页码与剩余配额, 已领取未完成的页按每页 50 个视频预占配额,
+    分区列表到达末尾或配额用尽后不再领取.
+
+    regions:    {分区 rid: (下一页页码, 剩余配额)}, 配额为 None 时不限
+    weights:    {分区 rid: 权重}
+    '''
+
+    def __init__(self, regions, weights=None):
+        weights = weights or {}
+        # 分区 rid -> [下一页页码, 剩余配额, 获取中的页数, 是否已到末页]
+        self.states = {rid: [pn, float('inf') if quota is None else quota, 0, False]
+                       for rid, (pn, quota) in regions.items()}
+        self.robin = WeightedRoundRobin({rid: weights.get(rid, 1) for rid in self.states})
+
+    def ready(self):
+        '''可以继续领取列表页的分区'''
+        return [rid for rid, state in self.states.items()
+                if not state[3] and state[2] * 50 < state[1]]
+
+    def claim(self, next_page=None):
+        '''按权重领取一页
+
+        next_page:  由分区 rid 领取页码的函数, 返回 None 表示该分区已无可领取的页;
+                    为 None 时按本地记录的页码依次领取
+        返回 (分区 rid, 页码), 没有可领取的分区时返回 None
+        '''
+        while True:
+            rid = self.robin.select(self.ready())
+            if rid is None:
+                return None
+            state = self.states[rid]
+            if next_page is None:
+                pn = state[0]
+                state[0] += 1
+            else:
+                pn = next_page(rid)
+                if pn is None:
+                    state[3] = True
+                    continue
+            state[2] += 1
+            return rid, pn
+
+    def remaining(self, rid):
+        '''分区剩余配额'''
+        return self.states[rid][1]
+
+    def done(self, rid, count, is_end):
+        '''记录一页处理完成
+
+        rid:        分区 rid
+        count:      放入任务队列的视频数
+        is_end:     是否已到列表末尾
+        '''
+        state = self.states[rid]
+        state[1] -= count
+        state[2] -= 1
+        state[3] = state[3] or is_end
+
+    def pages(self):
+        '''各分区下一页页码'''
+        return {rid: state[0] for rid, state in self.states.items()}
+
+
+TASK_TYPES = ('video', 'video_pic', 'user_pic', 'comment')
+
+
+def make_task(type, key, payload):
+    '''由任务表中的记录构造任务
+
+    type:       任务类型
+    key:        视频 aid 或用户 mid
+    payload:    视频任务为 json 格式的 [bvid, cid], 图片任务为图片地址
+    '''
+    if type == 'video':
+        bvid, cid = json.loads(payload)
+        return VideoTask(key, bvid, cid, None)
+    if type == 'comment':
+        return CommentTask(key)
+    return PicTask(type, key, payload)
+
+
+def parse_mapping(text, cast=int, default=None):
+    '''解析 "类型:数值, 类型:数值" 形式的配置
+
+    text:       配置字符串
+    cast:       数值类型
+    default:    省略 ":数值" 时使用的值, 为 None 时不允许省略
+    '''
+    result = {}
+    for item in text.split(','):
+        if item.strip():
+            if default is not None and ':' not in item:
+                result[item.strip()] = default
+                continue
+            key, value = item.split(':')
+            result[key.strip()] = cast(value.strip())
+    return result
+
+
+class Scheduler:
+    '''调度器, 线程安全
+
+    priorities: {任务类型: 优先级}, 数值大者优先
+    weights:    {任务类型: 权重}, 同优先级内按权重分配
+    capacity:   {任务类型: 容量上限}, 0 或缺省为不限
+    '''
+
+    def __init__(self, priorities=None, weights=None, capacity=None):
+        priorities = priorities or {}
+        weights = weights or {}
+        capacity = capacity or {}
+        self.queues = {t: deque() for t in TASK_TYPES}
+        self.priorities = {t: priorities.get(t, 0) for t in TASK_TYPES}
+        self.weights = {t: max(1, weights.get(t, 1)) for t in TASK_TYPES}
+        self.capacity = {t: capacity.get(t, 0) for t in TASK_TYPES}
+        self.robin = WeightedRoundRobin(self.weights)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+
+    def full(self, type):
+        return 0 < self.capacity[type] <= len(self.queues[type])
+
+    def put(self, task, block=True, timeout=None, retry=False):
+        '''放入任务
+
+        task:       任务
+        block:      队列满时是否等待
+        timeout:    最长等待时间 (秒)
+        retry:      失败重试的任务, 放到队首且不受容量限制
+        返回是否放入成功
+        '''
+        with self.lock:
+            if retry:
+                self.queues[task.type].appendleft(task)
+            else:
+                if self.full(task.type):
+                    if not block:
+                        return False
+                    if not self.not_full.wait_for(
+                            lambda: self.closed or not self.full(task.type), timeout):
+                        return False
+                    if self.closed:
+                        return False
+                self.queues[task.type].append(task)
+            self.not_empty.notify()
+            return True
+
+    def select(self):
+        '''在最高优先级的非空类型中按平滑加权轮询选出一个类型'''
+        ready = [t for t in TASK_TYPES if self.queues[t]]
+        if not ready:
+            return None
+        top = max(self.priorities[t] for t in ready)
+        return self.robin.select([t for t in ready if self.priorities[t] == top])
+
+    def get(self, timeout=None):
+        '''领取一个任务, 没有任务时阻塞等待
+
+        timeout:    最长等待时间 (秒), 为 None 时一直等待
+        返回任务, 超时或调度器关闭时返回 None
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while True:
+                type = self.select()
+                if type is not None:
+                    task = self.queues[type].popleft()
+                    if self.capacity[type]:
+                        self.not_full.notify_all()
+                    return task
+                if self.closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.not_empty.wait(remaining)
+
+    def close(self):
+        '''关闭调度器, 唤醒所有等待中的线程'''
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def qsize(self, type=None):
+        '''某类型或全部的排队任务数'''
+        with self.lock:
+            if type:
+                return len(self.queues[type])
+            return sum(len(q) for q in self.queues.values())
+
+
+class Inflight:
+    '''各阶段的在途任务计数, 线程安全
+
+    任务交给下一阶段时先计入下一阶段再移出当前阶段, 总数不会在交接途中短暂归零;
+    总数归零时调用 on_idle.
+
+    on_idle:    总数归零时调用的函数
+    '''
+
+    def __init__(self, on_idle=None):
+        self.counts = {}
+        self.total = 0
+        self.on_idle = on_idle
+        self.lock = threading.Lock()
+
+    def add(self, stage, n=1):
+        '''计入 n 个任务'''
+        with self.lock:
+            self.counts[stage] = self.counts.get(stage, 0) + n
+            self.total += n
+
+    def done(self, stage, n=1):
+        '''移出 n 个任务'''
+        with self.lock:
+            self.counts[stage] -= n
+            self.total -= n
+            idle = self.total == 0
+        if idle and self.on_idle is not None:
+            self.on_idle()
+
+    def move(self, source, target, n=1):
+        '''将 n 个任务从 source 阶段交给 target 阶段'''
+        self.add(target, n)
+        self.done(source, n)
+
+    def empty(self):
+        with self.lock:
+            return self.total == 0
+
+    def snapshot(self):
+        '''各阶段的在途任务数'''
+        with self.lock:
+            return dict(self.counts)
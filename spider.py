@@ -1,17 +1,25 @@
 import time
 import configparser
 import logging
+import os
+import socket
 import requests
 import json
 import threading
-import re
-import io
 from queue import Queue, Empty
-from bs4 import BeautifulSoup
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
 import tools
+import archive
 import database
+import dedup
+import extractor
+import http_pool
+import image_check
+import image_store
+import metrics
+import proxy_manager
+import scheduler
 
 logging.basicConfig(level=logging.INFO)
 
@@ -25,6 +33,12 @@ try:
     DB_NAME = CONFIG['common'].get('database_name', fallback='data')
     THREADS = CONFIG['common'].getint('threads', fallback=1)
     WL_MAX = CONFIG['common'].getint('waiting_list', fallback=100)
+    ENGINE = CONFIG['common'].get('engine', fallback='thread')
+    ASYNC_CONCURRENCY = {
+        'video': CONFIG.getint('async', 'video_concurrency', fallback=THREADS),
+        'comment': CONFIG.getint('async', 'comment_concurrency', fallback=THREADS),
+        'pic': CONFIG.getint('async', 'pic_concurrency', fallback=THREADS + (THREADS // 2))
+    }
     USE_PROXY = CONFIG['proxy'].getboolean('use_proxy', fallback=False)
     PROXY_URL = ''
     if USE_PROXY:
@@ -32,88 +46,204 @@ try:
     ALLOW_FALLBACK = CONFIG['proxy'].getboolean(
         'allow_fallback', fallback=False)
     ALLOW_DELETE = CONFIG['proxy'].getboolean('allow_delete', fallback=False)
-    RID = CONFIG['spider'].get('rid')
+    PROXY_BUFFER = CONFIG['proxy'].getint('buffer_size', fallback=50)
+    POOL_SIZE = CONFIG.getint('http', 'pool_size', fallback=10)
+    KEEP_ALIVE = CONFIG.getboolean('http', 'keep_alive', fallback=True)
+    IDLE_TIMEOUT = CONFIG.getint('http', 'idle_timeout', fallback=60)
+    WORKERS = CONFIG.getint('scheduler', 'workers',
+                            fallback=THREADS * 3 + (THREADS // 2))
+    SCHED_PRIORITIES = scheduler.parse_mapping(CONFIG.get(
+        'scheduler', 'priorities', fallback=''))
+    SCHED_WEIGHTS = scheduler.parse_mapping(CONFIG.get(
+        'scheduler', 'weights', fallback='video_pic:2, user_pic:1, comment:2, video:1'))
+    SCHED_CAPACITY = scheduler.parse_mapping(
+        CONFIG.get('scheduler', 'capacity', fallback=''))
+    SCHED_CAPACITY['video'] = WL_MAX
+    DB_BATCH = CONFIG.getint('database', 'batch_size', fallback=500)
+    DB_FLUSH = CONFIG.getfloat('database', 'flush_interval', fallback=1)
+    DB_SYNCHRONOUS = CONFIG.get('database', 'synchronous', fallback='NORMAL')
+    DB_CLAIM = CONFIG.getint('database', 'claim_batch', fallback=1000)
+    IMAGE_BACKEND = CONFIG.get('image', 'backend', fallback='file')
+    IMAGE_SEGMENT = CONFIG.getint('image', 'segment_size', fallback=256)
+    VERIFY_WORKERS = CONFIG.getint('image', 'verify_workers', fallback=2)
+    COMMENT_MODE = CONFIG.getint('comment', 'mode', fallback=3)
+    COMMENT_MAX = CONFIG.getint('comment', 'max_replies', fallback=1000)
+    if COMMENT_MAX < 0:
+        COMMENT_MAX = float('inf')
+    CLUSTER = CONFIG.getboolean('cluster', 'enabled', fallback=False)
+    # 重启后节点名称不变, 才能恢复上次运行中本节点领取的任务
+    NODE_ID = CONFIG.get('cluster', 'node_id', fallback='') or socket.gethostname()
+    LEASE_TIME = CONFIG.getint('cluster', 'lease_time', fallback=300) if CLUSTER else 0
+    if CLUSTER and not CONFIG.get('cluster', 'node_id', fallback=''):
+        logging.warning('未设置 node_id, 使用主机名 {}. 同一主机的多个进程需分别设置 node_id.'.format(NODE_ID))
+    if CLUSTER and ENGINE != 'thread':
+        logging.warning('多进程协作只支持 thread 引擎, 改用 thread 引擎.')
+        ENGINE = 'thread'
+    if CLUSTER and IMAGE_BACKEND == 'pack':
+        logging.warning('多进程协作不支持 pack 图片存储, 改用 file 方式.')
+        IMAGE_BACKEND = 'file'
+    ARCHIVE_ENABLED = CONFIG.getboolean('archive', 'enabled', fallback=False)
+    ARCHIVE_SEGMENT = CONFIG.getint('archive', 'segment_size', fallback=64)
+    ARCHIVE_IMAGES = CONFIG.getboolean('archive', 'images', fallback=False)
+    METRICS_HOST = CONFIG.get('metrics', 'host', fallback='127.0.0.1')
+    METRICS_PORT = CONFIG.getint('metrics', 'port', fallback=0)
+    METRICS_FILE = CONFIG.get('metrics', 'snapshot', fallback='')
+    METRICS_INTERVAL = CONFIG.getfloat('metrics', 'snapshot_interval', fallback=10)
+    # 分区 rid -> 列表页领取权重
+    RIDS = {int(rid): weight for rid, weight in scheduler.parse_mapping(
+        CONFIG['spider'].get('rid'), default=1).items()}
+    RID_QUOTA = {int(rid): quota for rid, quota in scheduler.parse_mapping(
+        CONFIG.get('spider', 'rid_quota', fallback='')).items()}
     ST_PN = CONFIG['spider'].getint('start_pn', fallback=1)
+    LIST_WINDOW = CONFIG['spider'].getint('list_window', fallback=1)
+    LIST_RATE = CONFIG['spider'].getfloat('list_rate', fallback=1)
+    LIST_BURST = CONFIG['spider'].getint(
+        'list_burst', fallback=max(LIST_WINDOW, WL_MAX // 50))
     VIDEO_NUM = CONFIG['spider'].getint('video_num', fallback=-1)
     if VIDEO_NUM < 0:
         VIDEO_NUM = float('inf')
+    DEDUP = CONFIG['spider'].getboolean('dedup', fallback=True)
 
     logging.info('[common][api_url]: {}'.format(API_URL))
     logging.info('[common][video_url]: {}'.format(VIDEO_URL))
     logging.info('[common][database_name]: {}'.format(DB_NAME))
     logging.info('[common][threads]: {}'.format(THREADS))
     logging.info('[common][waiting_list]: {}'.format(WL_MAX))
+    logging.info('[common][engine]: {}'.format(ENGINE))
+    if ENGINE == 'asyncio':
+        logging.info('[async]: {}'.format(ASYNC_CONCURRENCY))
     logging.info('[proxy][use_proxy]: {}'.format(USE_PROXY))
     logging.info('[proxy][proxy_url]: {}'.format(PROXY_URL))
     logging.info('[proxy][allow_fallback]: {}'.format(ALLOW_FALLBACK))
     logging.info('[proxy][allow_delete]: {}'.format(ALLOW_DELETE))
-    logging.info('[spider][rid]: {}'.format(RID))
+    logging.info('[proxy][buffer_size]: {}'.format(PROXY_BUFFER))
+    logging.info('[http][pool_size]: {}'.format(POOL_SIZE))
+    logging.info('[http][keep_alive]: {}'.format(KEEP_ALIVE))
+    logging.info('[http][idle_timeout]: {}'.format(IDLE_TIMEOUT))
+    logging.info('[scheduler][workers]: {}'.format(WORKERS))
+    logging.info('[scheduler][priorities]: {}'.format(SCHED_PRIORITIES))
+    logging.info('[scheduler][weights]: {}'.format(SCHED_WEIGHTS))
+    logging.info('[scheduler][capacity]: {}'.format(SCHED_CAPACITY))
+    logging.info('[database][batch_size]: {}'.format(DB_BATCH))
+    logging.info('[database][flush_interval]: {}'.format(DB_FLUSH))
+    logging.info('[database][synchronous]: {}'.format(DB_SYNCHRONOUS))
+    logging.info('[database][claim_batch]: {}'.format(DB_CLAIM))
+    logging.info('[image][backend]: {}'.format(IMAGE_BACKEND))
+    logging.info('[image][segment_size]: {}'.format(IMAGE_SEGMENT))
+    logging.info('[image][verify_workers]: {}'.format(VERIFY_WORKERS))
+    logging.info('[comment][mode]: {}'.format(COMMENT_MODE))
+    logging.info('[comment][max_replies]: {}'.format(COMMENT_MAX))
+    logging.info('[cluster][enabled]: {}'.format(CLUSTER))
+    if CLUSTER:
+        logging.info('[cluster][node_id]: {}'.format(NODE_ID))
+        logging.info('[cluster][lease_time]: {}'.format(LEASE_TIME))
+    logging.info('[archive][enabled]: {}'.format(ARCHIVE_ENABLED))
+    logging.info('[archive][segment_size]: {}'.format(ARCHIVE_SEGMENT))
+    logging.info('[archive][images]: {}'.format(ARCHIVE_IMAGES))
+    logging.info('[metrics][host]: {}'.format(METRICS_HOST))
+    logging.info('[metrics][port]: {}'.format(METRICS_PORT))
+    logging.info('[metrics][snapshot]: {}'.format(METRICS_FILE))
+    logging.info('[metrics][snapshot_interval]: {}'.format(METRICS_INTERVAL))
+    logging.info('[spider][rid]: {}'.format(RIDS))
+    logging.info('[spider][rid_quota]: {}'.format(RID_QUOTA))
     logging.info('[spider][start_pn]: {}'.format(ST_PN))
+    logging.info('[spider][list_window]: {}'.format(LIST_WINDOW))
+    logging.info('[spider][list_rate]: {}'.format(LIST_RATE))
+    logging.info('[spider][list_burst]: {}'.format(LIST_BURST))
     logging.info('[spider][video_num]: {}'.format(VIDEO_NUM))
+    logging.info('[spider][dedup]: {}'.format(DEDUP))
 except:
     logging.critical('配置文件载入失败!')
     exit(0)
-START_FLAG = True
+# 设置后各线程停止领取新任务, 等待中的线程立即返回
+STOP = threading.Event()
 WAIT_TIME = 5
 
-# 初始化任务队列
-task_queue = Queue(maxsize=WL_MAX)
-retry_queue = Queue()
-video_queue = Queue()
-user_queue = Queue()
-video_pic_queue = Queue()
-user_pic_queue = Queue()
-video_pic_res_queue = Queue()
-user_pic_res_queue = Queue()
-comment_queue = Queue()
-comment_res_queue = Queue()
-
-
-def GET(url, params={}, use_proxy=USE_PROXY, retry_time=3):
+# 初始化任务调度器
+SCHEDULER = scheduler.Scheduler(SCHED_PRIORITIES, SCHED_WEIGHTS, SCHED_CAPACITY)
+# 爬取结果队列, 元素为 (结果类型, 数据), 由数据库线程批量写入; (None, None) 只用于唤醒数据库线程
+result_queue = Queue()
+# 各阶段的在途任务: queued (调度器中) / 各任务类型 (处理中) / verify (校验中) / result (待写入),
+# 全部归零时唤醒数据库线程判断是否结束
+INFLIGHT = scheduler.Inflight(lambda: result_queue.put((None, None)))
+# 视频列表获取结束, 与全部任务完成
+LIST_DONE = threading.Event()
+DONE = threading.Event()
+# 评论分页进度, 每页 20 条
+COMMENTS = scheduler.CommentProgress(
+    COMMENT_MAX if COMMENT_MAX == float('inf') else -(-COMMENT_MAX // 20))
+# 各分区列表进度, 在 main 中从数据库载入
+REGIONS = None
+# 运行指标
+METRICS = metrics.SpiderMetrics()
+
+# 初始化连接池与本地代理缓存
+SESSIONS = http_pool.SessionPool(POOL_SIZE, KEEP_ALIVE, IDLE_TIMEOUT)
+PROXIES = proxy_manager.ProxyManager(
+    PROXY_URL, PROXY_BUFFER, allow_delete=ALLOW_DELETE)
+
+# 图片内容寻址存储与完整校验进程池, 原始响应存档, 已知的视频与用户, 在 main 中按配置创建
+IMAGES = None
+VERIFIER = None
+ARCHIVE = None
+SEEN = None
+
+
+def lease_proxy():
+    '''从本地代理缓存借用代理, 缓存为空时按配置等待或不使用代理'''
+    proxy = PROXIES.lease(timeout=1)
+    while (not ALLOW_FALLBACK) and (not proxy) and not STOP.is_set():
+        logging.warning('获取代理失败. 重试.')
+        proxy = PROXIES.lease(timeout=1)
+    if not proxy:
+        logging.warning('获取代理失败. 不使用代理.')
+    return proxy
+
+
+def GET(url, params={}, use_proxy=None, retry_time=3):
     ''' 带有重试与代理的 GET 方法
 
     url:        请求 URL
     params:     请求参数
-    use_proxy:  是否使用代理
+    use_proxy:  是否使用代理, 默认按配置
     retry_time: 重试次数上限
     '''
-    proxies = {}
     res = None
+    if use_proxy is None:
+        use_proxy = USE_PROXY
 
-    # 获取代理
-    if use_proxy:
-        proxy = tools.get_proxy(PROXY_URL)
-        while (not ALLOW_FALLBACK) and (not proxy) and START_FLAG:
-            logging.warning('获取代理失败. 重试.')
-            time.sleep(1)
-            proxy = tools.get_proxy(PROXY_URL)
-        if not proxy:
-            logging.warning('获取代理失败. 不使用代理.')
-        else:
-            proxies = {
-                'http': 'http://{}'.format(proxy), 'https': 'https://{}'.format(proxy)}
-
-    # 尝试请求
-    while (retry_time > 0) and START_FLAG:
+    # 尝试请求, 每次尝试借用当前最优的代理
+    while (retry_time > 0) and not STOP.is_set():
+        proxy = lease_proxy() if use_proxy else None
+        st = time.time()
         try:
             headers = {
                 'User-Agent': tools.get_UA(),
                 'X-Forwarded-For': tools.get_IP()
             }
-            res = requests.get(url, headers=headers,
-                               params=params, proxies=proxies, timeout=3)
+            res = SESSIONS.get(url, proxy, headers=headers,
+                               params=params, timeout=3)
             logging.debug(res)
+            METRICS.http_responses.inc(status=res.status_code)
             res.raise_for_status()
+            PROXIES.report(proxy, True, time.time() - st)
             break
-        except:
+        except BaseException as error:
+            if not isinstance(error, requests.exceptions.HTTPError):
+                METRICS.http_errors.inc(error=type(error).__name__)
+            # 只有连接错误、超时与限流计为代理失败, 目标内容不存在等状态码说明代理可用
+            if isinstance(error, requests.exceptions.HTTPError) and \
+                    error.response.status_code not in proxy_manager.THROTTLE_STATUS:
+                PROXIES.report(proxy, True, time.time() - st)
+            else:
+                if proxy:
+                    METRICS.proxy_errors.inc(proxy=proxy)
+                PROXIES.report(proxy, False)
             retry_time -= 1
             if (retry_time == 0):
-                if ALLOW_DELETE:
-                    logging.warning('删除代理 {} !'.format(proxy))
-                    tools.delete_proxy(PROXY_URL, proxy)
                 raise
             logging.debug('GET失败. 重试.(剩余:{} 次)'.format(retry_time))
-            time.sleep(1)
+            STOP.wait(1)
 
     if res == None:
         raise requests.exceptions.RequestException()
@@ -122,423 +252,552 @@ def GET(url, params={}, use_proxy=USE_PROXY, retry_time=3):
     if ('Content-Length' in res.headers) and (len(res.content) != int(res.headers['Content-Length'])):
         logging.warning('{} 获取信息不完整. 重试.'.format(url))
         raise requests.exceptions.RequestException('获取信息不完整')
+    if ARCHIVE is not None:
+        ARCHIVE.record(res.url, res.content, res.headers.get('Content-Type'))
     return res
 
 
-# 由于作业要求不能全部使用 api, 视频信息部分爬取 html 页面进行解析
-class VideoSpiderWithoutAPI(threading.Thread):
-    '''爬取视频页面线程
+def put_task(task, retry=False, timeout=None):
+    '''放入调度器并计入在途任务
 
-    thread_id:  线程 ID
-    video_url:  视频域名
+    task:       任务
+    retry:      失败重试的任务, 放到队首且不受容量限制
+    timeout:    队列满时最长等待时间 (秒)
+    返回是否放入成功
     '''
+    INFLIGHT.add('queued')
+    if SCHEDULER.put(task, timeout=timeout, retry=retry):
+        return True
+    INFLIGHT.done('queued')
+    return False
 
-    def __init__(self, thread_id, video_url):
-        threading.Thread.__init__(self)
-        self.thread_id = thread_id
-        self.video_url = video_url
-        self.finish = False
-
-    def run(self):
-        logging.info('启动 VideoSpider: {}'.format(self.thread_id))
-        self.work()
-        logging.info('退出 VideoSpider: {}'.format(self.thread_id))
-
-    def work(self):
-        while START_FLAG:
-            target = None
-
-            # 获取任务
-            while START_FLAG:
-                try:
-                    if retry_queue.empty():
-                        target = task_queue.get(block=True, timeout=WAIT_TIME)
-                    else:
-                        target = retry_queue.get(
-                            block=True, timeout=WAIT_TIME)
-                    self.finish = False
-                    break
-                except:
-                    self.finish = True
-                    logging.debug('视频队列空，等待 {} 秒...'.format(WAIT_TIME))
-            if not target:
-                break
-
-            # 请求视频页面，获取视频和作者信息
-            try:
-                video_data = {}
-                video_data['aid'] = target[0]
-                video_data['bvid'] = target[1]
-                video_data['cid'] = target[2]
-                video_data['url'] = '{}{}'.format(self.video_url, target[1])
-
-                res = GET(video_data['url'], {})
-
-                json_string = re.search(
-                    '<script>window.__INITIAL_STATE__=({.*});', res.text).group(1)
-                json_data = json.loads(json_string)
-                soup = BeautifulSoup(res.text, 'html.parser')
 
-                if not json_data['videoData']['stat']:
-                    logging.warning('视频 {} 已被删除, 跳过!'.format(target[0]))
-                    continue
+def put_result(kind, data):
+    '''放入爬取结果并计入在途任务
 
-                video_data['title'] = soup.find(
-                    'meta', attrs={'name': 'title'})['content']
-                video_data['keywords'] = soup.find(
-                    'meta', attrs={'name': 'keywords'})['content']
-                video_data['pn'] = target[3]
-                video_data.update(json_data['videoData'])
-                user_data = json_data['upData']
-
-                video_queue.put(video_data)
-                user_queue.put(user_data)
-
-                logging.info('获取视频 {} 成功.'.format(target[0]))
-
-            except requests.exceptions.RequestException:
-                logging.debug('获取视频 {} 失败. 网络错误. 重试.'.format(target[0]))
-                retry_queue.put(target)
-            except AttributeError:
-                logging.warning('获取视频 {} 失败. 格式错误. 重试.'.format(target[0]))
-                retry_queue.put(target)
-            except:
-                logging.error('获取视频 {} 失败. 未知错误. 退出.'.format(target[0]))
-                retry_queue.put(target)
-                raise
+    kind:   结果类型
+    data:   数据
+    '''
+    INFLIGHT.add('result')
+    result_queue.put((kind, data))
 
 
 class VideoListSpider(threading.Thread):
-    '''爬取某分区视频列表线程
+    '''爬取视频列表线程
+
+    同时预取 window 页列表, 按领取顺序放入调度器. 多个分区按权重交替领取列表页,
+    请求频率由令牌桶限制. 多进程协作时每一页都从共享数据库中按租约领取,
+    否则按各分区的进度依次获取.
 
     api_url:    API 域名
-    rid:        分区 rid
-    start_pn:   起始页码 (每页 50 个)
+    regions:    各分区列表进度 scheduler.RegionProgress
     limit:      尝试获取视频数量上限
+    window:     同时获取的页数
+    rate:       每秒最多请求的页数, 不大于 0 时不限速
+    burst:      空闲后允许连续请求的页数, 默认为 window
+    cluster:    是否从共享数据库领取列表页
     '''
 
-    def __init__(self, api_url, rid, start_pn, limit):
+    def __init__(self, api_url, regions, limit, window=1, rate=1, burst=None, cluster=False):
         threading.Thread.__init__(self)
         self.url = api_url + 'web-interface/newlist'
-        self.rid = rid
+        self.regions = regions
         self.limit = limit
-        self.pn = start_pn
-        self.finish = False
+        self.cluster = cluster
+        self.db = None
+        self.window = max(1, window)
+        self.bucket = tools.TokenBucket(rate, burst or self.window)
 
     def run(self):
         logging.info('启动 VideoListSpider')
-        self.work()
-        self.finish = True
+        if self.cluster:
+            self.db = database.Database(DB_NAME, synchronous=DB_SYNCHRONOUS,
+                                        owner=NODE_ID, lease=LEASE_TIME)
+        try:
+            self.work()
+        finally:
+            self.db = None
+            LIST_DONE.set()
+            # 唤醒数据库线程判断是否结束
+            result_queue.put((None, None))
         logging.info('退出 VideoListSpider')
 
-    def work(self):
-        logging.warning('恢复进度. 第 {} 页'.format(self.pn))
+    def claim(self):
+        '''按权重领取下一页, 返回 (分区 rid, 页码), 没有可领取的页时返回 None'''
+        if self.db is not None:
+            return self.regions.claim(self.db.claim_page)
+        return self.regions.claim()
+
+    def fetch(self, rid, pn):
+        '''获取一页视频列表, 失败时重试, 程序退出时返回 None
+
+        rid:    分区 rid
+        pn:     页码
+        '''
         params = {
-            'rid': self.rid,
-            'pn': self.pn,
+            'rid': rid,
+            'pn': pn,
             'ps': 50
         }
-        while START_FLAG:
-            if self.limit <= 0:
-                logging.warning('任务队列视频数已达上限, 停止获取列表.')
-                break
+        while not STOP.is_set():
+            self.bucket.acquire(STOP)
             try:
-                params['pn'] = self.pn
-                data = GET(self.url, params, False).json()
-                logging.info('获取视频列表第 {} 页成功.'.format(self.pn))
+                with METRICS.stage('list'):
+                    data = GET(self.url, params, False).json()
+                    archives = data['data']['archives']
+                logging.info('获取分区 {} 视频列表第 {} 页成功.'.format(rid, pn))
+                return archives
+            except:
+                logging.debug('获取分区 {} 视频列表第 {} 页失败. 重试.'.format(rid, pn))
+        return None
 
-                for video in data['data']['archives']:
-                    # 尝试放入任务队列
-                    if (self.limit <= 0):
+    def work(self):
+        if not self.cluster:
+            for rid, pn in self.regions.pages().items():
+                logging.warning('恢复进度. 分区 {} 第 {} 页'.format(rid, pn))
+        # 已提交获取的页: (分区 rid, 页码) -> Future, 先完成的页缓存在其中, 按领取顺序入队
+        futures = {}
+        with ThreadPoolExecutor(self.window) as pool:
+            while not STOP.is_set():
+                if self.limit <= 0:
+                    logging.warning('任务队列视频数已达上限, 停止获取列表.')
+                    break
+
+                # 补满预取窗口, 不预取超出剩余数量所需的页
+                while len(futures) < self.window and len(futures) * 50 < self.limit:
+                    page = self.claim()
+                    if page is None:
                         break
-                    while START_FLAG:
-                        try:
-                            task_queue.put((video['aid'], video['bvid'], video['cid'], self.pn),
-                                           block=True, timeout=WAIT_TIME)
-                            self.limit -= 1
-                            break
-                        except:
-                            logging.debug('视频队列满，等待 {} 秒...'.format(WAIT_TIME))
+                    futures[page] = pool.submit(self.fetch, *page)
+                if not futures:
+                    logging.warning('已将所有分区的视频载入列表, 停止获取列表.')
+                    break
 
-                if (not data['data']['archives']):
-                    logging.warning('已将当前分区下所有视频载入列表, 停止获取列表.')
+                page = next(iter(futures))
+                rid, pn = page
+                archives = futures.pop(page).result()
+                if archives is None:
                     break
+                if not archives:
+                    self.regions.done(rid, 0, True)
+                    if self.cluster:
+                        put_result('page', (rid, pn, []))
+                    logging.warning('已将分区 {} 下所有视频载入列表.'.format(rid))
+                    continue
 
-                time.sleep(1)
-                self.pn += 1
+                # 列表在爬取期间会移动, 跳过已知的视频; 当前页的任务先写入数据库任务表, 再放入调度器
+                count = len(archives)
+                archives = [video for video in archives if video['aid'] not in SEEN.videos]
+                if len(archives) < count:
+                    METRICS.duplicates.inc(count - len(archives), kind='video')
+                archives = archives[:min(len(archives), self.limit, self.regions.remaining(rid))]
+                for video in archives:
+                    SEEN.videos.add(video['aid'])
+                self.regions.done(rid, len(archives), False)
+                tasks = [scheduler.VideoTask(video['aid'], video['bvid'], video['cid'], pn)
+                         for video in archives]
+                put_result('page', (rid, pn, tasks))
+                for task in tasks:
+                    while not STOP.is_set():
+                        if put_task(task, timeout=WAIT_TIME):
+                            self.limit -= 1
+                            break
+                        logging.debug('视频队列满，等待 {} 秒...'.format(WAIT_TIME))
 
-            except:
-                logging.debug('获取视频列表第 {} 页失败. 重试.'.format(self.pn))
+            for future in futures.values():
+                future.cancel()
 
 
-class PicSpider(threading.Thread):
-    '''爬取图片线程
+class Worker(threading.Thread):
+    '''爬取线程, 从调度器领取并处理任意类型的任务
 
     thread_id:  线程 ID
+    api_url:    API 域名
+    video_url:  视频域名
     '''
 
-    def __init__(self, thread_id):
+    def __init__(self, thread_id, api_url, video_url):
         threading.Thread.__init__(self)
         self.thread_id = thread_id
-        self.finish = False
+        self.comment_url = api_url + 'v2/reply/main'
+        self.video_url = video_url
+        self.handlers = {
+            'video': self.crawl_video,
+            'video_pic': self.crawl_pic,
+            'user_pic': self.crawl_pic,
+            'comment': self.crawl_comment
+        }
 
     def run(self):
-        logging.info('启动 PicSpider: {}'.format(self.thread_id))
+        logging.info('启动 Worker: {}'.format(self.thread_id))
         self.work()
-        logging.info('退出 PicSpider: {}'.format(self.thread_id))
+        logging.info('退出 Worker: {}'.format(self.thread_id))
 
     def work(self):
-        while START_FLAG:
-            data = ('None')
-            pic_type = 'None'
+        while not STOP.is_set():
+            # 调度器关闭时返回 None
+            task = SCHEDULER.get()
+            if task is None:
+                break
+            INFLIGHT.move('queued', task.type)
             try:
-                # 优先爬取视频封面
-                if not video_pic_queue.empty():
-                    pic_type = '视频'
-                    data = video_pic_queue.get(block=True, timeout=WAIT_TIME)
-                    self.finish = False
-                    res = GET(data[1])
-
-                    try:
-                        Image.open(io.BytesIO(res.content)).verify()
-                    except:
-                        meg = '{} {} 图片不完整. 重试.'.format(pic_type, data[0])
-                        logging.warning(meg)
-                        raise requests.exceptions.RequestException(meg)
-
-                    with open('data/video_pic/{}.{}'.format(data[0], data[1].split('.')[-1]), 'wb') as f:
-                        f.write(res.content)
-                    video_pic_res_queue.put(data[0])
-
-                # 然后爬取用户头像
-                else:
-                    pic_type = '用户'
-                    data = user_pic_queue.get(block=True, timeout=WAIT_TIME)
-                    self.finish = False
-                    res = GET(data[1])
-
-                    try:
-                        Image.open(io.BytesIO(res.content)).verify()
-                    except:
-                        meg = '{} {} 图片不完整. 重试.'.format(pic_type, data[0])
-                        logging.warning(meg)
-                        raise requests.exceptions.RequestException(meg)
-
-                    with open('data/user_face/{}.{}'.format(data[0], data[1].split('.')[-1]), 'wb') as f:
-                        f.write(res.content)
-                    user_pic_res_queue.put(data[0])
-
-                logging.info('获取图片 {} {} 成功.'.format(pic_type, data[0]))
-
-            except Empty:
-                self.finish = True
-                logging.debug('图片队列空，等待 {} 秒...'.format(WAIT_TIME))
-            except requests.exceptions.RequestException:
-                logging.debug(
-                    '获取图片 {} {} 失败. 网络错误. 重试.'.format(pic_type, data[0]))
-                if pic_type == '视频':
-                    video_pic_queue.put(data)
-                elif pic_type == '用户':
-                    user_pic_queue.put(data)
-            except:
-                logging.error(
-                    '获取图片 {} {} 失败. 未知错误. 退出!'.format(pic_type, data[0]))
-                raise
-
-
-class CommentSpider(threading.Thread):
-    '''爬取评论线程
-
-    thread_id: 线程 ID
-    api_url
-    '''
+                self.handlers[task.type](task)
+            finally:
+                INFLIGHT.done(task.type)
 
-    def __init__(self, thread_id, api_url):
-        threading.Thread.__init__(self)
-        self.thread_id = thread_id
-        self.url = api_url + 'v2/reply/main'
-        self.finish = False
+    # 由于作业要求不能全部使用 api, 视频信息部分爬取 html 页面进行解析
+    def crawl_video(self, task):
+        '''请求视频页面，获取视频和作者信息'''
+        try:
+            video_data = {}
+            video_data['aid'] = task.aid
+            video_data['bvid'] = task.bvid
+            video_data['cid'] = task.cid
+            video_data['url'] = '{}{}'.format(self.video_url, task.bvid)
 
-    def run(self):
-        logging.info('启动 CommentSpider: {}'.format(self.thread_id))
-        self.work()
-        logging.info('退出 CommentSpider: {}'.format(self.thread_id))
+            with METRICS.stage('video'):
+                res = GET(video_data['url'], {})
 
-    def work(self):
-        while START_FLAG:
-            oid = None
+            with METRICS.stage('parse'):
+                parsed = extractor.parse_video(res.content, video_data)
+
+            if parsed is None:
+                logging.warning('视频 {} 已被删除, 跳过!'.format(task.aid))
+                put_result('video_skip', task.aid)
+                return
+            video_data, user_data = parsed
+
+            put_result('video', video_data)
+            # 同一用户只写入一次并添加一次头像任务
+            if SEEN.users.add(user_data['mid']):
+                put_result('user', user_data)
+            else:
+                METRICS.duplicates.inc(kind='user')
+
+            logging.info('获取视频 {} 成功.'.format(task.aid))
+
+        except requests.exceptions.RequestException:
+            logging.debug('获取视频 {} 失败. 网络错误. 重试.'.format(task.aid))
+            put_task(task, retry=True)
+        except AttributeError:
+            logging.warning('获取视频 {} 失败. 格式错误. 重试.'.format(task.aid))
+            put_task(task, retry=True)
+        except:
+            logging.error('获取视频 {} 失败. 未知错误. 退出.'.format(task.aid))
+            put_task(task, retry=True)
+            raise
+
+    def crawl_pic(self, task):
+        '''获取视频封面或用户头像'''
+        pic_type = '视频' if task.type == 'video_pic' else '用户'
+        folder = 'video_pic' if task.type == 'video_pic' else 'user_face'
+        content = None
+
+        def download(url):
+            nonlocal content
+            with METRICS.stage('image'):
+                res = GET(url)
+                if image_check.quick_check(res.content) is False:
+                    meg = '{} {} 图片不完整. 重试.'.format(pic_type, task.id)
+                    logging.warning(meg)
+                    raise requests.exceptions.RequestException(meg)
+            content = res.content
+            return content
 
-            # 获取任务
-            while START_FLAG:
+        try:
+            # 已下载并通过校验的图片地址不再请求, 只建立链接
+            digest, new = IMAGES.fetch(task.url, download)
+            if new:
+                # 新下载的图片在进程池中完整校验通过后才记入索引并记为完成
+                st = time.time()
+                INFLIGHT.add('verify')
                 try:
-                    oid = comment_queue.get(block=True, timeout=WAIT_TIME)
-                    self.finish = False
-                    break
-                except:
-                    self.finish = True
-                    logging.debug('评论队列空，等待 {} 秒...'.format(WAIT_TIME))
-            if not oid:
-                break
-
-            # 获取评论
-            try:
-                params = {
-                    'oid': oid[0],
-                    'next': 0,
-                    'type': 1,
-                    'mode': 3
-                }
-                res = GET(self.url, params=params)
+                    VERIFIER.submit(content, lambda ok: self.verified(task, digest, ok, st))
+                except BaseException:
+                    # 未能提交校验时撤销计数并释放该地址, 等待同一地址的任务由其中之一重新下载
+                    INFLIGHT.done('verify')
+                    IMAGES.settle(task.url, digest, False)
+                    raise
+                return
+            IMAGES.link(folder, task.id, task.url, digest)
+            put_result(task.type, task.id)
+
+            logging.info('获取图片 {} {} 成功.'.format(pic_type, task.id))
+
+        except requests.exceptions.RequestException:
+            logging.debug(
+                '获取图片 {} {} 失败. 网络错误. 重试.'.format(pic_type, task.id))
+            put_task(task, retry=True)
+        except:
+            logging.error(
+                '获取图片 {} {} 失败. 未知错误. 退出!'.format(pic_type, task.id))
+            put_task(task, retry=True)
+            raise
+
+    @staticmethod
+    def verified(task, digest, ok, st):
+        '''图片完整校验完成, 校验失败时删除内容并重新下载
+
+        task:   图片任务
+        digest: 内容哈希
+        ok:     是否完整
+        st:     提交校验的时间
+        '''
+        pic_type = '视频' if task.type == 'video_pic' else '用户'
+        folder = 'video_pic' if task.type == 'video_pic' else 'user_face'
+        try:
+            # 唤醒等待同一地址的任务, 校验失败时由其中之一重新下载
+            IMAGES.settle(task.url, digest, ok)
+            if ok:
+                METRICS.stage_seconds.observe(time.time() - st, stage='verify')
+                IMAGES.link(folder, task.id, task.url, digest)
+                put_result('image', (task.url, digest))
+                put_result(task.type, task.id)
+                logging.info('获取图片 {} {} 成功.'.format(pic_type, task.id))
+            else:
+                METRICS.stage_errors.inc(stage='verify')
+                logging.warning('{} {} 图片校验失败. 重试.'.format(pic_type, task.id))
+                put_task(task, retry=True)
+        finally:
+            INFLIGHT.done('verify')
+
+    def crawl_comment(self, task):
+        '''获取视频的一页评论, 并按分页进度放入后续页的任务'''
+        try:
+            params = {
+                'oid': task.oid,
+                'next': task.cursor,
+                'type': 1,
+                'mode': COMMENT_MODE
+            }
+            with METRICS.stage('comment'):
+                res = GET(self.comment_url, params=params)
                 json_data = res.json()
-                replies = []
-                try:
-                    if json_data['data']['replies']:
-                        for data in json_data['data']['replies']:
-                            replies.append(data['content']['message'])
-                except:
-                    logging.warning('{} 评论格式出错. 跳过.'.format(oid[0]))
-
+            replies = []
+            is_end = True
+            cursor = None
+            try:
+                replies = json_data['data']['replies'] or []
+                is_end = json_data['data']['cursor']['is_end'] or not replies
+                cursor = json_data['data']['cursor'].get('next')
+            except:
+                logging.warning('{} 评论格式出错. 跳过.'.format(task.oid))
+
+            # 每页评论直接交给数据库线程写入, 不在内存中累积整个视频的评论
+            if replies:
+                put_result('reply', replies)
+            # 下一页的请求参数由本页响应中的游标给出
+            next_task, first = COMMENTS.done(
+                task, [data['content']['message'] for data in replies], is_end, cursor)
+            if next_task is not None:
+                put_task(next_task, retry=True)
+            if first is not None:
                 comment = {
-                    'oid': oid[0],
-                    'data': json.dumps(replies, ensure_ascii=False)
+                    'oid': task.oid,
+                    'data': json.dumps(first, ensure_ascii=False)
                 }
-                comment_res_queue.put(comment)
-                logging.info('获取评论 {} 成功.'.format(oid[0]))
-            except requests.exceptions.RequestException:
-                logging.debug('获取评论失败. 网络错误. 重试.')
-                comment_queue.put(oid)
-            except:
-                logging.error('获取评论 {} 失败. 未知错误. 退出!'.format(oid[0]))
-                raise
+                put_result('comment', comment)
+                logging.info('获取评论 {} 成功.'.format(task.oid))
+        except requests.exceptions.RequestException:
+            logging.debug('获取评论失败. 网络错误. 重试.')
+            put_task(task, retry=True)
+        except:
+            logging.error('获取评论 {} 失败. 未知错误. 退出!'.format(task.oid))
+            raise
 
 
 class SpiderDB(threading.Thread):
     '''数据库交互线程
 
-    db_name:    数据库名称
+    db_name:        数据库名称
+    batch_size:     累计结果数达到该值时写入
+    flush_interval: 最早一条未写入结果等待超过该时间 (秒) 时写入
+    claim_batch:    调度器中每类任务不足一半时, 从任务表补充至该数量
     '''
 
-    def __init__(self, db_name):
+    def __init__(self, db_name, batch_size=500, flush_interval=1, claim_batch=1000):
         threading.Thread.__init__(self)
         self.db_name = db_name
-        self.finish = False
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.claim_batch = claim_batch
+        self.stopping = threading.Event()
 
     def run(self):
         logging.info('启动 SpiderDB')
-        self.db = database.Database(self.db_name)
+        self.db = database.Database(self.db_name, synchronous=DB_SYNCHRONOUS,
+                                    owner=NODE_ID, lease=LEASE_TIME)
         self.work()
         del self.db
         logging.info('退出 SpiderDB')
         logging.info('数据已保存.')
 
     def work(self):
-        # 根据数据库获取图片与评论任务
-        for data in self.db.get_video_pic_list():
-            video_pic_queue.put(data)
-        for data in self.db.get_user_face_list():
-            user_pic_queue.put(data)
-        for data in self.db.get_comment_list():
-            comment_queue.put(data)
-
-        # 根据重新爬取未成功入库的用户信息
-        for data in self.db.get_broken_user_list():
-            task_queue.put((data[0], data[1], data[2], ST_PN))
-
-        while START_FLAG or (not self.finish):
-            # 存入视频结果, 加入图片与评论任务队列
-            while not video_queue.empty():
-                self.finish = False
-                video = video_queue.get(block=False)
-                video_pic_queue.put((video['aid'], video['pic']))
-                comment_queue.put((video['aid'],))
-                self.db.insert_video(video)
-                self.db.update_temp_pn(video['pn'])
-
-            # 存入用户结果, 加入图片队列
-            while not user_queue.empty():
-                self.finish = False
-                user = user_queue.get(block=False)
-                user_pic_queue.put((user['mid'], user['face']))
-                self.db.insert_user(user)
-
-            # 存入视频封面结果
-            while not video_pic_res_queue.empty():
-                self.finish = False
-                aid = video_pic_res_queue.get(block=False)
-                self.db.update_video_pic(aid)
-
-            # 存入用户头像结果
-            while not user_pic_res_queue.empty():
-                self.finish = False
-                mid = user_pic_res_queue.get(block=False)
-                self.db.update_user_pic(mid)
-
-            # 存入评论结果
-            while not comment_res_queue.empty():
-                self.finish = False
-                comment = comment_res_queue.get(block=False)
-                self.db.insert_comment(comment)
-
-            time.sleep(WAIT_TIME)
-            self.finish = video_queue.empty() and user_queue.empty() and video_pic_res_queue.empty(
-            ) and user_pic_res_queue.empty() and comment_res_queue.empty()
+        batch = {'page': [], 'video': [], 'video_skip': [], 'user': [], 'image': [],
+                 'video_pic': [], 'user_pic': [], 'reply': [], 'comment': []}
+        pending = 0
+        deadline = None
+        renew_at = time.time() + LEASE_TIME / 3
+        while not self.stopping.is_set() or pending or (not result_queue.empty()):
+            # 等待结果直至攒满一批或最早的结果超时, 唤醒标记立即处理
+            timeout = WAIT_TIME if deadline is None else max(0, deadline - time.time())
+            try:
+                kind, data = result_queue.get(block=True, timeout=timeout)
+                if kind is not None:
+                    batch[kind].append(data)
+                    pending += 1
+                    if deadline is None:
+                        deadline = time.time() + self.flush_interval
+                    if pending < self.batch_size and time.time() < deadline:
+                        continue
+            except Empty:
+                pass
+
+            if pending:
+                with METRICS.stage('db_flush'):
+                    self.flush(batch)
+                for kind, data in batch.items():
+                    if data:
+                        METRICS.results.inc(
+                            sum(map(len, data)) if kind == 'reply' else len(data), kind=kind)
+                for data in batch.values():
+                    data.clear()
+                INFLIGHT.done('result', pending)
+                pending = 0
+                deadline = None
+            if not STOP.is_set():
+                self.refill()
+            # 多进程协作时定期延长本节点任务的租约
+            if LEASE_TIME and time.time() > renew_at:
+                self.db.renew_leases()
+                renew_at = time.time() + LEASE_TIME / 3
+            # 列表获取结束, 在途任务 (含刚补充的) 全部完成且任务表中没有待处理任务时结束
+            if LIST_DONE.is_set() and INFLIGHT.empty() and not DONE.is_set() \
+                    and not self.db.has_pending_tasks():
+                DONE.set()
+
+    def stop(self):
+        '''写入剩余结果后退出, 应在其他线程退出后调用'''
+        self.stopping.set()
+        result_queue.put((None, None))
+
+    def flush(self, batch):
+        '''在一个事务中批量写入结果, 同时更新任务表
+
+        batch:  按结果类型分组的结果
+        '''
+        with self.db.transaction(immediate=bool(LEASE_TIME)):
+            # 列表页中的视频已放入调度器, 记为已领取; 下一页记录为该分区下次启动的起始页,
+            # 多进程协作时列表进度在领取时已推进, 只需标记该页完成
+            for rid, pn, tasks in batch['page']:
+                self.db.add_tasks('video', [(task.aid, [task.bvid, task.cid])
+                                            for task in tasks], database.CLAIMED)
+                self.db.update_region(rid, pn + 1, len(tasks))
+            if batch['page'] and LEASE_TIME:
+                self.db.finish_tasks('page', [database.page_key(rid, pn)
+                                              for rid, pn, tasks in batch['page']])
+            if batch['video']:
+                self.db.insert_videos(batch['video'])
+            if batch['video_skip']:
+                self.db.finish_tasks('video', batch['video_skip'])
+            if batch['user']:
+                self.db.insert_users(batch['user'])
+            if batch['image']:
+                self.db.insert_images(batch['image'])
+            if batch['video_pic']:
+                self.db.update_video_pics(batch['video_pic'])
+            if batch['user_pic']:
+                self.db.update_user_pics(batch['user_pic'])
+            for replies in batch['reply']:
+                self.db.insert_replies(replies)
+            if batch['comment']:
+                self.db.insert_comments(batch['comment'])
+        logging.debug('写入 {} 条结果.'.format(sum(map(len, batch.values()))))
+
+    def refill(self):
+        '''从任务表领取待处理任务放入调度器'''
+        for type in scheduler.TASK_TYPES:
+            size = SCHEDULER.qsize(type)
+            if size * 2 >= self.claim_batch:
+                continue
+            for key, payload in self.db.claim_tasks(type, self.claim_batch - size):
+                # 已领取的任务不能丢弃, 不受调度器容量限制
+                put_task(scheduler.make_task(type, key, payload), retry=True)
+
+
+def start_metrics():
+    '''按配置启动指标 HTTP 服务与定期 json 快照'''
+    if METRICS_PORT:
+        METRICS.serve(METRICS_HOST, METRICS_PORT)
+        logging.warning('指标地址: http://{}:{}/metrics'.format(METRICS_HOST, METRICS_PORT))
+    if METRICS_FILE:
+        METRICS.start_dump(METRICS_FILE, METRICS_INTERVAL)
+
+
+def stop_metrics():
+    '''停止指标服务, 并写入最后一次快照'''
+    METRICS.close()
+    if METRICS_FILE:
+        METRICS.dump(METRICS_FILE)
 
 
 def main():
     # 从数据库载入进度
-    db = database.Database(DB_NAME)
+    db = database.Database(DB_NAME, owner=NODE_ID, lease=LEASE_TIME)
+    # 上次运行中已领取但未完成的任务重新置为待处理, 须在各线程领取任务前进行
+    db.reset_claims()
     global VIDEO_NUM
     VIDEO_NUM -= db.count_videos()
-    if st_pn := db.get_temp_pn():
-        global ST_PN
-        ST_PN = st_pn
+    global REGIONS, IMAGES, VERIFIER, ARCHIVE, SEEN
+    db.init_regions({rid: RID_QUOTA.get(rid) for rid in RIDS}, ST_PN)
+    REGIONS = scheduler.RegionProgress(db.get_regions(RIDS), RIDS)
+    IMAGES = image_store.open_store(IMAGE_BACKEND, 'data', IMAGE_SEGMENT * 1024 * 1024)
+    IMAGES.load(db.get_images())
+    SEEN = dedup.Seen(db, DEDUP)
     del db
+    VERIFIER = image_check.ImageVerifier(VERIFY_WORKERS)
+    if ARCHIVE_ENABLED:
+        ARCHIVE = archive.ResponseArchive(
+            'data/archive', ARCHIVE_SEGMENT * 1024 * 1024, ARCHIVE_IMAGES)
+
+    if USE_PROXY:
+        PROXIES.start()
+    start_metrics()
+
+    if ENGINE == 'asyncio':
+        import async_spider
+        async_spider.AsyncSpider(API_URL, VIDEO_URL, DB_NAME, REGIONS, VIDEO_NUM, WL_MAX,
+                                 ASYNC_CONCURRENCY, PROXIES if USE_PROXY else None,
+                                 ALLOW_FALLBACK, LIST_RATE, KEEP_ALIVE, IDLE_TIMEOUT,
+                                 IMAGES, VERIFIER, COMMENTS, COMMENT_MODE, METRICS,
+                                 ARCHIVE, SEEN, DB_CLAIM, DB_FLUSH).run()
+        PROXIES.close()
+        VERIFIER.close()
+        IMAGES.close()
+        if ARCHIVE is not None:
+            ARCHIVE.close()
+        stop_metrics()
+        return
 
     # 单线程初始化 视频列表爬虫线程 和 数据库线程
-    list_spider = VideoListSpider(API_URL, RID, ST_PN, VIDEO_NUM)
+    list_spider = VideoListSpider(
+        API_URL, REGIONS, VIDEO_NUM, LIST_WINDOW, LIST_RATE, LIST_BURST, CLUSTER)
     list_spider.start()
-    spider_db = SpiderDB(DB_NAME)
+    spider_db = SpiderDB(DB_NAME, DB_BATCH, DB_FLUSH, DB_CLAIM)
     spider_db.start()
 
-    # 初始化 视频爬虫 和 评论爬虫
-    spider_list = []
-    comment_spider_list = []
-    for i in range(0, THREADS):
-        spider_list.append(VideoSpiderWithoutAPI(i, VIDEO_URL))
-        spider_list[i].start()
-        comment_spider_list.append(CommentSpider(i, API_URL))
-        comment_spider_list[i].start()
-
-    # 1.5倍数量初始化图片爬虫
-    pic_spider_list = []
-    for i in range(0, THREADS + (THREADS // 2)):
-        pic_spider_list.append(PicSpider(i))
-        pic_spider_list[i].start()
-
-    def is_end():
-        '''判断爬虫是否全部结束'''
-        if list_spider.limit > 0 or \
-                task_queue.qsize() > 0 or \
-                video_pic_queue.qsize() > 0 or \
-                user_pic_queue.qsize() > 0 or \
-                comment_queue.qsize() > 0:
-            return False
-        if not list_spider.finish:
-            return False
-        if not spider_db.finish:
-            return False
-        for spider in spider_list:
-            if not spider.finish:
-                return False
-        for spider in pic_spider_list:
-            if not spider.finish:
-                return False
-        for spider in comment_spider_list:
-            if not spider.finish:
-                return False
-        return True
+    METRICS.queue_depth.collect = lambda: dict(
+        {type: SCHEDULER.qsize(type) for type in scheduler.TASK_TYPES},
+        result=result_queue.qsize(), verify=VERIFIER.size(), proxy=PROXIES.size())
+    METRICS.inflight.collect = INFLIGHT.snapshot
+
+    # 初始化爬取线程, 数量与原先 视频 + 评论 + 1.5 倍图片 线程总数相同
+    worker_list = []
+    for i in range(0, WORKERS):
+        worker_list.append(Worker(i, API_URL, VIDEO_URL))
+        worker_list[i].start()
 
-    # 状态显示与结束判断
+    # 状态显示, 全部任务完成时由数据库线程通知结束
     try:
         while True:
             msg = '-' * 20 + '\n' +\
@@ -546,37 +805,45 @@ def main():
                 '排队视频数:     {}\n' + \
                 '排队视频封面数: {}\n' + \
                 '排队用户头像数: {}\n' + \
-                '排队评论数:     {}\n' + '-' * 20 + '\n'
-            msg = msg.format(list_spider.limit, task_queue.qsize(),
-                             video_pic_queue.qsize(), user_pic_queue.qsize(),
-                             comment_queue.qsize())
+                '排队评论数:     {}\n' + \
+                '校验中图片数:   {}\n' + \
+                '在途任务数:     {}\n' + \
+                '连接复用:       {}/{}\n' + \
+                '缓存代理数:     {}\n' + '-' * 20 + '\n'
+            stats = SESSIONS.stats()
+            msg = msg.format(list_spider.limit, SCHEDULER.qsize('video'),
+                             SCHEDULER.qsize('video_pic'), SCHEDULER.qsize('user_pic'),
+                             SCHEDULER.qsize('comment'), VERIFIER.size(), INFLIGHT.total,
+                             stats['reused'], stats['requests'], PROXIES.size())
             print(msg)
-            if is_end():
+            if DONE.wait(10):
                 logging.warning('爬虫任务结束, 准备退出.')
-                raise Exception()
-
-            time.sleep(10)
-    except:
+                break
+    except KeyboardInterrupt:
         pass
 
     logging.warning('开始退出...')
 
-    # 通知线程退出
-    global START_FLAG
-    START_FLAG = False
+    # 通知线程退出, 唤醒等待中的线程
+    STOP.set()
+    SCHEDULER.close()
 
-    # 阻塞等待线程退出
+    # 阻塞等待线程退出, 爬取线程全部退出后数据库线程写入剩余结果
     try:
         list_spider.join()
-        for spider in spider_list:
-            spider.join()
-        for spider in pic_spider_list:
-            spider.join()
-        for spider in comment_spider_list:
-            spider.join()
+        for worker in worker_list:
+            worker.join()
+        VERIFIER.close()
+        spider_db.stop()
         spider_db.join()
-    except:
+    except KeyboardInterrupt:
         pass
+    SESSIONS.close()
+    PROXIES.close()
+    IMAGES.close()
+    if ARCHIVE is not None:
+        ARCHIVE.close()
+    stop_metrics()
 
     logging.warning('退出完成.')
 
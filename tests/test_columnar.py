@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import columnar
+
+SCHEMA = [('id', 'int64'), ('size', 'int32'), ('name', 'string'), ('sex', 'dict'),
+          ('score', 'float64')]
+
+
+def test_round_trip(tmp_path):
+    writer = columnar.Writer(str(tmp_path), SCHEMA)
+    writer.append([(1, 10, 'a', '男', 0.5), (2, None, None, None, None)])
+    writer.append([(3, 30, '中文', '女', 1.5)])
+    writer.commit(100)
+
+    table = columnar.Table(str(tmp_path))
+    assert len(table) == 3
+    assert table.meta['last'] == 100
+    assert list(table.column('id')) == [1, 2, 3]
+    assert table.column('size')[1] == columnar.null_value('int32')
+    assert list(table.column('name')) == ['a', '', '中文']
+    assert list(table.decode('sex')) == ['男', None, '女']
+    assert np.isnan(table.column('score')[1])
+
+
+def test_uncommitted_rows_truncated(tmp_path):
+    writer = columnar.Writer(str(tmp_path), SCHEMA)
+    writer.append([(1, 10, 'a', '男', 0.5)])
+    writer.commit(1)
+    writer.append([(2, 20, 'bb', '女', 1.0)])
+
+    writer = columnar.Writer(str(tmp_path), SCHEMA)
+    writer.append([(3, 30, 'c', '女', 2.0)])
+    writer.commit(2)
+    table = columnar.Table(str(tmp_path))
+    assert list(table.column('id')) == [1, 3]
+    assert list(table.column('name')) == ['a', 'c']
+    assert list(table.decode('sex')) == ['男', '女']
+
+
+def test_latest(tmp_path):
+    writer = columnar.Writer(str(tmp_path), SCHEMA[:1])
+    writer.append([(1,), (2,), (1,), (3,), (2,)])
+    writer.commit(0)
+    assert list(columnar.Table(str(tmp_path)).latest('id')) == [2, 3, 4]
+
+
+def test_schema_mismatch(tmp_path):
+    columnar.Writer(str(tmp_path), SCHEMA).commit(0)
+    with pytest.raises(ValueError):
+        columnar.Writer(str(tmp_path), SCHEMA[:2])
@@ -0,0 +1,34 @@
+from dedup import IntSet, NullSet, Seen
+
+
+def test_int_set_membership():
+    values = IntSet([5, 3, 3])
+    assert len(values) == 2
+    assert 3 in values and 5 in values and 4 not in values
+    assert not values.add(3)
+    assert values.add(4)
+    assert 4 in values
+
+
+def test_int_set_merge():
+    values = IntSet(range(0, 100, 2), merge_size=4)
+    for value in range(1, 100, 2):
+        assert values.add(value)
+    assert len(values) == 100
+    assert all(value in values for value in range(100))
+    assert -1 not in values and 100 not in values
+    assert not values.add(99)
+    assert list(values.sorted) == sorted(values.sorted)
+
+
+def test_null_set():
+    values = NullSet()
+    assert values.add(1) and values.add(1)
+    assert 1 not in values and len(values) == 0
+
+
+def test_seen_disabled():
+    seen = Seen(enabled=False)
+    assert seen.videos.add(1) and seen.videos.add(1)
+    seen = Seen()
+    assert seen.users.add(1) and not seen.users.add(1)
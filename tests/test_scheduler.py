@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import Counter
+
+import scheduler
+from scheduler import CommentProgress, CommentTask, PicTask, RegionProgress, Scheduler, \
+    VideoTask, WeightedRoundRobin
+
+
+def video(aid):
+    return VideoTask(aid, 'BV{}'.format(aid), aid, 1)
+
+
+def pic(id):
+    return PicTask('video_pic', id, 'http://example.com/{}.jpg'.format(id))
+
+
+def drain(sched, n):
+    return [sched.get(timeout=0) for _ in range(n)]
+
+
+def test_round_robin_proportional_and_interleaved():
+    robin = WeightedRoundRobin({'a': 2, 'b': 1})
+    picks = [robin.select(['a', 'b']) for _ in range(30)]
+    assert Counter(picks) == {'a': 20, 'b': 10}
+    assert 'aaa' not in ''.join(picks)
+
+
+def test_round_robin_only_ready_keys():
+    robin = WeightedRoundRobin({'a': 5, 'b': 1})
+    assert robin.select([]) is None
+    assert [robin.select(['b']) for _ in range(3)] == ['b'] * 3
+
+
+def test_equal_priority_shares_by_weight():
+    # 默认优先级相同, 下游积压时视频任务仍按权重被领取
+    sched = Scheduler(weights={'video': 1, 'video_pic': 2})
+    for i in range(10):
+        sched.put(pic(i))
+        sched.put(video(i))
+    types = Counter(task.type for task in drain(sched, 9))
+    assert types == {'video_pic': 6, 'video': 3}
+
+
+def test_higher_priority_is_strict():
+    sched = Scheduler(priorities={'video_pic': 1})
+    for i in range(3):
+        sched.put(video(i))
+        sched.put(pic(i))
+    assert [task.type for task in drain(sched, 6)] == ['video_pic'] * 3 + ['video'] * 3
+
+
+def test_retry_goes_to_front():
+    sched = Scheduler()
+    sched.put(video(1))
+    sched.put(video(2), retry=True)
+    assert [task.aid for task in drain(sched, 2)] == [2, 1]
+
+
+def test_capacity_blocks_put():
+    sched = Scheduler(capacity={'video': 2})
+    assert sched.put(video(1)) and sched.put(video(2))
+    assert not sched.put(video(3), block=False)
+    assert not sched.put(video(3), timeout=0.05)
+    # 重试的任务不受容量限制
+    assert sched.put(video(4), retry=True)
+    assert sched.qsize('video') == 3
+
+
+def test_blocked_put_resumes_after_get():
+    sched = Scheduler(capacity={'video': 1})
+    sched.put(video(1))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(sched.put(video(2), timeout=5)))
+    thread.start()
+    time.sleep(0.05)
+    assert thread.is_alive()
+    assert sched.get(timeout=0).aid == 1
+    thread.join(1)
+    assert result == [True]
+    assert sched.get(timeout=0).aid == 2
+
+
+def test_close_wakes_waiters():
+    full = Scheduler(capacity={'video': 1})
+    full.put(video(1))
+    empty = Scheduler()
+    result = {}
+    threads = [threading.Thread(target=lambda: result.update(put=full.put(video(2)))),
+               threading.Thread(target=lambda: result.update(get=empty.get()))]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    full.close()
+    empty.close()
+    for thread in threads:
+        thread.join(1)
+    assert result == {'put': False, 'get': None}
+
+
+def test_comment_progress_follows_cursor():
+    progress = CommentProgress()
+    task, first = progress.done(CommentTask(1), ['a', 'b'], False, 20)
+    assert first is None
+    assert (task.oid, task.page, task.cursor) == (1, 2, 20)
+    task, first = progress.done(task, ['c'], False, 40)
+    assert (task.page, task.cursor) == (3, 40)
+    # 只返回第一页评论
+    assert progress.done(task, ['d'], True, 60) == (None, ['a', 'b'])
+
+
+def test_comment_progress_end_detection():
+    # 末页标记, 游标缺失, 游标未前进与页数上限均结束该视频
+    for is_end, cursor, max_pages in [(True, 20, 10), (False, None, 10),
+                                      (False, 0, 10), (False, 20, 1)]:
+        progress = CommentProgress(max_pages)
+        assert progress.done(CommentTask(1), ['a'], is_end, cursor) == (None, ['a'])
+        assert progress.states == {}
+
+
+def test_region_progress_reserves_quota():
+    progress = RegionProgress({1: (1, 120), 2: (5, None)}, {1: 1, 2: 1})
+    pages = [progress.claim() for _ in range(8)]
+    # 分区 1 的配额按每页 50 个视频预占, 领取 3 页后不再领取
+    assert [pn for rid, pn in pages if rid == 1] == [1, 2, 3]
+    assert [pn for rid, pn in pages if rid == 2] == [5, 6, 7, 8, 9]
+    progress.done(1, 50, False)
+    assert progress.remaining(1) == 70
+    assert progress.ready() == [2]
+    progress.done(2, 0, True)
+    assert progress.ready() == []
+
+
+def test_region_progress_shared_pages():
+    progress = RegionProgress({1: (1, None), 2: (1, None)})
+    pages = iter([7, None])
+    assert progress.claim(lambda rid: next(pages)) in [(1, 7), (2, 7)]
+    # 领取函数返回 None 的分区不再领取
+    assert progress.claim(lambda rid: None) is None
+    assert progress.claim(lambda rid: 1) is None
+
+
+def test_parse_mapping():
+    assert scheduler.parse_mapping('') == {}
+    assert scheduler.parse_mapping('video:1, comment : 2') == {'video': 1, 'comment': 2}
+    assert scheduler.parse_mapping('1, 2:3', default=1) == {'1': 1, '2': 3}
+
+
+def test_make_task():
+    task = scheduler.make_task('video', 1, '["BV1", 2]')
+    assert (task.type, task.aid, task.bvid, task.cid) == ('video', 1, 'BV1', 2)
+    assert scheduler.make_task('comment', 1, None).cursor == 0
+    assert scheduler.make_task('user_pic', 3, 'url').url == 'url'
@@ -2,15 +2,21 @@
 
 Method:
     get_proxy:      获取代理服务器地址
+    get_proxy_list: 获取代理池中全部代理服务器地址
     delete_proxy:   通知代理池删除代理服务器
     get_UA:         获取随机 UA
     get_IP:         获取随机国内 IP
+
+Class:
+    TokenBucket:    令牌桶限速器
 '''
 
 import random
 import requests
 import logging
 import json
+import threading
+import time
 
 
 with open('ip_list.json', 'r') as f:
@@ -32,6 +38,18 @@ def get_proxy(proxy_url):
         return None
 
 
+def get_proxy_list(proxy_url):
+    '''获取代理池中全部代理服务器地址
+
+    proxy_url:  代理池地址
+    '''
+    try:
+        data = requests.get(proxy_url + 'all/', timeout=5).json()
+        return [item.get('proxy') for item in data if item.get('proxy')]
+    except:
+        return []
+
+
 def delete_proxy(proxy_url, proxy):
     '''通知代理池删除代理服务器
 
@@ -58,3 +76,39 @@ def get_IP():
 def get_UA():
     '''获取随机 UA'''
     return random.choice(UA_list)
+
+
+class TokenBucket:
+    '''令牌桶限速器, 线程安全
+
+    rate:   每秒产生的令牌数, 不大于 0 时不限速
+    burst:  令牌桶容量, 即允许的最大突发数
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, stop=None):
+        '''取得一个令牌, 令牌不足时等待
+
+        stop:   threading.Event, 设置时立即结束等待
+        '''
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.last) * self.rate)
+            self.last = now
+            # 预支令牌, 令牌为负时按欠额计算等待时间, 多个等待者依次排开
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            if stop is not None:
+                stop.wait(wait)
+            else:
+                time.sleep(wait)